@@ -0,0 +1,219 @@
+import asyncio
+import ssl
+from common.log import get_logger, shorten, TRACE
+
+
+class AsyncPOP3Client:
+    """
+    Асинхронный POP3 клиент на asyncio с тем же набором команд, что и POP3Client.
+    Позволяет одному процессу обслуживать много почтовых ящиков одновременно.
+    """
+
+    def __init__(self, server, port, use_ssl=True, timeout=30):
+        self.server = server
+        self.port = port
+        self.use_ssl = use_ssl
+        self.timeout = timeout
+        self.reader = None
+        self.writer = None
+        self.connected = False
+        self.capabilities = None
+        # Ответы на конвейерные TOP, которые еще не прочитаны (обход прерван досрочно)
+        self._outstanding = 0
+        self.logger = get_logger("pop3")
+
+    def log_message(self, message, direction=""):
+        if direction == "ERROR:":
+            self.logger.error("%s", message)
+        elif self.logger.isEnabledFor(TRACE):
+            self.logger.log(TRACE, "%s %s", direction, shorten(message))
+
+    async def connect(self):
+        try:
+            context = ssl.create_default_context() if self.use_ssl else None
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(self.server, self.port, ssl=context,
+                                        server_hostname=self.server if context else None,
+                                        limit=1024 * 1024),
+                self.timeout)
+            response = await self._readline()
+            self.log_message(response.decode('utf-8', errors='replace'), "SERVER:")
+            self.connected = True
+            self.capabilities = None
+            self._outstanding = 0
+            return True
+        except Exception as e:
+            self.log_message(f"Connection error: {str(e)}", "ERROR:")
+            return False
+
+    async def _readline(self):
+        """Читает одну строку ответа без завершающего CRLF"""
+        line = await asyncio.wait_for(self.reader.readuntil(b"\r\n"), self.timeout)
+        return line[:-2]
+
+    async def _read_multiline_bytes(self):
+        """Читает многострочный ответ до строки '.' и снимает dot-stuffing"""
+        chunks = []
+        while True:
+            line = await self._readline()
+            if line == b".":
+                break
+            if line.startswith(b".."):
+                line = line[1:]
+            chunks.append(line)
+        return b"\r\n".join(chunks)
+
+    async def send_command(self, command):
+        if not self.connected:
+            self.log_message("Not connected to server", "ERROR:")
+            return None
+
+        try:
+            await self._drain_pipeline()
+            self.log_message(command, "CLIENT:")
+            self.writer.write(f"{command}\r\n".encode('utf-8'))
+            await self.writer.drain()
+            response = (await self._readline()).decode('utf-8', errors='replace')
+            self.log_message(response, "SERVER:")
+            return response
+        except Exception as e:
+            self.log_message(f"Error sending command: {str(e)}", "ERROR:")
+            return None
+
+    async def receive_multiline(self):
+        try:
+            response = (await self._read_multiline_bytes()).decode('utf-8', errors='replace')
+            self.log_message("Получено многострочное сообщение", "SERVER:")
+            return response
+        except Exception as e:
+            self.log_message(f"Error receiving response: {str(e)}", "ERROR:")
+            return None
+
+    async def retrieve_to(self, msg_number, sink):
+        """
+        Выполняет RETR и записывает письмо в sink (объект с методом write) байтами,
+        как они пришли с сервера, без перекодирования. Строки записываются без
+        dot-stuffing и с окончанием CRLF. Возвращает размер письма или None при ошибке.
+        """
+        response = await self.send_command(f"RETR {msg_number}")
+        if not response or not response.startswith("+OK"):
+            return None
+
+        try:
+            size = 0
+            while True:
+                line = await self._readline()
+                if line == b".":
+                    break
+                if line.startswith(b".."):
+                    line = line[1:]
+                sink.write(line + b"\r\n")
+                size += len(line) + 2
+            self.log_message(f"Получено письмо {msg_number}, {size} байт", "SERVER:")
+            return size
+        except Exception as e:
+            self.connected = False
+            self.log_message(f"Error receiving message: {str(e)}", "ERROR:")
+            return None
+
+    async def _drain_pipeline(self):
+        """Дочитывает ответы на конвейерные TOP, которые вызывающий код не забрал"""
+        while self._outstanding:
+            self._outstanding -= 1
+            if (await self._readline()).startswith(b"+OK"):
+                await self._read_multiline_bytes()
+
+    async def get_capabilities(self):
+        """Запрашивает CAPA; результат кэшируется до следующего подключения"""
+        if self.capabilities is not None:
+            return self.capabilities
+
+        self.capabilities = set()
+        response = await self.send_command("CAPA")
+        if response and response.startswith("+OK"):
+            data = await self.receive_multiline()
+            for line in (data or "").split("\r\n"):
+                if line.strip():
+                    self.capabilities.add(line.split()[0].upper())
+        return self.capabilities
+
+    async def get_uidl_map(self):
+        """Возвращает словарь {номер сообщения: UIDL} или None при ошибке"""
+        response = await self.send_command("UIDL")
+        if not response or not response.startswith("+OK"):
+            return None
+
+        data = await self.receive_multiline()
+        if data is None:
+            return None
+
+        uidl_map = {}
+        for line in data.split("\r\n"):
+            parts = line.split()
+            if len(parts) >= 2:
+                try:
+                    uidl_map[int(parts[0])] = parts[1]
+                except ValueError:
+                    continue
+        return uidl_map
+
+    async def top_pipelined(self, msg_numbers, lines=0, window=50):
+        """
+        Асинхронный генератор пар (номер, данные заголовков или None) для TOP
+        с конвейерной отправкой не более window команд, как в POP3Client.top_pipelined.
+        Если обход прерван досрочно, ответы на уже отправленные команды дочитываются
+        при закрытии генератора или перед следующей командой клиента: async for
+        при break не закрывает генератор сам.
+        """
+        msg_numbers = list(msg_numbers)
+        window = max(1, window)
+        sent = 0
+        received = 0
+        self.log_message(f"TOP x{len(msg_numbers)} (window {window})", "CLIENT:")
+
+        try:
+            await self._drain_pipeline()
+            while received < len(msg_numbers):
+                if sent < len(msg_numbers) and sent - received <= window // 2:
+                    batch = msg_numbers[sent:received + window]
+                    self.writer.write("".join(f"TOP {num} {lines}\r\n" for num in batch).encode('utf-8'))
+                    await self.writer.drain()
+                    sent += len(batch)
+                    self._outstanding += len(batch)
+
+                msg_num = msg_numbers[received]
+                received += 1
+                status = await self._readline()
+                if status.startswith(b"+OK"):
+                    data = (await self._read_multiline_bytes()).decode('utf-8', errors='replace')
+                    self._outstanding -= 1
+                    yield msg_num, data
+                else:
+                    self._outstanding -= 1
+                    self.log_message(f"TOP {msg_num}: {status.decode('utf-8', errors='replace')}", "SERVER:")
+                    yield msg_num, None
+        except GeneratorExit:
+            try:
+                await self._drain_pipeline()
+            except Exception as e:
+                # Ответы дочитаны не полностью - сессию продолжать нельзя
+                self._outstanding = 0
+                self.connected = False
+                self.log_message(f"Error draining pipelined TOP: {str(e)}", "ERROR:")
+            raise
+        except Exception:
+            # Ответ прочитан не полностью - продолжать сессию нельзя
+            self._outstanding = 0
+            self.connected = False
+            raise
+
+    async def close(self):
+        if self.writer:
+            if self.connected:
+                await self.send_command("QUIT")
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
+            self.connected = False
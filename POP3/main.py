@@ -1,13 +1,13 @@
 import socket
 import ssl
 import sys
+import time
 from datetime import datetime
 import re
-import base64
-import quopri
-import email
-from email.header import decode_header
-from email.parser import Parser
+from common.line_reader import LineReader
+from common.log import get_logger, setup_logging, shorten, TRACE
+from common.metrics import get_metrics
+from common.mime import parse_message
 
 
 class POP3Client:
@@ -17,29 +17,97 @@ class POP3Client:
         self.socket = None
         self.connected = False
         self.use_ssl = use_ssl
-        self.log_file = f"pop3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        self.capabilities = None
+        self.reader = None
+        # Вывод команд и ответов в консоль нужен только интерактивному клиенту
+        self.echo = False
+        self.logger = get_logger("pop3")
+        # Реестр метрик: задержки команд, трафик, ошибки
+        self.metrics = get_metrics()
+        self._last_command = None
+        # Время последнего успешного чтения из сокета (time.monotonic); по нему
+        # соединение считается живым без отдельной проверки командой NOOP
+        self.last_activity = None
+        # Номера писем текущей сессии по UIDL из последнего ответа на UIDL
+        self.uidl_numbers = {}
 
     def log_message(self, message, direction=""):
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open(self.log_file, 'a', encoding='utf-8') as f:
-            f.write(f"[{timestamp}] {direction} {message}\n")
-        print(f"{direction} {message}")
+        if direction == "ERROR:":
+            self.logger.error("%s", message)
+        elif self.logger.isEnabledFor(TRACE):
+            self.logger.log(TRACE, "%s %s", direction, shorten(message))
+        if self.echo:
+            print(f"{direction} {message}")
+
+    def _observe(self, name, start, command):
+        """Записывает длительность с момента start в гистограмму name"""
+        self.metrics.observe(name, time.perf_counter() - start, protocol="pop3", command=command)
+
+    def _error(self, command, code):
+        self.metrics.inc("errors_total", protocol="pop3", command=command, code=code)
+
+    def _send(self, data):
+        """Отправляет байты серверу с учетом исходящего трафика"""
+        self.socket.sendall(data)
+        self.metrics.inc("bytes_sent_total", len(data), protocol="pop3")
+
+    def _count_received(self, size):
+        self.last_activity = time.monotonic()
+        self.metrics.inc("bytes_received_total", size, protocol="pop3")
+
+    def _mark_broken(self):
+        """
+        Закрывает соединение после ошибки ввода-вывода: неизвестно, какая часть
+        ответа осталась непрочитанной, поэтому продолжать сессию нельзя.
+        """
+        self.connected = False
+        self.last_activity = None
+        if self.socket:
+            try:
+                self.socket.close()
+            except OSError:
+                pass
+
+    def check_alive(self, idle_threshold=30.0):
+        """
+        Проверяет, что сессия жива. Если данные от сервера приходили не позднее
+        idle_threshold секунд назад, проверка ничего не отправляет; иначе сервер
+        опрашивается командой NOOP. Обрыв соединения, замеченный при любом
+        обмене, отмечается сразу, поэтому мертвый сокет не считается живым.
+        """
+        if not self.connected:
+            return False
+        if self.last_activity is not None and time.monotonic() - self.last_activity < idle_threshold:
+            return True
+        response = self.send_command("NOOP")
+        return bool(response) and response.startswith("+OK")
 
     def connect(self):
         try:
             plain_socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+            start = time.perf_counter()
+            plain_socket.connect((self.server, self.port))
+            self._observe("connect_seconds", start, "CONNECT")
+
             if self.use_ssl:
+                # Рукопожатие выполняется при обертывании уже подключенного сокета
+                start = time.perf_counter()
                 context = ssl.create_default_context()
                 self.socket = context.wrap_socket(plain_socket, server_hostname=self.server)
+                self._observe("tls_seconds", start, "CONNECT")
             else:
                 self.socket = plain_socket
 
-            self.socket.connect((self.server, self.port))
-            response = self.socket.recv(1024).decode('utf-8')
+            self.reader = LineReader(self.socket, on_read=self._count_received)
+            response = self.reader.readline().decode('utf-8', errors='replace')
             self.log_message(response, "SERVER:")
             self.connected = True
+            self.capabilities = None
+            self.uidl_numbers = {}
             return True
         except Exception as e:
+            self._mark_broken()
+            self._error("CONNECT", "exception")
             self.log_message(f"Connection error: {str(e)}", "ERROR:")
             return False
 
@@ -48,81 +116,293 @@ class POP3Client:
             self.log_message("Not connected to server", "ERROR:")
             return None
 
+        verb = command.split(" ", 1)[0].upper()
+        self._last_command = verb
         try:
             self.log_message(command, "CLIENT:")
-            self.socket.send(f"{command}\r\n".encode('utf-8'))
-            response = self.socket.recv(1024).decode('utf-8')
+            start = time.perf_counter()
+            self._send(f"{command}\r\n".encode('utf-8'))
+            response = self.reader.readline().decode('utf-8', errors='replace')
+            self._observe("command_seconds", start, verb)
+            if response.startswith("-ERR"):
+                self._error(verb, "-ERR")
             self.log_message(response, "SERVER:")
             return response
         except Exception as e:
+            self._mark_broken()
+            self._error(verb, "exception")
             self.log_message(f"Error sending command: {str(e)}", "ERROR:")
             return None
 
     def receive_multiline(self):
         try:
-            response = ""
-            while True:
-                line = self.socket.recv(1024).decode('utf-8', errors='replace')
-                response += line
-                if line.endswith('\r\n.\r\n'):
-                    break
+            start = time.perf_counter()
+            response = self.reader.read_multiline().decode('utf-8', errors='replace')
+            self._observe("transfer_seconds", start, self._last_command or "UNKNOWN")
             self.log_message("Получено многострочное сообщение", "SERVER:")
             return response
         except Exception as e:
+            self._mark_broken()
             self.log_message(f"Error receiving response: {str(e)}", "ERROR:")
             return None
 
+    def retrieve_to(self, msg_number, sink, chunk_size=65536):
+        """
+        Выполняет RETR и записывает письмо в sink блоками по chunk_size байт.
+        sink - путь к файлу или объект с методом write, принимающий байты.
+        Возвращает размер записанного письма или None при ошибке.
+        """
+        return self._multiline_to(f"RETR {msg_number}", msg_number, sink, chunk_size)
+
+    def top_to(self, msg_number, lines, sink, chunk_size=65536):
+        """
+        Выполняет TOP и записывает в sink заголовки и первые lines строк тела письма
+        в исходном виде (байтами), как retrieve_to. Возвращает размер или None.
+        """
+        return self._multiline_to(f"TOP {msg_number} {lines}", msg_number, sink, chunk_size)
+
+    def _multiline_to(self, command, msg_number, sink, chunk_size):
+        response = self.send_command(command)
+        if not response or not response.startswith("+OK"):
+            return None
+
+        try:
+            start = time.perf_counter()
+            if isinstance(sink, str):
+                with open(sink, 'wb') as f:
+                    size = self.reader.read_multiline_into(f, chunk_size)
+            else:
+                size = self.reader.read_multiline_into(sink, chunk_size)
+            self._observe("transfer_seconds", start, self._last_command)
+            self.log_message(f"Получено письмо {msg_number}, {size} байт", "SERVER:")
+            return size
+        except Exception as e:
+            self._mark_broken()
+            self.log_message(f"Error receiving message: {str(e)}", "ERROR:")
+            return None
+
+    def get_uidl_map(self):
+        """
+        Запрашивает уникальные идентификаторы сообщений командой UIDL.
+        Возвращает словарь {номер сообщения: UIDL} или None при ошибке.
+        Обратное соответствие сохраняется в uidl_numbers (см. number_for).
+        """
+        response = self.send_command("UIDL")
+        if not response or not response.startswith("+OK"):
+            return None
+
+        data = self.receive_multiline()
+        if data is None:
+            return None
+
+        uidl_map = {}
+        for line in data.split("\r\n"):
+            parts = line.split()
+            if len(parts) >= 2:
+                try:
+                    uidl_map[int(parts[0])] = parts[1]
+                except ValueError:
+                    continue
+        self.uidl_numbers = {uidl: number for number, uidl in uidl_map.items()}
+        return uidl_map
+
+    def number_for(self, uidl):
+        """Номер письма с данным UIDL в текущей сессии или None, если письма нет"""
+        return self.uidl_numbers.get(uidl)
+
+    def get_capabilities(self):
+        """
+        Запрашивает список возможностей сервера командой CAPA (RFC 2449).
+        Результат кэшируется до следующего подключения.
+        """
+        if self.capabilities is not None:
+            return self.capabilities
+
+        self.capabilities = set()
+        try:
+            self.log_message("CAPA", "CLIENT:")
+            start = time.perf_counter()
+            self._send(b"CAPA\r\n")
+            status = self.reader.readline().decode('utf-8', errors='replace')
+            self._observe("command_seconds", start, "CAPA")
+            self.log_message(status, "SERVER:")
+            if status.startswith("+OK"):
+                for line in self.reader.read_multiline().decode('utf-8', errors='replace').split("\r\n"):
+                    if line.strip():
+                        self.capabilities.add(line.split()[0].upper())
+        except Exception as e:
+            self._mark_broken()
+            self._error("CAPA", "exception")
+            self.log_message(f"Error requesting capabilities: {str(e)}", "ERROR:")
+        return self.capabilities
+
+    def top_pipelined(self, msg_numbers, lines=0, window=50):
+        """
+        Генератор, выполняющий TOP для списка сообщений с конвейерной отправкой команд.
+        В сети одновременно находится не более window команд; ответы разбираются
+        по порядку отправки. Возвращает пары (номер, данные) - для ответа -ERR данные равны None.
+        При window=1 работает как обычный последовательный обмен. Если генератор
+        закрыт до конца обхода, ответы на уже отправленные команды дочитываются.
+        Задержкой ответа в метриках считается ожидание его строки статуса после
+        разбора предыдущего ответа, поэтому сумма по TOP равна сетевому времени обхода.
+        """
+        msg_numbers = list(msg_numbers)
+        window = max(1, window)
+        sent = 0
+        received = 0
+        self.log_message(f"TOP x{len(msg_numbers)} (window {window})", "CLIENT:")
+        mark = time.perf_counter()
+
+        try:
+            while received < len(msg_numbers):
+                # Дозаполняем окно, когда в нем освободилась половина мест
+                if sent < len(msg_numbers) and sent - received <= window // 2:
+                    batch = msg_numbers[sent:received + window]
+                    commands = "".join(f"TOP {num} {lines}\r\n" for num in batch)
+                    self._send(commands.encode('utf-8'))
+                    sent += len(batch)
+
+                msg_num = msg_numbers[received]
+                received += 1
+                status = self.reader.readline()
+                self._observe("command_seconds", mark, "TOP")
+                if status.startswith(b"+OK"):
+                    start = time.perf_counter()
+                    data = self.reader.read_multiline().decode('utf-8', errors='replace')
+                    self._observe("transfer_seconds", start, "TOP")
+                    yield msg_num, data
+                else:
+                    self._error("TOP", "-ERR")
+                    self.log_message(f"TOP {msg_num}: {status.decode('utf-8', errors='replace')}", "SERVER:")
+                    yield msg_num, None
+                # Время обработки ответа вызывающим кодом в метрики не попадает
+                mark = time.perf_counter()
+        except GeneratorExit:
+            # Обход прерван досрочно: дочитываем ответы на уже отправленные команды,
+            # чтобы следующая команда не получила чужой ответ
+            try:
+                while received < sent:
+                    received += 1
+                    if self.reader.readline().startswith(b"+OK"):
+                        self.reader.read_multiline()
+            except Exception as e:
+                # Ответы дочитаны не полностью - сессию продолжать нельзя
+                self._mark_broken()
+                self.log_message(f"Error draining pipelined TOP: {str(e)}", "ERROR:")
+            raise
+        except Exception:
+            self._mark_broken()
+            raise
+
+    def delete_pipelined(self, msg_numbers, window=50):
+        """
+        Помечает письма на удаление командами DELE, отправляя их окнами по window
+        команд. Письма удаляются сервером только после QUIT; RSET снимает пометки.
+        Возвращает список номеров, помеченных успешно, или None при обрыве
+        соединения (пометки при этом теряются вместе с сессией).
+        """
+        msg_numbers = list(msg_numbers)
+        window = max(1, window)
+        marked = []
+        self.log_message(f"DELE x{len(msg_numbers)} (window {window})", "CLIENT:")
+        try:
+            for start in range(0, len(msg_numbers), window):
+                batch = msg_numbers[start:start + window]
+                mark = time.perf_counter()
+                self._send("".join(f"DELE {num}\r\n" for num in batch).encode('utf-8'))
+                for msg_num in batch:
+                    status = self.reader.readline()
+                    self._observe("command_seconds", mark, "DELE")
+                    mark = time.perf_counter()
+                    if status.startswith(b"+OK"):
+                        marked.append(msg_num)
+                    else:
+                        self._error("DELE", "-ERR")
+                        self.log_message(f"DELE {msg_num}: {status.decode('utf-8', errors='replace')}", "SERVER:")
+            return marked
+        except Exception as e:
+            self._mark_broken()
+            self._error("DELE", "exception")
+            self.log_message(f"Error deleting messages: {str(e)}", "ERROR:")
+            return None
+
+    def list_pipelined(self, msg_numbers, window=50):
+        """
+        Запрашивает размеры писем командами LIST n, отправляя их окнами по window
+        команд. Возвращает {номер: размер} для существующих писем или None при
+        обрыве соединения.
+        """
+        msg_numbers = list(msg_numbers)
+        window = max(1, window)
+        sizes = {}
+        self.log_message(f"LIST x{len(msg_numbers)} (window {window})", "CLIENT:")
+        try:
+            for start in range(0, len(msg_numbers), window):
+                batch = msg_numbers[start:start + window]
+                mark = time.perf_counter()
+                self._send("".join(f"LIST {num}\r\n" for num in batch).encode('utf-8'))
+                for msg_num in batch:
+                    status = self.reader.readline()
+                    self._observe("command_seconds", mark, "LIST")
+                    mark = time.perf_counter()
+                    parts = status.split()
+                    if status.startswith(b"+OK") and len(parts) >= 3 and parts[2].isdigit():
+                        sizes[msg_num] = int(parts[2])
+                    elif not status.startswith(b"+OK"):
+                        self._error("LIST", "-ERR")
+                        self.log_message(f"LIST {msg_num}: {status.decode('utf-8', errors='replace')}", "SERVER:")
+            return sizes
+        except Exception as e:
+            self._mark_broken()
+            self._error("LIST", "exception")
+            self.log_message(f"Error listing messages: {str(e)}", "ERROR:")
+            return None
+
+    def quit(self):
+        """
+        Завершает сессию командой QUIT - сервер удаляет помеченные письма - и
+        закрывает соединение. Возвращает ответ сервера или None при ошибке.
+        """
+        if not self.connected:
+            return None
+        response = self.send_command("QUIT")
+        self.connected = False
+        self.socket.close()
+        return response
+
     def decode_message(self, message_data):
         try:
-            # Парсим email сообщение
-            email_message = email.message_from_string(message_data)
+            # Разбираем структуру письма; тела частей декодируются только при выводе
+            if isinstance(message_data, str):
+                message_data = message_data.encode('utf-8', errors='replace')
+            message = parse_message(message_data)
 
             print("\n=== Заголовки сообщения ===")
-            # Декодируем и выводим основные заголовки
             for header in ['From', 'To', 'Subject', 'Date']:
-                if header in email_message:
-                    value = email_message[header]
-                    decoded_header = decode_header(value)
-                    decoded_value = ''
-                    for part, charset in decoded_header:
-                        if isinstance(part, bytes):
-                            decoded_value += part.decode(charset or 'utf-8', errors='replace')
-                        else:
-                            decoded_value += part
-                    print(f"{header}: {decoded_value}")
+                if header in message.headers:
+                    print(f"{header}: {message.get_header(header)}")
 
             print("\n=== Содержимое сообщения ===")
-            # Обрабатываем тело сообщения
-            if email_message.is_multipart():
-                for part in email_message.walk():
-                    if part.get_content_type() == "text/plain":
-                        content = part.get_payload()
-                        encoding = part.get('Content-Transfer-Encoding', '')
-
-                        if encoding.lower() == 'base64':
-                            content = base64.b64decode(content).decode('utf-8', errors='replace')
-                        elif encoding.lower() == 'quoted-printable':
-                            content = quopri.decodestring(content).decode('utf-8', errors='replace')
-
-                        print(content)
-                        break
-            else:
-                content = email_message.get_payload()
-                encoding = email_message.get('Content-Transfer-Encoding', '')
+            part = message.text_part or message.html_part
+            print(part.text() if part else "")
 
-                if encoding.lower() == 'base64':
-                    content = base64.b64decode(content).decode('utf-8', errors='replace')
-                elif encoding.lower() == 'quoted-printable':
-                    content = quopri.decodestring(content).decode('utf-8', errors='replace')
-
-                print(content)
+            attachments = message.attachments
+            if attachments:
+                print("\n=== Вложения ===")
+                for attachment in attachments:
+                    print(f"{attachment.filename or 'без имени'} ({attachment.content_type}, {attachment.size} байт)")
 
         except Exception as e:
             print(f"Ошибка при декодировании сообщения: {str(e)}")
 
+    def abort(self):
+        """Закрывает соединение без QUIT: письма, помеченные DELE, сервер не удалит"""
+        self._mark_broken()
+
     def close(self):
         if self.socket:
-            self.send_command("QUIT")
+            if self.connected:
+                self.send_command("QUIT")
             self.socket.close()
             self.connected = False
 
@@ -152,7 +432,9 @@ def main():
 
     port = int(input(f"Введите порт (по умолчанию {default_port}): ") or str(default_port))
 
+    setup_logging(f"pop3_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log", level=TRACE)
     client = POP3Client(server, port, use_ssl)
+    client.echo = True
 
     if not client.connect():
         print("Не удалось подключиться к серверу")
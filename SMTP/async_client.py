@@ -0,0 +1,184 @@
+import asyncio
+import socket
+import ssl
+from common.log import get_logger, shorten, TRACE
+from SMTP.main import SMTPClient
+
+
+class AsyncSMTPClient:
+    """Асинхронный SMTP клиент на asyncio с тем же набором команд, что и SMTPClient"""
+
+    def __init__(self, timeout=30):
+        self.reader = None
+        self.writer = None
+        self.timeout = timeout
+        # Расширения ESMTP из ответа на EHLO: {ключевое слово: параметры}
+        self.esmtp_features = {}
+        self.use_pipelining = True
+        # Ушел ли текст письма в последней транзакции send_mail (см. SMTPClient.message_sent)
+        self.message_sent = False
+        self.logger = get_logger("smtp")
+
+    def log_message(self, message, direction=''):
+        """Записывает сообщение в общий журнал"""
+        if not direction:
+            self.logger.error("%s", message)
+        elif self.logger.isEnabledFor(TRACE):
+            self.logger.log(TRACE, "%s %s", direction, shorten(message))
+
+    async def receive_response(self):
+        """Получает ответ от сервера целиком, включая многострочные ответы вида '250-...'"""
+        try:
+            lines = []
+            while True:
+                line = await asyncio.wait_for(self.reader.readuntil(b"\r\n"), self.timeout)
+                lines.append(line.decode('utf-8', errors='replace'))
+                if len(line) < 6 or line[3:4] != b"-":
+                    break
+            response = "".join(lines)
+            self.log_message(response, '<--')
+            return response
+        except Exception as e:
+            self.log_message(f"Ошибка при получении ответа: {str(e)}")
+            return None
+
+    async def send_command(self, command):
+        """Отправляет команду серверу"""
+        try:
+            self.log_message(command, '-->')
+            # surrogateescape возвращает байты письма, не являющиеся UTF-8, без изменений
+            self.writer.write(f"{command}\r\n".encode('utf-8', errors='surrogateescape'))
+            await self.writer.drain()
+            return await self.receive_response()
+        except Exception as e:
+            self.log_message(f"Ошибка при отправке команды: {str(e)}")
+            return None
+
+    async def connect(self, server, port, use_tls=None, use_ssl=False):
+        """
+        Устанавливает соединение с SMTP-сервером.
+        use_tls включает STARTTLS, как в SMTPClient.connect: по умолчанию он
+        выполняется только на порту 587. use_ssl включает неявный TLS (порт 465).
+        """
+        try:
+            context = ssl.create_default_context() if use_ssl else None
+            self.reader, self.writer = await asyncio.wait_for(
+                asyncio.open_connection(server, port, ssl=context,
+                                        server_hostname=server if context else None),
+                self.timeout)
+
+            # Получаем приветственное сообщение; без EHLO сервер не примет AUTH
+            await self.receive_response()
+            await self.ehlo()
+
+            if not use_ssl and (use_tls or (use_tls is None and port == 587)):  # Для STARTTLS
+                response = await self.send_command("STARTTLS")
+                if response and response.startswith('220'):
+                    # Переводим существующее соединение на TLS
+                    await self.writer.start_tls(ssl.create_default_context(), server_hostname=server)
+                    # После STARTTLS нужно снова отправить EHLO
+                    await self.ehlo()
+                else:
+                    raise Exception("STARTTLS не поддерживается сервером")
+
+            return True
+        except Exception as e:
+            self.log_message(f"Ошибка подключения: {str(e)}")
+            await self.close()
+            self.reader = self.writer = None
+            return False
+
+    async def ehlo(self):
+        """Представляется серверу командой EHLO, при отказе - командой HELO"""
+        self.esmtp_features = {}
+        response = await self.send_command(f"EHLO {socket.gethostname()}")
+        if not response or not response.startswith('250'):
+            return await self.send_command(f"HELO {socket.gethostname()}")
+
+        # Первая строка ответа - имя сервера, остальные - поддерживаемые расширения
+        for line in response.split('\r\n')[1:]:
+            if len(line) > 4:
+                keyword, _, params = line[4:].partition(' ')
+                self.esmtp_features[keyword.upper()] = params
+        return response
+
+    def supports(self, feature):
+        """Проверяет, объявил ли сервер расширение ESMTP в ответе на EHLO"""
+        return feature.upper() in self.esmtp_features
+
+    async def send_pipelined(self, commands):
+        """
+        Отправляет группу команд одной записью (RFC 2920) и возвращает список
+        ответов в порядке отправки команд.
+        """
+        for command in commands:
+            self.log_message(command, '-->')
+        try:
+            self.writer.write("".join(f"{command}\r\n" for command in commands).encode())
+            await self.writer.drain()
+        except Exception as e:
+            self.log_message(f"Ошибка при отправке команд: {str(e)}")
+            return [None] * len(commands)
+        return [await self.receive_response() for _ in commands]
+
+    async def send_mail(self, from_addr, recipients, message):
+        """
+        Выполняет одну почтовую транзакцию MAIL FROM / RCPT TO / DATA так же,
+        как SMTPClient.send_mail, и возвращает кортеж (ответ сервера, отклоненные получатели).
+        """
+        reply_code = SMTPClient.reply_code
+        refused = {}
+        self.message_sent = False
+        if not recipients:
+            return None, refused
+
+        mail_from, message = SMTPClient.prepare_message(from_addr, message, self.supports('8BITMIME'))
+
+        if self.use_pipelining and self.supports('PIPELINING'):
+            # Весь конверт уходит одной записью, ответы сопоставляются с командами по порядку
+            commands = [mail_from] + [f"RCPT TO:<{r}>" for r in recipients] + ["DATA"]
+            replies = await self.send_pipelined(commands)
+            mail_response, rcpt_responses, data_response = replies[0], replies[1:-1], replies[-1]
+        else:
+            mail_response = await self.send_command(mail_from)
+            if reply_code(mail_response) != 250:
+                return mail_response, refused
+            rcpt_responses = [await self.send_command(f"RCPT TO:<{r}>") for r in recipients]
+            data_response = None
+
+        if reply_code(mail_response) != 250:
+            await self._abort_data(data_response)
+            return mail_response, refused
+
+        for recipient, rcpt_response in zip(recipients, rcpt_responses):
+            if reply_code(rcpt_response) not in (250, 251):
+                refused[recipient] = rcpt_response
+
+        if len(refused) == len(recipients):
+            # Ни один получатель не принят - сбрасываем транзакцию
+            await self._abort_data(data_response)
+            await self.send_command("RSET")
+            return rcpt_responses[-1], refused
+
+        if data_response is None:
+            data_response = await self.send_command("DATA")
+        if reply_code(data_response) != 354:
+            await self.send_command("RSET")
+            return data_response, refused
+
+        self.message_sent = True
+        return await self.send_command(SMTPClient.format_data(message)), refused
+
+    async def _abort_data(self, data_response):
+        """Если сервер все же принял DATA в конвейере, завершает пустые данные"""
+        if SMTPClient.reply_code(data_response) == 354:
+            await self.send_command(".")
+
+    async def close(self):
+        """Закрывает соединение"""
+        if self.writer:
+            self.writer.close()
+            try:
+                await self.writer.wait_closed()
+            except Exception:
+                pass
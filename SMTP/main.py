@@ -1,24 +1,75 @@
 import socket
 import ssl
 import datetime
+import time
+import base64
+import quopri
+from email import message_from_bytes
+from email.policy import SMTP as SMTP_POLICY
+from common.line_reader import LineReader
+from common.log import get_logger, log_file, setup_logging, shorten, TRACE
+from common.metrics import get_metrics
 
 
 class SMTPClient:
     def __init__(self):
         self.socket = None
-        self.log_file = f"smtp_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        self.reader = None
+        # Расширения ESMTP из ответа на EHLO: {ключевое слово: параметры}
+        self.esmtp_features = {}
+        self.use_pipelining = True
+        # Ушел ли текст письма в последней транзакции send_mail: после этого
+        # повтор при потере ответа мог бы доставить письмо дважды
+        self.message_sent = False
+        # Вывод команд и ответов в консоль нужен только интерактивному клиенту
+        self.echo = False
+        self.logger = get_logger("smtp")
+        # Реестр метрик: задержки команд, трафик, коды ошибок
+        self.metrics = get_metrics()
 
     def log_message(self, message, direction=''):
-        """Записывает сообщение в лог-файл"""
-        timestamp = datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        with open(self.log_file, 'a', encoding='utf-8') as f:
-            f.write(f"{timestamp} {direction} {message}\n")
-        print(f"{direction} {message}")
+        """Записывает сообщение в общий журнал"""
+        if not direction:
+            self.logger.error("%s", message)
+        elif self.logger.isEnabledFor(TRACE):
+            self.logger.log(TRACE, "%s %s", direction, shorten(message))
+        if self.echo:
+            print(f"{direction} {message}")
+
+    def _observe(self, name, start, command):
+        """Записывает длительность с момента start в гистограмму name"""
+        self.metrics.observe(name, time.perf_counter() - start, protocol="smtp", command=command)
+
+    def _error(self, command, code):
+        self.metrics.inc("errors_total", protocol="smtp", command=command, code=code)
+
+    def _send(self, data):
+        """Отправляет байты серверу с учетом исходящего трафика"""
+        self.socket.sendall(data)
+        self.metrics.inc("bytes_sent_total", len(data), protocol="smtp")
+
+    def _count_received(self, size):
+        self.metrics.inc("bytes_received_total", size, protocol="smtp")
+
+    def _check_reply(self, command, response):
+        """Учитывает в метриках ответы с кодами 4xx и 5xx"""
+        code = self.reply_code(response)
+        if code is not None and code >= 400:
+            self._error(command, str(code))
+
+    @staticmethod
+    def command_name(command):
+        """Имя команды для меток метрик; текст письма после DATA помечается как MESSAGE"""
+        verb = command.split(" ", 1)[0].upper()
+        if "\n" in command or not verb.isalpha() or len(verb) > 10:
+            return "MESSAGE"
+        return verb
 
     def receive_response(self):
-        """Получает ответ от сервера"""
+        """Получает ответ от сервера целиком, включая многострочные ответы вида '250-...'"""
         try:
-            response = self.socket.recv(1024).decode()
+            lines = self.reader.read_reply()
+            response = "".join(line.decode('utf-8', errors='replace') + "\r\n" for line in lines)
             self.log_message(response, '<--')
             return response
         except Exception as e:
@@ -27,48 +78,242 @@ class SMTPClient:
 
     def send_command(self, command):
         """Отправляет команду серверу"""
+        name = self.command_name(command)
         try:
             self.log_message(command, '-->')
-            self.socket.send(f"{command}\r\n".encode())
-            return self.receive_response()
+            start = time.perf_counter()
+            # surrogateescape возвращает байты письма, не являющиеся UTF-8, без изменений
+            self._send(f"{command}\r\n".encode('utf-8', errors='surrogateescape'))
+            response = self.receive_response()
+            self._observe("command_seconds", start, name)
+            self._check_reply(name, response)
+            return response
         except Exception as e:
+            self._error(name, "exception")
             self.log_message(f"Ошибка при отправке команды: {str(e)}")
             return None
 
-    def connect(self, server, port):
-        """Устанавливает соединение с SMTP-сервером"""
+    def connect(self, server, port, use_tls=None):
+        """
+        Устанавливает соединение с SMTP-сервером.
+        use_tls включает STARTTLS; по умолчанию он выполняется только на порту 587.
+        """
         try:
             # Создаем обычный сокет
             self.socket = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
             self.socket.settimeout(10)  # Устанавливаем таймаут
+            start = time.perf_counter()
             self.socket.connect((server, port))
+            self._observe("connect_seconds", start, "CONNECT")
+            self.reader = LineReader(self.socket, on_read=self._count_received)
 
             # Получаем приветственное сообщение
             initial_response = self.receive_response()
 
-            if port == 587:  # Для STARTTLS
+            if use_tls or (use_tls is None and port == 587):  # Для STARTTLS
                 # Отправляем EHLO
-                self.send_command(f"EHLO {socket.gethostname()}")
+                self.ehlo()
 
                 # Отправляем STARTTLS
                 response = self.send_command("STARTTLS")
                 if response and response.startswith('220'):
                     # Создаем SSL контекст
+                    start = time.perf_counter()
                     context = ssl.create_default_context()
                     # Оборачиваем существующий сокет в SSL
                     self.socket = context.wrap_socket(self.socket, server_hostname=server)
+                    self._observe("tls_seconds", start, "STARTTLS")
+                    self.reader = LineReader(self.socket, on_read=self._count_received)
                     # После STARTTLS нужно снова отправить EHLO
-                    self.send_command(f"EHLO {socket.gethostname()}")
+                    self.ehlo()
                 else:
                     raise Exception("STARTTLS не поддерживается сервером")
+            else:
+                self.ehlo()
 
-            print("\nСоединение установлено. Теперь вы можете вводить SMTP команды.")
-            print("Для завершения работы введите 'QUIT'\n")
+            if self.echo:
+                print("\nСоединение установлено. Теперь вы можете вводить SMTP команды.")
+                print("Для завершения работы введите 'QUIT'\n")
             return True
         except Exception as e:
+            self._error("CONNECT", "exception")
             self.log_message(f"Ошибка подключения: {str(e)}")
+            # Сокет (в том числе не переведенный на TLS) закрывается при любой ошибке
+            self.close()
+            self.socket = None
+            self.reader = None
             return False
 
+    def ehlo(self):
+        """Представляется серверу командой EHLO, при отказе - командой HELO"""
+        self.esmtp_features = {}
+        response = self.send_command(f"EHLO {socket.gethostname()}")
+        if not response or not response.startswith('250'):
+            return self.send_command(f"HELO {socket.gethostname()}")
+
+        # Первая строка ответа - имя сервера, остальные - поддерживаемые расширения
+        for line in response.split('\r\n')[1:]:
+            if len(line) > 4:
+                keyword, _, params = line[4:].partition(' ')
+                self.esmtp_features[keyword.upper()] = params
+        return response
+
+    def supports(self, feature):
+        """Проверяет, объявил ли сервер расширение ESMTP в ответе на EHLO"""
+        return feature.upper() in self.esmtp_features
+
+    def send_pipelined(self, commands):
+        """
+        Отправляет группу команд одной записью в сокет (RFC 2920) и
+        возвращает список ответов в порядке отправки команд.
+        Задержкой каждой команды в метриках считается ожидание ее ответа
+        после получения предыдущего.
+        """
+        for command in commands:
+            self.log_message(command, '-->')
+        mark = time.perf_counter()
+        self._send("".join(f"{command}\r\n" for command in commands).encode())
+        replies = []
+        for command in commands:
+            name = self.command_name(command)
+            response = self.receive_response()
+            self._observe("command_seconds", mark, name)
+            self._check_reply(name, response)
+            mark = time.perf_counter()
+            replies.append(response)
+        return replies
+
+    def authenticate(self, username, password):
+        """Выполняет AUTH PLAIN, возвращает True при успешной аутентификации"""
+        auth_string = base64.b64encode(f"\0{username}\0{password}".encode()).decode()
+        start = time.perf_counter()
+        response = self.send_command("AUTH PLAIN " + auth_string)
+        self._observe("auth_seconds", start, "AUTH")
+        return self.reply_code(response) == 235
+
+    @staticmethod
+    def reply_code(response):
+        """Возвращает числовой код ответа сервера или None"""
+        if not response or len(response) < 3 or not response[:3].isdigit():
+            return None
+        return int(response[:3])
+
+    @staticmethod
+    def format_data(message):
+        """
+        Готовит текст письма для команды DATA: приводит переводы строк к CRLF,
+        экранирует строки, начинающиеся с точки, и добавляет завершающую строку '.'
+        Байты не в UTF-8 сохраняются как суррогаты и восстанавливаются при отправке.
+        """
+        if isinstance(message, bytes):
+            message = message.decode('utf-8', errors='surrogateescape')
+        text = message.replace('\r\n', '\n')
+        if text.endswith('\n'):
+            text = text[:-1]
+        lines = ['.' + line if line.startswith('.') else line for line in text.split('\n')]
+        return "\r\n".join(lines) + "\r\n."
+
+    @staticmethod
+    def split_recipients(to_addr):
+        """Возвращает список адресов из строки получателей, разделенных запятыми"""
+        return [addr.strip() for addr in to_addr.split(',') if addr.strip()]
+
+    @staticmethod
+    def prepare_message(from_addr, message, eightbitmime):
+        """
+        Возвращает команду MAIL FROM и текст письма для транзакции. 8bit-данные
+        можно передавать только серверу с 8BITMIME (eightbitmime=True) - с параметром
+        BODY=8BITMIME, остальным письмо перекодируется в 7bit (см. to_7bit).
+        """
+        mail_from = f"MAIL FROM:<{from_addr}>"
+        if not message.isascii():
+            if eightbitmime:
+                mail_from += " BODY=8BITMIME"
+            else:
+                message = SMTPClient.to_7bit(message)
+        return mail_from, message
+
+    @staticmethod
+    def to_7bit(message):
+        """
+        Перекодирует письмо с 8bit-данными для сервера без расширения 8BITMIME:
+        текстовые части - в quoted-printable (без указанной кодировки считается
+        UTF-8), остальные - в base64, заголовки - в encoded words. Возвращает строку ASCII.
+        """
+        if isinstance(message, str):
+            message = message.encode('utf-8', errors='surrogateescape')
+        parsed = message_from_bytes(message, policy=SMTP_POLICY.clone(cte_type='7bit'))
+        for part in parsed.walk():
+            # Части в base64, quoted-printable или из одних символов ASCII не меняются
+            if part.is_multipart() or part.get_payload().isascii():
+                continue
+            data = part.get_payload(decode=True)
+            del part['Content-Transfer-Encoding']
+            if part.get_content_maintype() == 'text':
+                if part.get_param('charset') is None:
+                    part.set_param('charset', 'utf-8')
+                encoded = quopri.encodestring(data.replace(b"\r\n", b"\n")).decode('ascii')
+                part['Content-Transfer-Encoding'] = 'quoted-printable'
+            else:
+                encoded = base64.encodebytes(data).decode('ascii')
+                part['Content-Transfer-Encoding'] = 'base64'
+            part.set_payload(encoded)
+        return parsed.as_bytes().decode('ascii')
+
+    def send_mail(self, from_addr, recipients, message):
+        """
+        Выполняет одну почтовую транзакцию MAIL FROM / RCPT TO / DATA.
+        Возвращает кортеж (ответ сервера, отклоненные получатели), где отклоненные -
+        словарь {адрес: ответ сервера}. Ответ - последний ответ транзакции:
+        на окончание DATA при успехе либо на команду, на которой транзакция прервалась.
+        """
+        refused = {}
+        self.message_sent = False
+        if not recipients:
+            return None, refused
+
+        mail_from, message = self.prepare_message(from_addr, message, self.supports('8BITMIME'))
+
+        if self.use_pipelining and self.supports('PIPELINING'):
+            # Весь конверт уходит одной записью, ответы сопоставляются с командами по порядку
+            commands = [mail_from] + [f"RCPT TO:<{r}>" for r in recipients] + ["DATA"]
+            replies = self.send_pipelined(commands)
+            mail_response, rcpt_responses, data_response = replies[0], replies[1:-1], replies[-1]
+        else:
+            mail_response = self.send_command(mail_from)
+            if self.reply_code(mail_response) != 250:
+                return mail_response, refused
+            rcpt_responses = [self.send_command(f"RCPT TO:<{r}>") for r in recipients]
+            data_response = None
+
+        if self.reply_code(mail_response) != 250:
+            self._abort_data(data_response)
+            return mail_response, refused
+
+        for recipient, rcpt_response in zip(recipients, rcpt_responses):
+            if self.reply_code(rcpt_response) not in (250, 251):
+                refused[recipient] = rcpt_response
+
+        if len(refused) == len(recipients):
+            # Ни один получатель не принят - сбрасываем транзакцию
+            self._abort_data(data_response)
+            self.send_command("RSET")
+            return rcpt_responses[-1], refused
+
+        if data_response is None:
+            data_response = self.send_command("DATA")
+        if self.reply_code(data_response) != 354:
+            self.send_command("RSET")
+            return data_response, refused
+
+        self.message_sent = True
+        return self.send_command(self.format_data(message)), refused
+
+    def _abort_data(self, data_response):
+        """Если сервер все же принял DATA в конвейере, завершает пустые данные"""
+        if self.reply_code(data_response) == 354:
+            self.send_command(".")
+
     def close(self):
         """Закрывает соединение"""
         if self.socket:
@@ -88,7 +333,9 @@ def main():
     server = input("Введите адрес SMTP-сервера: ")
     port = int(input("Введите порт: "))
 
+    setup_logging(f"smtp_{datetime.datetime.now().strftime('%Y%m%d_%H%M%S')}.log", level=TRACE)
     client = SMTPClient()
+    client.echo = True
 
     if not client.connect(server, port):
         print("Не удалось подключиться к серверу")
@@ -124,7 +371,7 @@ def main():
             client.send_command(command)
 
     client.close()
-    print("\nСоединение закрыто. Сессия сохранена в файле", client.log_file)
+    print("\nСоединение закрыто. Сессия сохранена в файле", log_file())
 
 
 if __name__ == "__main__":
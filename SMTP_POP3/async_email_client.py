@@ -0,0 +1,192 @@
+import base64
+import logging
+import tempfile
+from email.message import EmailMessage
+from POP3.async_client import AsyncPOP3Client
+from SMTP.async_client import AsyncSMTPClient
+from SMTP.main import SMTPClient
+from common.log import get_logger
+from email_decoder import EmailDecoder
+
+
+class AsyncEmailClient:
+    """
+    Асинхронный вариант EmailClient. Методы являются корутинами, поэтому
+    один цикл событий может одновременно работать с множеством ящиков и SMTP серверов.
+    """
+
+    def __init__(self):
+        self.smtp_client = None
+        self.pop3_client = None
+        self.smtp_authenticated = False
+        self.pop3_authenticated = False
+        self.logger = get_logger("email_client")
+
+    def log_message(self, message, level="ИНФО:"):
+        """Записывает сообщение в общий журнал"""
+        self.logger.log(logging.ERROR if level == "ОШИБКА:" else logging.INFO, message)
+
+    async def setup_smtp(self, server, port, username, password, use_tls=True):
+        try:
+            self.smtp_client = AsyncSMTPClient()
+            if not await self.smtp_client.connect(server, port, use_tls):
+                return False
+
+            # Выполняем аутентификацию SMTP
+            auth_string = base64.b64encode(f"\0{username}\0{password}".encode()).decode()
+            response = await self.smtp_client.send_command("AUTH PLAIN " + auth_string)
+            if not response or not response.startswith("235"):
+                self.log_message("Ошибка аутентификации SMTP", "ОШИБКА:")
+                return False
+
+            self.smtp_authenticated = True
+            self.log_message("SMTP аутентификация успешна", "ИНФО:")
+            return True
+
+        except Exception as e:
+            self.log_message(f"Ошибка настройки SMTP: {str(e)}", "ОШИБКА:")
+            return False
+
+    async def setup_pop3(self, server, port, username, password, use_ssl=True):
+        try:
+            self.pop3_client = AsyncPOP3Client(server, port, use_ssl)
+            if not await self.pop3_client.connect():
+                return False
+
+            user_response = await self.pop3_client.send_command(f"USER {username}")
+            if not user_response or "+OK" not in user_response:
+                self.log_message("Ошибка при отправке команды USER", "ОШИБКА:")
+                return False
+
+            pass_response = await self.pop3_client.send_command(f"PASS {password}")
+            if not pass_response or "+OK" not in pass_response:
+                self.log_message("Ошибка при отправке команды PASS", "ОШИБКА:")
+                return False
+
+            self.pop3_authenticated = True
+            self.log_message("POP3 аутентификация успешна", "ИНФО:")
+            return True
+
+        except Exception as e:
+            self.log_message(f"Ошибка настройки POP3: {str(e)}", "ОШИБКА:")
+            return False
+
+    async def list_messages(self, pipeline_window=50):
+        """
+        Получает список сообщений с сервера POP3.
+        Возвращает список кортежей (номер, размер, заголовки).
+        """
+        if not self.pop3_authenticated:
+            self.log_message("POP3 клиент не настроен или не авторизован", "ОШИБКА:")
+            return None
+
+        try:
+            response = await self.pop3_client.send_command("LIST")
+            if not response or "+OK" not in response:
+                self.log_message("Ошибка при получении списка сообщений", "ОШИБКА:")
+                return None
+
+            messages_data = await self.pop3_client.receive_multiline()
+            if not messages_data:
+                return []
+
+            sizes = []
+            for line in messages_data.split('\n'):
+                parts = line.strip().split()
+                if len(parts) >= 2:
+                    try:
+                        sizes.append((int(parts[0]), int(parts[1])))
+                    except ValueError:
+                        continue
+
+            if "PIPELINING" in await self.pop3_client.get_capabilities():
+                window = pipeline_window
+            else:
+                window = 1
+
+            headers_by_number = {}
+            async for msg_num, headers_data in self.pop3_client.top_pipelined([num for num, _ in sizes], 0, window):
+                headers_by_number[msg_num] = EmailDecoder.parse_headers(headers_data) if headers_data else None
+
+            messages = [(msg_num, msg_size, headers_by_number.get(msg_num)) for msg_num, msg_size in sizes]
+            self.log_message(f"Получено {len(messages)} сообщений", "ИНФО:")
+            return messages
+
+        except Exception as e:
+            self.log_message(f"Ошибка при получении списка сообщений: {str(e)}", "ОШИБКА:")
+            return None
+
+    async def get_message_headers(self, msg_number):
+        if not self.pop3_authenticated:
+            return None
+
+        try:
+            response = await self.pop3_client.send_command(f"TOP {msg_number} 0")
+            if not response or "+OK" not in response:
+                return None
+
+            headers_data = await self.pop3_client.receive_multiline()
+            if not headers_data:
+                return None
+
+            return EmailDecoder.parse_headers(headers_data)
+
+        except Exception as e:
+            self.log_message(f"Ошибка при получении заголовков сообщения {msg_number}: {str(e)}", "ОШИБКА:")
+            return None
+
+    async def read_message(self, msg_number):
+        if not self.pop3_authenticated:
+            return None
+
+        try:
+            # Письмо принимается байтами: кодировку тела определяет декодер
+            with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+                if not await self.pop3_client.retrieve_to(msg_number, spool):
+                    return None
+                spool.seek(0)
+                return EmailDecoder.decode_message_stream(spool)
+
+        except Exception as e:
+            self.log_message(f"Ошибка при чтении сообщения {msg_number}: {str(e)}", "ОШИБКА:")
+            return None
+
+    async def send_email(self, from_addr, to_addr, subject, message):
+        if not self.smtp_authenticated:
+            self.log_message("Требуется аутентификация SMTP", "ОШИБКА:")
+            return False
+
+        try:
+            email_message = EmailMessage()
+            email_message['From'] = from_addr
+            email_message['To'] = to_addr
+            email_message['Subject'] = subject
+            email_message.set_content(message)
+
+            recipients = SMTPClient.split_recipients(to_addr)
+            if not recipients:
+                self.log_message("Не указаны получатели письма", "ОШИБКА:")
+                return False
+
+            response, refused = await self.smtp_client.send_mail(from_addr, recipients, email_message.as_string())
+            for recipient, reason in refused.items():
+                self.log_message(f"Получатель {recipient} отклонен: {reason}", "ОШИБКА:")
+
+            if SMTPClient.reply_code(response) != 250:
+                self.log_message(f"Письмо не отправлено: {response}", "ОШИБКА:")
+                return False
+
+            self.log_message(f"Письмо для {to_addr} отправлено", "ИНФО:")
+            return True
+
+        except Exception as e:
+            self.log_message(f"Ошибка при отправке письма: {str(e)}", "ОШИБКА:")
+            return False
+
+    async def close(self):
+        if self.smtp_client:
+            if self.smtp_authenticated:
+                await self.smtp_client.send_command("QUIT")
+            await self.smtp_client.close()
+        if self.pop3_client:
+            await self.pop3_client.close()
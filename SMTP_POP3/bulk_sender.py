@@ -0,0 +1,202 @@
+import logging
+import time
+from SMTP.main import SMTPClient
+from common.log import get_logger
+from common.metrics import get_metrics
+
+
+class OutgoingMessage:
+    """Письмо для массовой отправки: отправитель, получатели и готовый текст письма"""
+
+    def __init__(self, from_addr, recipients, data, message_id=None):
+        self.from_addr = from_addr
+        self.recipients = [recipients] if isinstance(recipients, str) else list(recipients)
+        self.data = data if isinstance(data, (str, bytes)) else data.as_string()
+        self.message_id = message_id
+
+
+class SendResult:
+    """Результат отправки одного письма"""
+
+    def __init__(self, message, success, response=None, refused=None, attempts=1):
+        self.message = message
+        self.success = success
+        self.response = response
+        self.refused = refused or {}
+        self.attempts = attempts
+
+    def __repr__(self):
+        status = "OK" if self.success else "FAIL"
+        return f"<SendResult {self.message.message_id} {status} refused={len(self.refused)}>"
+
+
+class BulkSender:
+    """
+    Отправляет поток писем через одно аутентифицированное SMTP соединение.
+
+    Между транзакциями сессия сбрасывается командой RSET вместо повторного
+    подключения. Соседние письма с одинаковым отправителем и текстом объединяются
+    в одну транзакцию с несколькими RCPT TO (не более max_recipients).
+    Соединение переоткрывается после reconnect_every транзакций, а также при
+    временных ошибках (4xx) и обрыве соединения - в этом случае транзакция
+    повторяется до max_retries раз. Письма без получателей или с недопустимым
+    адресом получателя не отправляются и сразу возвращаются с ошибкой.
+    """
+
+    def __init__(self, server, port, username, password, reconnect_every=100,
+                 max_recipients=100, max_retries=2, retry_delay=1.0, client_factory=SMTPClient):
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.reconnect_every = reconnect_every
+        self.max_recipients = max_recipients
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.client_factory = client_factory
+        self.client = None
+        self.transactions = 0
+        self.logger = get_logger("bulk_sender")
+
+    def log_message(self, message, level="ИНФО:"):
+        """Записывает сообщение в общий журнал"""
+        self.logger.log(logging.ERROR if level == "ОШИБКА:" else logging.INFO, message)
+
+    def _connect(self):
+        """Открывает и аутентифицирует новое соединение"""
+        self.close()
+        client = self.client_factory()
+        if not client.connect(self.server, self.port):
+            raise ConnectionError(f"не удалось подключиться к {self.server}:{self.port}")
+        if not client.authenticate(self.username, self.password):
+            client.close()
+            raise PermissionError("ошибка аутентификации SMTP")
+        self.client = client
+        self.transactions = 0
+
+    def _ensure_session(self):
+        """Готовит соединение к новой транзакции: переподключение или RSET"""
+        if self.client is None or self.transactions >= self.reconnect_every:
+            self._connect()
+        elif self.transactions:
+            response = self.client.send_command("RSET")
+            if self.client.reply_code(response) != 250:
+                self._connect()
+
+    @staticmethod
+    def _recipients_error(message):
+        """Возвращает описание ошибки, если письмо нельзя отправить этим получателям, иначе None"""
+        if not message.recipients:
+            return "нет получателей"
+        for recipient in message.recipients:
+            if (not isinstance(recipient, str) or "@" not in recipient
+                    or any(char in recipient for char in " <>\r\n\t")):
+                return f"недопустимый адрес получателя: {recipient!r}"
+        return None
+
+    def _group(self, messages):
+        """
+        Объединяет соседние письма с общим отправителем и текстом в пачки.
+        Письмо с недопустимыми получателями выдается отдельной пачкой.
+        """
+        batch = []
+        batch_recipients = 0
+        for message in messages:
+            if self._recipients_error(message):
+                if batch:
+                    yield batch
+                    batch = []
+                    batch_recipients = 0
+                yield [message]
+                continue
+            if batch and (message.from_addr != batch[0].from_addr or message.data != batch[0].data
+                          or batch_recipients + len(message.recipients) > self.max_recipients):
+                yield batch
+                batch = []
+                batch_recipients = 0
+            batch.append(message)
+            batch_recipients += len(message.recipients)
+        if batch:
+            yield batch
+
+    def _send_batch(self, batch):
+        """Отправляет пачку писем одной транзакцией с повторами при временных ошибках"""
+        error = self._recipients_error(batch[0])
+        if error:
+            self.log_message(f"Письмо {batch[0].message_id} не отправлено: {error}", "ОШИБКА:")
+            return [SendResult(batch[0], False, error, attempts=0)]
+
+        recipients = [recipient for message in batch for recipient in message.recipients]
+        attempts = 0
+        while True:
+            attempts += 1
+            io_error = False
+            try:
+                self._ensure_session()
+                response, refused = self.client.send_mail(batch[0].from_addr, recipients, batch[0].data)
+                self.transactions += 1
+                code = self.client.reply_code(response)
+                # Ответа нет только при обрыве: ошибки ввода-вывода SMTPClient перехватывает сам
+                if response is None:
+                    io_error = True
+                    if self.client.message_sent:
+                        # Текст письма ушел, сервер мог его принять - повтор дал бы дубликат
+                        response = "соединение прервано после передачи письма, доставка не подтверждена"
+                        io_error = False
+                    self._drop()
+            except Exception as e:
+                response, refused, code = str(e), {}, None
+                # Временными считаются только ошибки ввода-вывода (обрыв, таймаут, отказ
+                # в подключении); отказ в аутентификации и прочие ошибки повтор не исправит
+                io_error = isinstance(e, OSError) and not isinstance(e, PermissionError)
+                self._drop()
+
+            # Временная ошибка всей транзакции или обрыв соединения - переподключаемся и повторяем
+            transient = io_error or (code is not None and 400 <= code < 500)
+            if transient and attempts <= self.max_retries:
+                self.log_message(f"Временная ошибка отправки ({response}), повтор {attempts}", "ОШИБКА:")
+                get_metrics().inc("retries_total", operation="bulk_send")
+                self._drop()
+                time.sleep(self.retry_delay)
+                continue
+
+            delivered = code == 250
+            results = []
+            for message in batch:
+                message_refused = {r: refused[r] for r in message.recipients if r in refused}
+                success = delivered and len(message_refused) < len(message.recipients)
+                results.append(SendResult(message, success, response, message_refused, attempts))
+            return results
+
+    def send_all(self, messages):
+        """
+        Отправляет письма из итерируемого messages (OutgoingMessage).
+        Генератор: возвращает SendResult для каждого письма по мере отправки.
+        """
+        sent = 0
+        failed = 0
+        try:
+            for batch in self._group(messages):
+                for result in self._send_batch(batch):
+                    if result.success:
+                        sent += 1
+                    else:
+                        failed += 1
+                    yield result
+        finally:
+            self.log_message(f"Массовая отправка завершена: успешно {sent}, с ошибками {failed}", "ИНФО:")
+
+    def _drop(self):
+        """Закрывает соединение без QUIT (после ошибки сессия считается испорченной)"""
+        if self.client:
+            self.client.close()
+            self.client = None
+
+    def close(self):
+        """Завершает текущую SMTP сессию"""
+        if self.client:
+            try:
+                self.client.send_command("QUIT")
+            finally:
+                self.client.close()
+                self.client = None
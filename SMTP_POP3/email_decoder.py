@@ -1,46 +1,220 @@
-import email
+import threading
+from collections import OrderedDict
 from email.header import decode_header
-from email.parser import Parser
-import quopri
-import base64
-import chardet
+from email.utils import parseaddr
+from common.mime import parse_message
+
+# chardet импортируется только при первой необходимости: импорт медленный,
+# а большинство писем декодируется без него
+_chardet = None
+
+# Кодировка, подобранная для писем отправителя: {домен: кодировка}
+_sender_charsets = OrderedDict()
+_sender_charsets_lock = threading.Lock()
+_SENDER_CHARSETS_LIMIT = 4096
+
+# Декодированные значения заголовков с encoded words: {исходное значение: результат}
+_header_cache = OrderedDict()
+_header_cache_lock = threading.Lock()
+_header_cache_stats = {'hits': 0, 'misses': 0}
+
+
+def _detect_charset(sample):
+    """Определяет кодировку с помощью chardet, если он установлен"""
+    global _chardet
+    if _chardet is None:
+        try:
+            import chardet
+            _chardet = chardet
+        except ImportError:
+            _chardet = False
+    if not _chardet:
+        return None
+    return _chardet.detect(sample)['encoding']
+
+
+def _sender_key(sender):
+    """Ключ запоминания кодировки - домен адреса отправителя"""
+    if not sender:
+        return None
+    address = parseaddr(sender)[1] or sender
+    return address.rpartition('@')[2].strip().lower() or None
+
+
+def _remembered_charset(sender):
+    key = _sender_key(sender)
+    if key is None:
+        return None
+    with _sender_charsets_lock:
+        charset = _sender_charsets.get(key)
+        if charset:
+            _sender_charsets.move_to_end(key)
+        return charset
+
+
+def _remember_charset(sender, charset):
+    key = _sender_key(sender)
+    if key is None:
+        return
+    with _sender_charsets_lock:
+        _sender_charsets[key] = charset
+        _sender_charsets.move_to_end(key)
+        while len(_sender_charsets) > _SENDER_CHARSETS_LIMIT:
+            _sender_charsets.popitem(last=False)
+
+
+def _plausibility(text):
+    """
+    Доля строчных букв среди символов вне ASCII. Обычный текст состоит в основном
+    из строчных букв, а при чтении в чужой однобайтовой кодировке (cp1251 как koi8-r
+    и наоборот) строчные и прописные меняются местами или превращаются в символы.
+    """
+    total = 0
+    lower = 0
+    for char in text:
+        if char > '\x7f':
+            total += 1
+            if char.islower():
+                lower += 1
+    return lower / total if total else 1.0
 
 
 class EmailDecoder:
+    # Кодировки, которые проверяются после UTF-8 до автоматического определения
+    likely_charsets = ('cp1251', 'koi8-r')
+    # Сколько байт передается chardet, если ни одна из кодировок не подошла
+    detect_sample_size = 16 * 1024
+    # Сколько декодированных значений заголовков хранится в кэше
+    header_cache_size = 10000
+
+    @staticmethod
+    def parse_headers(headers_data):
+        """Разбирает блок заголовков в словарь с декодированными значениями"""
+        raw_headers = []
+        current_header = None
+        current_value = []
+
+        for line in headers_data.split('\n'):
+            line = line.rstrip()
+            if not line:
+                continue
+
+            if line[0] in [' ', '\t'] and current_header:
+                current_value.append(line.strip())
+            else:
+                if current_header:
+                    raw_headers.append((current_header, ' '.join(current_value)))
+
+                if ':' in line:
+                    current_header = line.split(':', 1)[0].strip()
+                    current_value = [line.split(':', 1)[1].strip()]
+
+        if current_header:
+            raw_headers.append((current_header, ' '.join(current_value)))
+
+        # Отправитель нужен заранее: по нему запоминается кодировка писем
+        sender = next((value for name, value in raw_headers if name.lower() == 'from'), None)
+        return {name: EmailDecoder.decode_header_value(value, sender) for name, value in raw_headers}
+
+    @staticmethod
+    def decode_bytes(data, charset=None, sender=None):
+        """
+        Переводит байты в строку, подбирая кодировку по возрастанию стоимости:
+        указанная charset, строгий UTF-8, кодировка, ранее подобранная для домена
+        отправителя, кодировки из likely_charsets и лишь затем chardet по первым
+        detect_sample_size байтам. Подобранная кодировка запоминается для sender.
+        """
+        if charset:
+            try:
+                return data.decode(charset)
+            except (UnicodeDecodeError, LookupError):
+                pass
+
+        try:
+            return data.decode('utf-8')
+        except UnicodeDecodeError:
+            pass
+
+        # Однобайтовые кодировки принимают почти любые байты, поэтому кандидат
+        # проверяется не только строгим декодированием, но и правдоподобием текста
+        sample = data[:EmailDecoder.detect_sample_size]
+        remembered = _remembered_charset(sender)
+        best = None
+        best_score = 0.5
+        candidates = [remembered] if remembered else []
+        candidates += [charset for charset in EmailDecoder.likely_charsets if charset != remembered]
+        for candidate in candidates:
+            try:
+                score = _plausibility(sample.decode(candidate))
+            except (UnicodeDecodeError, LookupError):
+                continue
+            if score > best_score:
+                best, best_score = candidate, score
+
+        if best is None:
+            best = _detect_charset(sample)
+        if best:
+            try:
+                text = data.decode(best, errors='replace')
+                _remember_charset(sender, best)
+                return text
+            except LookupError:
+                pass
+        return data.decode('utf-8', errors='replace')
+
     @staticmethod
-    def decode_header_value(header_value):
-        """Декодирует значение заголовка письма из MIME-encoded words формата"""
+    def decode_header_value(header_value, sender=None):
+        """
+        Декодирует значение заголовка письма из MIME-encoded words формата.
+        Значение без '=?' возвращается как есть; результаты для encoded words
+        кэшируются по исходному значению (LRU на header_cache_size записей).
+        """
         if not header_value:
             return ""
+        if '=?' not in header_value:
+            return header_value
+
+        with _header_cache_lock:
+            decoded = _header_cache.get(header_value)
+            if decoded is not None:
+                _header_cache.move_to_end(header_value)
+                _header_cache_stats['hits'] += 1
+                return decoded
+            _header_cache_stats['misses'] += 1
+
+        decoded = EmailDecoder._decode_encoded_words(header_value, sender)
+        with _header_cache_lock:
+            _header_cache[header_value] = decoded
+            while len(_header_cache) > EmailDecoder.header_cache_size:
+                _header_cache.popitem(last=False)
+        return decoded
 
+    @staticmethod
+    def header_cache_stats():
+        """Возвращает счетчики кэша заголовков: попадания, промахи и число записей"""
+        with _header_cache_lock:
+            return dict(_header_cache_stats, size=len(_header_cache))
+
+    @staticmethod
+    def clear_header_cache():
+        with _header_cache_lock:
+            _header_cache.clear()
+            _header_cache_stats['hits'] = 0
+            _header_cache_stats['misses'] = 0
+
+    @staticmethod
+    def _decode_encoded_words(header_value, sender=None):
+        """
+        Декодирует encoded words без кэша. Отправитель влияет на результат, только
+        если у слова нет кодировки или она неверна, поэтому в ключ кэша он не входит.
+        """
         try:
             # Декодируем MIME-encoded words
             decoded_parts = []
             for part, charset in decode_header(header_value):
                 if isinstance(part, bytes):
-                    if charset:
-                        try:
-                            decoded_parts.append(part.decode(charset))
-                        except (UnicodeDecodeError, LookupError):
-                            # Если указанная кодировка не работает, пытаемся определить автоматически
-                            detected = chardet.detect(part)
-                            if detected['encoding']:
-                                try:
-                                    decoded_parts.append(part.decode(detected['encoding']))
-                                except UnicodeDecodeError:
-                                    decoded_parts.append(part.decode('utf-8', errors='replace'))
-                            else:
-                                decoded_parts.append(part.decode('utf-8', errors='replace'))
-                    else:
-                        # Если кодировка не указана, пытаемся определить автоматически
-                        detected = chardet.detect(part)
-                        if detected['encoding']:
-                            try:
-                                decoded_parts.append(part.decode(detected['encoding']))
-                            except UnicodeDecodeError:
-                                decoded_parts.append(part.decode('utf-8', errors='replace'))
-                        else:
-                            decoded_parts.append(part.decode('utf-8', errors='replace'))
+                    # Если кодировка не указана или не подходит, она подбирается
+                    decoded_parts.append(EmailDecoder.decode_bytes(part, charset, sender))
                 else:
                     decoded_parts.append(str(part))
 
@@ -49,51 +223,46 @@ class EmailDecoder:
             print(f"Ошибка при декодировании заголовка: {str(e)}")
             return header_value
 
+    @staticmethod
+    def parse_message(source, close_source=False, truncated=False):
+        """
+        Разбирает структуру письма (common.mime.MimeMessage) с подбором кодировок
+        EmailDecoder. source - байты, путь к файлу или файловый объект в бинарном
+        режиме (закрывается вместе с сообщением при close_source=True).
+        Тела частей декодируются при обращении. truncated=True - письмо получено
+        не целиком (TOP): оборванные части и последний символ текста допускаются.
+        """
+        return parse_message(source, EmailDecoder.decode_bytes, EmailDecoder.decode_header_value,
+                             close_source, truncated)
+
+    @staticmethod
+    def body_text(message):
+        """Текст письма для показа: первая часть text/plain, иначе text/html"""
+        part = message.text_part or message.html_part
+        return part.text() if part else ""
+
     @staticmethod
     def decode_message_content(message_data):
         """Декодирует содержимое письма"""
         try:
-            # Парсим сообщение
-            parser = Parser()
-            email_message = parser.parsestr(message_data)
-
-            # Получаем тело письма
-            if email_message.is_multipart():
-                # Для многочастных сообщений берем первую текстовую часть
-                for part in email_message.walk():
-                    if part.get_content_type() == "text/plain":
-                        content = part.get_payload(decode=True)
-                        charset = part.get_content_charset()
-                        if charset:
-                            try:
-                                return content.decode(charset)
-                            except UnicodeDecodeError:
-                                detected = chardet.detect(content)
-                                if detected['encoding']:
-                                    return content.decode(detected['encoding'], errors='replace')
-                                return content.decode('utf-8', errors='replace')
-                        else:
-                            detected = chardet.detect(content)
-                            if detected['encoding']:
-                                return content.decode(detected['encoding'], errors='replace')
-                            return content.decode('utf-8', errors='replace')
-            else:
-                # Для простых сообщений
-                content = email_message.get_payload(decode=True)
-                charset = email_message.get_content_charset()
-                if charset:
-                    try:
-                        return content.decode(charset)
-                    except UnicodeDecodeError:
-                        detected = chardet.detect(content)
-                        if detected['encoding']:
-                            return content.decode(detected['encoding'], errors='replace')
-                        return content.decode('utf-8', errors='replace')
-                else:
-                    detected = chardet.detect(content)
-                    if detected['encoding']:
-                        return content.decode(detected['encoding'], errors='replace')
-                    return content.decode('utf-8', errors='replace')
+            if isinstance(message_data, str):
+                message_data = message_data.encode('utf-8', errors='replace')
+            with EmailDecoder.parse_message(message_data) as message:
+                return EmailDecoder.body_text(message)
+
+        except Exception as e:
+            print(f"Ошибка при декодировании содержимого: {str(e)}")
+            return "Ошибка при декодировании содержимого письма"
+
+    @staticmethod
+    def decode_message_stream(stream):
+        """
+        Декодирует письмо из файла (путь) или файлового объекта, открытого в бинарном
+        режиме. Разбирается только структура, вложения не декодируются и не читаются в память.
+        """
+        try:
+            with EmailDecoder.parse_message(stream) as message:
+                return EmailDecoder.body_text(message)
 
         except Exception as e:
             print(f"Ошибка при декодировании содержимого: {str(e)}")
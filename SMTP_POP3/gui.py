@@ -1,6 +1,10 @@
 import tkinter as tk
 from tkinter import ttk, messagebox, scrolledtext
 from SMTP_POP3.main import EmailClient
+from SMTP_POP3.message_cache import MessageCache
+from SMTP_POP3.search_index import SearchIndex
+from SMTP_POP3.gui_worker import BackgroundWorker
+from SMTP_POP3.virtual_list import VirtualMessageList
 import re
 
 
@@ -10,7 +14,18 @@ class EmailClientGUI:
         self.root.title("Почтовый клиент")
         self.root.geometry("800x600")
 
-        self.email_client = EmailClient()
+        self.email_client = EmailClient(cache=MessageCache(), search_index=SearchIndex())
+
+        # Сетевые операции выполняются в фоне, чтобы окно не зависало
+        self.worker = BackgroundWorker(self.root)
+        self.refresh_task = None
+        self.select_task = None
+        self.index_task = None
+        self.sync_task = None
+        self.displayed_msg = None
+        # Проверка новой почты по STAT/UIDL раз в sync_interval миллисекунд
+        self.sync_interval = 60000
+        self.search_active = False
 
         # Создаем notebook для вкладок
         self.notebook = ttk.Notebook(self.root)
@@ -29,6 +44,8 @@ class EmailClientGUI:
         self._setup_send_tab()
         self._setup_receive_tab()
 
+        self.root.after(self.sync_interval, self._periodic_sync)
+
     def _setup_config_tab(self):
         # SMTP настройки
         smtp_frame = ttk.LabelFrame(self.setup_tab, text='Настройки SMTP')
@@ -114,11 +131,37 @@ class EmailClientGUI:
                    command=self._refresh_messages).pack(side='left', padx=5)
         ttk.Button(control_frame, text='Удалить выбранное',
                    command=self._delete_selected).pack(side='left', padx=5)
-
-        # Список писем с расширенными колонками
-        self.messages_tree = ttk.Treeview(self.receive_tab,
-                                          columns=('number', 'subject', 'from', 'date', 'size'),
-                                          show='headings')
+        ttk.Button(control_frame, text='Отмена',
+                   command=self._cancel_refresh).pack(side='left', padx=5)
+
+        # Индикатор фоновых операций
+        self.status_label = ttk.Label(control_frame, text='')
+        self.status_label.pack(side='right', padx=5)
+        self.progress = ttk.Progressbar(control_frame, mode='indeterminate', length=120)
+        self.progress.pack(side='right', padx=5)
+
+        # Поиск по локальному индексу: from:, subject:, after:ГГГГ-ММ-ДД, before:ГГГГ-ММ-ДД и слова текста
+        search_frame = ttk.Frame(self.receive_tab)
+        search_frame.pack(fill='x', padx=5, pady=(0, 5))
+
+        ttk.Label(search_frame, text='Поиск:').pack(side='left', padx=5)
+        self.search_entry = ttk.Entry(search_frame)
+        self.search_entry.pack(side='left', fill='x', expand=True, padx=5)
+        self.search_entry.bind('<Return>', lambda e: self._search_messages())
+        ttk.Button(search_frame, text='Найти',
+                   command=self._search_messages).pack(side='left', padx=5)
+        ttk.Button(search_frame, text='Сбросить',
+                   command=self._reset_search).pack(side='left', padx=5)
+        ttk.Button(search_frame, text='Индексировать',
+                   command=self._index_messages).pack(side='left', padx=5)
+
+        # Список писем с расширенными колонками; в Treeview находятся только видимые строки,
+        # заголовки остальных писем подгружаются при прокрутке
+        self.message_list = VirtualMessageList(self.receive_tab,
+                                               columns=('number', 'subject', 'from', 'date', 'size'),
+                                               format_row=self._format_row,
+                                               on_need_headers=self._load_headers)
+        self.messages_tree = self.message_list.tree
 
         # Настройка заголовков колонок
         self.messages_tree.heading('number', text='№')
@@ -134,15 +177,10 @@ class EmailClientGUI:
         self.messages_tree.column('date', width=150)
         self.messages_tree.column('size', width=100)
 
-        # Добавляем скроллбар
-        scrollbar = ttk.Scrollbar(self.receive_tab, orient="vertical", command=self.messages_tree.yview)
-        self.messages_tree.configure(yscrollcommand=scrollbar.set)
-
         # Размещаем список и скроллбар
-        self.messages_tree.pack(side='left', fill='both', expand=True, padx=(5, 0), pady=5)
-        scrollbar.pack(side='right', fill='y', padx=(0, 5), pady=5)
+        self.message_list.pack()
 
-        self.messages_tree.bind('<<TreeviewSelect>>', self._on_select_message)
+        self.messages_tree.bind('<<TreeviewSelect>>', self._on_select_message, add='+')
 
         # Фрейм для просмотра письма
         message_frame = ttk.LabelFrame(self.receive_tab, text='Содержимое письма')
@@ -162,10 +200,36 @@ class EmailClientGUI:
         for i, (key, label) in enumerate(self.message_headers.items()):
             label.grid(row=i, column=0, sticky='w', padx=5, pady=2)
 
+        # Для крупного письма показывается начало текста; целиком оно загружается по кнопке
+        self.full_message_button = ttk.Button(headers_frame, text='Открыть полностью',
+                                              command=self._open_full_message, state='disabled')
+        self.full_message_button.grid(row=0, column=1, sticky='e', padx=5, pady=2)
+        headers_frame.columnconfigure(1, weight=1)
+
         # Просмотр содержимого письма
         self.message_view = scrolledtext.ScrolledText(message_frame, height=10)
         self.message_view.pack(fill='both', expand=True, padx=5, pady=5)
 
+    def _run_in_background(self, func, on_done, status):
+        """Запускает func(task) в фоновом потоке, показывая индикатор занятости"""
+        def finish(result):
+            self._update_busy()
+            on_done(result)
+
+        def fail(error):
+            self._update_busy()
+            messagebox.showerror("Ошибка", f"Ошибка: {str(error)}")
+
+        task = self.worker.submit(func, finish, fail)
+        self.status_label.configure(text=status)
+        self.progress.start(10)
+        return task
+
+    def _update_busy(self):
+        if self.worker.pending == 0:
+            self.progress.stop()
+            self.status_label.configure(text='')
+
     def _connect_smtp(self):
         try:
             server = self.smtp_server.get()
@@ -173,13 +237,19 @@ class EmailClientGUI:
             username = self.smtp_username.get()
             password = self.smtp_password.get()
             use_tls = self.use_smtp_tls.get()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Ошибка подключения: {str(e)}")
+            return
 
-            if self.email_client.setup_smtp(server, port, username, password, use_tls):
+        def on_done(success):
+            if success:
                 messagebox.showinfo("Успех", "SMTP подключение установлено")
             else:
                 messagebox.showerror("Ошибка", "Не удалось подключиться к SMTP серверу")
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка подключения: {str(e)}")
+
+        self._run_in_background(
+            lambda task: self.email_client.setup_smtp(server, port, username, password, use_tls),
+            on_done, "Подключение к SMTP...")
 
     def _connect_pop3(self):
         try:
@@ -188,14 +258,20 @@ class EmailClientGUI:
             username = self.pop3_username.get()
             password = self.pop3_password.get()
             use_ssl = self.use_pop3_ssl.get()
+        except Exception as e:
+            messagebox.showerror("Ошибка", f"Ошибка подключения: {str(e)}")
+            return
 
-            if self.email_client.setup_pop3(server, port, username, password, use_ssl):
+        def on_done(success):
+            if success:
                 messagebox.showinfo("Успех", "POP3 подключение установлено")
                 self._refresh_messages()
             else:
                 messagebox.showerror("Ошибка", "Не удалось подключиться к POP3 серверу")
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Ошибка подключения: {str(e)}")
+
+        self._run_in_background(
+            lambda task: self.email_client.setup_pop3(server, port, username, password, use_ssl),
+            on_done, "Подключение к POP3...")
 
     def _send_email(self):
         if not self.email_client.smtp_authenticated:
@@ -213,103 +289,274 @@ class EmailClientGUI:
             messagebox.showerror("Ошибка", "Неверный формат email адреса")
             return
 
-        if self.email_client.send_email(from_addr, to_addr, subject, message):
-            messagebox.showinfo("Успех", "Письмо отправлено")
-            # Очищаем поля
-            self.subject_entry.delete(0, tk.END)
-            self.message_text.delete('1.0', tk.END)
-        else:
-            messagebox.showerror("Ошибка", "Не удалось отправить письмо")
+        def on_done(success):
+            if success:
+                messagebox.showinfo("Успех", "Письмо отправлено")
+                # Очищаем поля
+                self.subject_entry.delete(0, tk.END)
+                self.message_text.delete('1.0', tk.END)
+            else:
+                messagebox.showerror("Ошибка", "Не удалось отправить письмо")
+
+        self._run_in_background(
+            lambda task: self.email_client.send_email(from_addr, to_addr, subject, message),
+            on_done, "Отправка письма...")
 
     def _refresh_messages(self):
         if not self.email_client.pop3_authenticated:
             messagebox.showerror("Ошибка", "Сначала настройте POP3 подключение")
             return
 
-        # Очищаем список
-        for item in self.messages_tree.get_children():
-            self.messages_tree.delete(item)
-
-        try:
-            # Получаем список писем
-            messages = self.email_client.list_messages()
-
-            if messages:
-                for msg_num, msg_size, headers in messages:
-                    try:
-                        # Обработка заголовков с учетом возможного отсутствия данных
-                        subject = headers.get('Subject', '(Без темы)')
-                        from_addr = headers.get('From', '(Неизвестный отправитель)')
-                        date = headers.get('Date', '(Дата неизвестна)')
-
-                        # Форматируем размер для читаемости
-                        if msg_size > 1024 * 1024:
-                            size_str = f"{msg_size / (1024 * 1024):.1f} MB"
-                        elif msg_size > 1024:
-                            size_str = f"{msg_size / 1024:.1f} KB"
-                        else:
-                            size_str = f"{msg_size} B"
-
-                        # Вставляем данные в дерево
-                        self.messages_tree.insert('', 'end',
-                                                  values=(msg_num, subject, from_addr, date, size_str))
-                    except Exception as e:
-                        print(f"Ошибка при обработке сообщения {msg_num}: {str(e)}")
-                        continue
-            else:
+        # Предыдущее обновление больше не нужно
+        self._cancel_refresh()
+        self.search_active = False
+
+        def fetch(task):
+            # Получаем только номера и размеры; заголовки загружаются для видимых строк
+            return self.email_client.get_message_sizes()
+
+        def on_done(sizes):
+            if task.cancelled:
+                return
+            self.refresh_task = None
+            if sizes is None:
+                messagebox.showerror("Ошибка", "Не удалось получить список писем")
+                return
+            self.displayed_msg = None
+            self.message_list.set_messages(sizes)
+            if not sizes:
                 print("Список сообщений пуст")
                 messagebox.showinfo("Информация", "Нет доступных сообщений")
 
-        except Exception as e:
-            print(f"Ошибка при получении списка писем: {str(e)}")
-            messagebox.showerror("Ошибка", f"Не удалось получить список писем: {str(e)}")
+        task = self._run_in_background(fetch, on_done, "Загрузка списка писем...")
+        self.refresh_task = task
+
+    def _cancel_refresh(self):
+        if self.refresh_task:
+            self.refresh_task.cancel()
+            self.refresh_task = None
+        if self.index_task:
+            self.index_task.cancel()
+            self.index_task = None
+        if self.sync_task:
+            self.sync_task.cancel()
+            self.sync_task = None
+
+    def _search_messages(self):
+        """Показывает в списке письма, найденные в локальном индексе"""
+        query = self.search_entry.get().strip()
+        if not query:
+            self._reset_search()
+            return
+
+        # Запрос к индексу занимает миллисекунды, поэтому выполняется без фонового потока
+        results = self.email_client.search_messages(query)
+        found = [(msg_num, size, headers) for msg_num, size, headers in results if msg_num is not None]
+        self.search_active = True
+        self.displayed_msg = None
+        self.message_list.set_messages([(msg_num, size) for msg_num, size, _ in found],
+                                       {msg_num: headers for msg_num, _, headers in found})
+        self.status_label.configure(text=f'Найдено: {len(found)}')
+
+    def _reset_search(self):
+        """Возвращает полный список писем из последнего ответа на LIST"""
+        self.search_entry.delete(0, tk.END)
+        self.search_active = False
+        self.displayed_msg = None
+        self.message_list.set_messages(sorted(self.email_client.message_sizes.items()))
+        self._update_busy()
+
+    def _index_messages(self):
+        if not self.email_client.pop3_authenticated:
+            messagebox.showerror("Ошибка", "Сначала настройте POP3 подключение")
+            return
+        if self.index_task:
+            return
+
+        def on_done(count):
+            self.index_task = None
+            if count is None:
+                messagebox.showerror("Ошибка", "Не удалось проиндексировать письма")
+            elif not task.cancelled:
+                messagebox.showinfo("Информация", f"Проиндексировано писем: {count}")
+
+        task = self._run_in_background(
+            lambda task: self.email_client.index_messages(cancel_event=task.cancel_event),
+            on_done, "Индексация писем...")
+        self.index_task = task
+
+    def _periodic_sync(self):
+        """
+        Проверяет новую почту, если пользователь не занят другой операцией.
+        Изменения применяются к списку без повторной загрузки заголовков.
+        """
+        self.root.after(self.sync_interval, self._periodic_sync)
+        if (not self.email_client.pop3_authenticated or self.worker.pending or self.search_active
+                or not self.message_list.rows):
+            return
+
+        def on_done(result):
+            self.sync_task = None
+            if task.cancelled or result is None or not result.changed or self.search_active:
+                return
+            if self.displayed_msg is not None:
+                if self.displayed_msg in result.removed:
+                    self.displayed_msg = None
+                else:
+                    self.displayed_msg = result.renumbered.get(self.displayed_msg, self.displayed_msg)
+            self.message_list.apply_changes(result.removed, result.renumbered, result.added)
+            if result.added:
+                self.status_label.configure(text=f'Новых писем: {len(result.added)}')
+
+        # Новые письма видны только в новой сессии: текущая видит ящик на момент входа
+        task = self.worker.submit(lambda task: self.email_client.sync_messages(reopen_session=True), on_done)
+        self.sync_task = task
+
+    def _load_headers(self, msg_numbers):
+        """Подгружает заголовки писем, попавших в видимое окно списка"""
+        def fetch(task):
+            # Пока задача ждала очереди, список могли прокрутить дальше
+            wanted = [msg_num for msg_num in msg_numbers if self.message_list.is_wanted(msg_num)]
+            if not wanted:
+                return {}
+            return self.email_client.fetch_headers(wanted) or {}
+
+        def on_done(headers):
+            self.message_list.release_requests([num for num in msg_numbers if num not in headers])
+            self.message_list.set_headers(headers)
+
+        self._run_in_background(fetch, on_done, "Загрузка заголовков...")
+
+    @staticmethod
+    def _format_row(msg_num, msg_size, headers):
+        """Формирует значения колонок строки списка писем"""
+        if headers is None:
+            subject = from_addr = date = '...'
+        else:
+            # Обработка заголовков с учетом возможного отсутствия данных
+            subject = headers.get('Subject', '(Без темы)')
+            from_addr = headers.get('From', '(Неизвестный отправитель)')
+            date = headers.get('Date', '(Дата неизвестна)')
+
+        # Форматируем размер для читаемости
+        if msg_size > 1024 * 1024:
+            size_str = f"{msg_size / (1024 * 1024):.1f} MB"
+        elif msg_size > 1024:
+            size_str = f"{msg_size / 1024:.1f} KB"
+        else:
+            size_str = f"{msg_size} B"
+
+        return msg_num, subject, from_addr, date, size_str
 
     def _on_select_message(self, event):
         selection = self.messages_tree.selection()
-        if not selection:
+        # При выделении нескольких писем (для удаления) содержимое не загружается
+        if len(selection) != 1:
             return
 
-        item = self.messages_tree.item(selection[0])
-        msg_num = item['values'][0]
+        msg_num = int(selection[0])
 
-        try:
-            # Очищаем просмотрщик
+        # Список перерисовывается при прокрутке и восстанавливает выделение - письмо уже показано
+        if msg_num == self.displayed_msg or not self.email_client.pop3_authenticated:
+            return
+        self.displayed_msg = msg_num
+
+        # Письмо, выбранное раньше, но еще не загруженное, больше не нужно
+        if self.select_task:
+            self.select_task.cancel()
+
+        # Очищаем просмотрщик
+        self.message_view.delete('1.0', tk.END)
+        self.message_view.insert('1.0', 'Загрузка...')
+        self.full_message_button.configure(state='disabled')
+
+        def fetch(task):
+            if task.cancelled:
+                return None
+            # Заголовки и текст приходят одной командой: RETR или, для крупного письма, TOP
+            return self.email_client.preview_message(msg_num)
+
+        def on_done(result):
+            if task.cancelled:
+                return
+            self.select_task = None
+            if result is None:
+                self.message_view.delete('1.0', tk.END)
+                self.message_view.insert('1.0', 'Не удалось загрузить содержимое письма')
+                return
+            headers, content, truncated = result
+
+            # Обновляем заголовки
+            for key, label in self.message_headers.items():
+                value = headers.get(key, '')
+                label.configure(text=f'{key}: {value}')
+
+            # Отображаем содержимое
+            self.message_view.delete('1.0', tk.END)
+            self.message_view.insert('1.0', content or '')
+            if truncated:
+                self.message_view.insert(tk.END, '\n\n[Показано начало письма. '
+                                                 'Нажмите «Открыть полностью», чтобы загрузить его целиком]')
+                self.full_message_button.configure(state='normal')
+
+        task = self._run_in_background(fetch, on_done, "Загрузка письма...")
+        self.select_task = task
+
+    def _open_full_message(self):
+        """Загружает показанное письмо целиком командой RETR и заменяет им начало текста"""
+        msg_num = self.displayed_msg
+        if msg_num is None:
+            return
+        self.full_message_button.configure(state='disabled')
+
+        def fetch(task):
+            if task.cancelled:
+                return None
+            return self.email_client.read_message(msg_num)
+
+        def on_done(content):
+            if task.cancelled or msg_num != self.displayed_msg:
+                return
+            self.select_task = None
+            if content is None:
+                self.full_message_button.configure(state='normal')
+                messagebox.showerror("Ошибка", "Не удалось загрузить письмо")
+                return
             self.message_view.delete('1.0', tk.END)
+            self.message_view.insert('1.0', content)
 
-            # Получаем и отображаем содержимое письма
-            if self.email_client.pop3_authenticated:
-                # Получаем заголовки и содержимое письма
-                headers = self.email_client.get_message_headers(msg_num)
-                content = self.email_client.read_message(msg_num)
-
-                # Обновляем заголовки
-                if headers:
-                    for key, label in self.message_headers.items():
-                        value = headers.get(key, '')
-                        label.configure(text=f'{key}: {value}')
-
-                # Отображаем содержимое
-                if content:
-                    self.message_view.insert('1.0', content)
-                else:
-                    self.message_view.insert('1.0', 'Не удалось загрузить содержимое письма')
-        except Exception as e:
-            messagebox.showerror("Ошибка", f"Не удалось загрузить письмо: {str(e)}")
+        task = self._run_in_background(fetch, on_done, "Загрузка письма...")
+        self.select_task = task
 
     def _delete_selected(self):
-        selection = self.messages_tree.selection()
-        if not selection:
+        # Выделенными могут быть и письма за пределами видимого окна списка
+        msg_numbers = self.message_list.selected_numbers()
+        if not msg_numbers:
             messagebox.showwarning("Предупреждение", "Выберите письмо для удаления")
             return
 
-        if messagebox.askyesno("Подтверждение", "Удалить выбранное письмо?"):
-            item = self.messages_tree.item(selection[0])
-            msg_num = item['values'][0]
+        if len(msg_numbers) == 1:
+            question = f"Удалить письмо #{msg_numbers[0]}?"
+        else:
+            question = f"Удалить выбранные письма ({len(msg_numbers)})?"
+        if not messagebox.askyesno("Подтверждение", question):
+            return
 
-            if self.email_client.pop3_authenticated:
-                self.email_client.delete_message(msg_num)
-                self.messages_tree.delete(selection[0])
-                messagebox.showinfo("Успех", f"Письмо #{msg_num} удалено")
+        if self.email_client.pop3_authenticated:
+            def on_done(result):
+                if result is None:
+                    messagebox.showerror("Ошибка", "Не удалось удалить письма; пометки на удаление сняты")
+                    return
+                if self.displayed_msg in result.removed:
+                    self.displayed_msg = None
+                elif self.displayed_msg is not None:
+                    self.displayed_msg = result.renumbered.get(self.displayed_msg, self.displayed_msg)
+                self.message_list.apply_changes(result.removed, result.renumbered, result.added)
+                messagebox.showinfo("Успех", f"Удалено писем: {len(result.removed)}")
+
+            # Все письма помечаются конвейерными DELE и удаляются одним QUIT
+            self._run_in_background(lambda task: self.email_client.delete_messages(msg_numbers),
+                                    on_done, "Удаление писем...")
 
     def run(self):
         self.root.mainloop()
@@ -0,0 +1,82 @@
+import queue
+import threading
+
+
+class BackgroundTask:
+    """Задача фонового потока; cancel() просит задачу завершиться досрочно"""
+
+    def __init__(self, func, on_done=None, on_error=None):
+        self.func = func
+        self.on_done = on_done
+        self.on_error = on_error
+        self.cancel_event = threading.Event()
+
+    def cancel(self):
+        self.cancel_event.set()
+
+    @property
+    def cancelled(self):
+        return self.cancel_event.is_set()
+
+
+class BackgroundWorker:
+    """
+    Выполняет сетевые операции в отдельном потоке, не блокируя главный цикл Tk.
+
+    Задачи выполняются по одной в порядке поступления (соединения POP3/SMTP не
+    рассчитаны на одновременное использование из нескольких потоков). Результаты
+    и промежуточные события передаются в поток Tk через очередь, которую
+    периодически разбирает root.after.
+    """
+
+    def __init__(self, root, poll_interval=50):
+        self.root = root
+        self.poll_interval = poll_interval
+        self.pending = 0
+        self._tasks = queue.Queue()
+        self._callbacks = queue.Queue()
+        self._thread = threading.Thread(target=self._run, daemon=True)
+        self._thread.start()
+        self.root.after(self.poll_interval, self._poll)
+
+    def submit(self, func, on_done=None, on_error=None):
+        """
+        Ставит func(task) в очередь фонового потока. По завершении в потоке Tk
+        вызывается on_done(результат) или on_error(исключение).
+        """
+        task = BackgroundTask(func, on_done, on_error)
+        self.pending += 1
+        self._tasks.put(task)
+        return task
+
+    def post(self, callback, *args):
+        """Передает вызов callback(*args) в поток Tk (можно вызывать из фонового потока)"""
+        self._callbacks.put((callback, args))
+
+    def _run(self):
+        while True:
+            task = self._tasks.get()
+            try:
+                result = task.func(task)
+            except Exception as e:
+                self.post(self._finish, task.on_error, e)
+            else:
+                self.post(self._finish, task.on_done, result)
+
+    def _finish(self, callback, value):
+        self.pending -= 1
+        if callback:
+            callback(value)
+
+    def _poll(self):
+        # Разбираем все накопившиеся события за один проход, чтобы не отставать от потока
+        try:
+            while True:
+                callback, args = self._callbacks.get_nowait()
+                try:
+                    callback(*args)
+                except Exception as e:
+                    print(f"Ошибка обработки результата фоновой задачи: {str(e)}")
+        except queue.Empty:
+            pass
+        self.root.after(self.poll_interval, self._poll)
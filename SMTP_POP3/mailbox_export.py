@@ -0,0 +1,395 @@
+import hashlib
+import logging
+import os
+import socket
+import tempfile
+import threading
+import time
+from collections import deque
+from email.utils import parseaddr
+from POP3.main import POP3Client
+from common.log import get_logger
+from common.metrics import get_metrics
+
+
+class ExportStats:
+    """Итоги экспорта ящика"""
+
+    def __init__(self):
+        self.total = 0
+        self.exported = 0
+        self.skipped = 0
+        self.failed = 0
+        self.bytes = 0
+        self.sessions = 0
+        self.elapsed = 0.0
+
+    def as_dict(self):
+        return {
+            'total': self.total,
+            'exported': self.exported,
+            'skipped': self.skipped,
+            'failed': self.failed,
+            'bytes': self.bytes,
+            'sessions': self.sessions,
+            'elapsed': round(self.elapsed, 3),
+            'bytes_per_sec': round(self.bytes / self.elapsed, 1) if self.elapsed else 0.0,
+        }
+
+
+class _Checkpoint:
+    """
+    Журнал уже выгруженных писем: по строке "UIDL<TAB>положение" на письмо.
+    Для mbox положение - смещение конца письма в файле архива, для Maildir -
+    имя файла письма. Строка дописывается только после записи письма в архив,
+    поэтому при повторном запуске журнал не опережает архив.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.start_offset = None
+        if os.path.exists(path):
+            with open(path, encoding='utf-8') as f:
+                for line in f:
+                    key, _, value = line.rstrip('\n').partition('\t')
+                    if key == '#start':
+                        self.start_offset = int(value)
+                    elif key:
+                        self.entries[key] = value
+        self._file = open(path, 'a', encoding='utf-8')
+
+    def add(self, uidl, value):
+        self._file.write(f"{uidl}\t{value}\n")
+        self._file.flush()
+
+    def mark_start(self, offset):
+        self.start_offset = offset
+        self.add('#start', offset)
+
+    def sync(self):
+        self._file.flush()
+        os.fsync(self._file.fileno())
+
+    def close(self):
+        self._file.close()
+
+
+class MailboxExporter:
+    """
+    Выгружает все письма POP3 ящика в архив формата mbox или Maildir.
+
+    Письма принимаются потоком (через временный файл, крупные - на диске) и
+    сразу дописываются в архив. Выгруженные письма отмечаются по UIDL в журнале
+    (по умолчанию - рядом с архивом, с суффиксом .state), поэтому прерванный
+    экспорт при повторном запуске продолжается с места остановки. Обрыв
+    соединения во время работы приводит к переподключению с нарастающей паузой,
+    не более max_retries раз подряд.
+
+    При connections > 1 письма загружаются несколькими сессиями параллельно.
+    Многие серверы блокируют ящик на время сессии; если дополнительную сессию
+    открыть не удалось, экспорт продолжается оставшимися.
+    """
+
+    FORMATS = ('mbox', 'maildir')
+
+    def __init__(self, server, port, username, password, target, fmt='mbox', use_ssl=True,
+                 connections=1, checkpoint_path=None, max_retries=5, retry_delay=1.0,
+                 sync_every=100, client_factory=POP3Client):
+        if fmt not in self.FORMATS:
+            raise ValueError(f"Неизвестный формат архива: {fmt}")
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.target = target
+        self.format = fmt
+        self.connections = max(1, connections)
+        self.checkpoint_path = checkpoint_path or f"{target.rstrip(os.sep)}.state"
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        # Архив и журнал сбрасываются на диск (fsync) после каждых sync_every писем
+        self.sync_every = max(1, sync_every)
+        self.client_factory = client_factory
+        self.stats = ExportStats()
+        self.logger = get_logger("mailbox_export")
+        self.metrics = get_metrics()
+        self._lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._queue = deque()
+        self._checkpoint = None
+        self._mbox = None
+        self._unsynced = 0
+        self._hostname = socket.gethostname().replace('/', '_').replace(':', '_') or "localhost"
+
+    def log_message(self, message, level="ИНФО:"):
+        """Записывает сообщение в общий журнал"""
+        self.logger.log(logging.ERROR if level == "ОШИБКА:" else logging.INFO, message)
+
+    def stop(self):
+        """Просит экспорт остановиться после текущих писем; прогресс сохраняется в журнале"""
+        self._stop_event.set()
+
+    def _open_session(self):
+        """Открывает и аутентифицирует новую POP3 сессию"""
+        client = self.client_factory(self.server, self.port, self.use_ssl)
+        if not client.connect():
+            raise ConnectionError(f"не удалось подключиться к {self.server}:{self.port}")
+        for command in (f"USER {self.username}", f"PASS {self.password}"):
+            response = client.send_command(command)
+            if not response or "+OK" not in response:
+                client.close()
+                raise PermissionError("ошибка аутентификации POP3")
+        return client
+
+    def _open_archive(self):
+        """Готовит архив и журнал; возвращает множество уже выгруженных UIDL"""
+        self._checkpoint = _Checkpoint(self.checkpoint_path)
+        entries = self._checkpoint.entries
+
+        if self.format == 'maildir':
+            for sub in ('tmp', 'new', 'cur'):
+                os.makedirs(os.path.join(self.target, sub), exist_ok=True)
+            # Письмо, перенесенное почтовой программой в cur/, получает суффикс ":2,флаги"
+            present = set(os.listdir(os.path.join(self.target, 'new')))
+            present.update(name.split(':', 1)[0] for name in os.listdir(os.path.join(self.target, 'cur')))
+            return {uidl for uidl, name in entries.items() if name in present}
+
+        self._mbox = open(self.target, 'ab')
+        size = self._mbox.seek(0, os.SEEK_END)
+        if self._checkpoint.start_offset is None:
+            self._checkpoint.mark_start(size)
+            return set()
+
+        # Записи, указывающие за конец файла, остались от сбоя до fsync архива
+        done = {uidl for uidl, offset in entries.items() if int(offset) <= size}
+        end = max([self._checkpoint.start_offset] + [int(entries[uidl]) for uidl in done])
+        if end < size:
+            # Хвост после последней отмеченной записи - письмо, прерванное на середине
+            self.log_message(f"Отбрасывается незавершенная запись в конце архива ({size - end} байт)")
+            self._mbox.truncate(end)
+        return done
+
+    def _close_archive(self):
+        if self._mbox:
+            self._sync()
+            self._mbox.close()
+            self._mbox = None
+        if self._checkpoint:
+            self._checkpoint.sync()
+            self._checkpoint.close()
+            self._checkpoint = None
+
+    def _sync(self):
+        if self._mbox:
+            self._mbox.flush()
+            os.fsync(self._mbox.fileno())
+        self._checkpoint.sync()
+        self._unsynced = 0
+
+    def _mark_done(self, uidl, position, size):
+        """Отмечает письмо в журнале; вызывается под self._lock"""
+        self._checkpoint.add(uidl, position)
+        self.stats.exported += 1
+        self.stats.bytes += size
+        self._unsynced += 1
+        if self._unsynced >= self.sync_every:
+            self._sync()
+
+    @staticmethod
+    def _envelope_sender(spool):
+        """Адрес для строки "From " в mbox: из Return-Path или From"""
+        sender = None
+        while True:
+            line = spool.readline()
+            if not line or line in (b"\r\n", b"\n"):
+                break
+            name, _, value = line.partition(b":")
+            name = name.strip().lower()
+            if name == b"return-path" or (name == b"from" and sender is None):
+                address = parseaddr(value.decode('ascii', errors='replace'))[1]
+                if address:
+                    sender = address
+                    if name == b"return-path":
+                        break
+        spool.seek(0)
+        return sender or "MAILER-DAEMON"
+
+    def _append_mbox(self, uidl, spool, size):
+        """
+        Дописывает письмо в mbox (вариант mboxrd): строка "From ", переводы строк LF,
+        строки вида ">*From " экранируются еще одним '>'.
+        """
+        header = f"From {self._envelope_sender(spool)} {time.asctime(time.gmtime())}\n".encode('ascii', errors='replace')
+        with self._lock:
+            mbox = self._mbox
+            mbox.write(header)
+            line_start = True
+            last = b"\n"
+            while True:
+                line = spool.readline(65536)
+                if not line:
+                    break
+                if line_start and line.lstrip(b">").startswith(b"From "):
+                    mbox.write(b">")
+                line_start = line.endswith(b"\n")
+                if line.endswith(b"\r\n"):
+                    line = line[:-2] + b"\n"
+                mbox.write(line)
+                last = line
+            # Письмо отделяется от следующего пустой строкой
+            mbox.write(b"\n\n" if not last.endswith(b"\n") else b"\n")
+            mbox.flush()
+            self._mark_done(uidl, mbox.tell(), size)
+
+    def _maildir_name(self, uidl):
+        # Имя выводится из UIDL, поэтому повторная выгрузка письма заменяет файл, а не дублирует его
+        return f"{hashlib.sha1(uidl.encode('utf-8')).hexdigest()[:20]}.{self._hostname}"
+
+    def _export_maildir(self, client, msg_number, uidl):
+        """Принимает письмо в tmp/ и переносит в new/, как требует формат Maildir"""
+        name = self._maildir_name(uidl)
+        tmp_path = os.path.join(self.target, 'tmp', name)
+        try:
+            with open(tmp_path, 'wb') as f:
+                size = client.retrieve_to(msg_number, f)
+                if size is None:
+                    return False
+                f.flush()
+                os.fsync(f.fileno())
+            os.replace(tmp_path, os.path.join(self.target, 'new', name))
+        finally:
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+        with self._lock:
+            self._mark_done(uidl, name, size)
+        return True
+
+    def _export_mbox(self, client, msg_number, uidl):
+        with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+            size = client.retrieve_to(msg_number, spool)
+            if size is None:
+                return False
+            spool.seek(0)
+            self._append_mbox(uidl, spool, size)
+        return True
+
+    def _next_uidl(self):
+        with self._lock:
+            return self._queue.popleft() if self._queue else None
+
+    def _worker(self, client):
+        """
+        Забирает UIDL из общей очереди и выгружает письма через свою сессию.
+        Номера писем у каждой сессии свои, поэтому они берутся из ее ответа на UIDL.
+        """
+        export = self._export_mbox if self.format == 'mbox' else self._export_maildir
+        failures = 0
+        numbers = None
+        uidl = None
+        try:
+            while not self._stop_event.is_set():
+                try:
+                    if client is None:
+                        client = self._open_session()
+                        numbers = None
+                    if numbers is None:
+                        uidl_map = client.get_uidl_map()
+                        if uidl_map is None:
+                            raise ConnectionError("сервер не ответил на UIDL")
+                        numbers = {value: number for number, value in uidl_map.items()}
+
+                    if uidl is None:
+                        uidl = self._next_uidl()
+                        if uidl is None:
+                            return
+                    if uidl not in numbers:
+                        # Письмо удалено с сервера после начала экспорта
+                        with self._lock:
+                            self.stats.skipped += 1
+                        uidl = None
+                        continue
+
+                    if not export(client, numbers[uidl], uidl):
+                        if not client.connected or client.send_command("NOOP") is None:
+                            raise ConnectionError("соединение прервано при получении письма")
+                        self.log_message(f"Не удалось выгрузить письмо {uidl}", "ОШИБКА:")
+                        with self._lock:
+                            self.stats.failed += 1
+                    uidl = None
+                    failures = 0
+                except PermissionError as e:
+                    # Отказ в аутентификации повтор не исправит, а каждый повтор снова отправил бы пароль
+                    self.log_message(f"Сессия экспорта остановлена: {str(e)}", "ОШИБКА:")
+                    if uidl is not None:
+                        with self._lock:
+                            self._queue.appendleft(uidl)
+                    return
+                except (ConnectionError, OSError) as e:
+                    failures += 1
+                    if client is not None:
+                        client.close()
+                        client = None
+                    if failures > self.max_retries:
+                        self.log_message(f"Сессия экспорта остановлена: {str(e)}", "ОШИБКА:")
+                        if uidl is not None:
+                            with self._lock:
+                                self._queue.appendleft(uidl)
+                        return
+                    self.metrics.inc("retries_total", operation="mailbox_export")
+                    self.log_message(f"Переподключение после ошибки: {str(e)}", "ОШИБКА:")
+                    self._stop_event.wait(self.retry_delay * 2 ** (failures - 1))
+        finally:
+            if client is not None:
+                client.close()
+
+    def run(self):
+        """
+        Выполняет экспорт и возвращает ExportStats. Письма, которые не удалось
+        выгрузить, в журнал не попадают и будут запрошены при следующем запуске.
+        """
+        started = time.monotonic()
+        self._stop_event.clear()
+        self.stats = ExportStats()
+        try:
+            done = self._open_archive()
+            first = self._open_session()
+            uidl_map = first.get_uidl_map()
+            if uidl_map is None:
+                first.close()
+                raise ConnectionError("сервер не ответил на UIDL")
+
+            self.stats.total = len(uidl_map)
+            self._queue = deque(uidl for _, uidl in sorted(uidl_map.items()) if uidl not in done)
+            self.stats.skipped = self.stats.total - len(self._queue)
+            if self.stats.skipped:
+                self.log_message(f"Уже выгружено ранее: {self.stats.skipped}, осталось: {len(self._queue)}")
+
+            clients = [first]
+            for _ in range(min(self.connections, len(self._queue)) - 1):
+                try:
+                    clients.append(self._open_session())
+                except (ConnectionError, PermissionError) as e:
+                    self.log_message(f"Дополнительная сессия не открыта, продолжаем с {len(clients)}: {str(e)}")
+                    break
+            self.stats.sessions = len(clients)
+
+            threads = [threading.Thread(target=self._worker, args=(client,), daemon=True) for client in clients[1:]]
+            for thread in threads:
+                thread.start()
+            self._worker(clients[0])
+            for thread in threads:
+                thread.join()
+
+            if self._queue and not self._stop_event.is_set():
+                self.log_message(f"Экспорт не завершен, осталось писем: {len(self._queue)}", "ОШИБКА:")
+        except Exception as e:
+            self.log_message(f"Ошибка экспорта ящика: {str(e)}", "ОШИБКА:")
+        finally:
+            if self._checkpoint:
+                self._close_archive()
+            self.stats.elapsed = time.monotonic() - started
+
+        self.log_message(f"Экспорт завершен: {self.stats.as_dict()}")
+        return self.stats
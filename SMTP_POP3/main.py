@@ -1,31 +1,91 @@
-from datetime import datetime
+import io
+import logging
+import os
+import time
 from POP3.main import POP3Client
 from SMTP.main import SMTPClient
-import base64
+from common.log import get_logger
+from common.metrics import get_metrics
+import tempfile
+from email.message import EmailMessage
+from email.utils import parsedate_to_datetime
+from datetime import datetime
 from email_decoder import EmailDecoder
+from mailbox_export import MailboxExporter
+from message_cache import MessageCache
+from parse_pipeline import ParsePipeline
+from search_index import SearchIndex
+from smtp_pool import shared_pool
+
+
+class SyncResult:
+    """Изменения ящика с момента предыдущего получения списка или синхронизации"""
+
+    def __init__(self, added=None, removed=None, renumbered=None):
+        # Новые письма: кортежи (номер, размер, заголовки)
+        self.added = added or []
+        # Прежние номера удаленных писем
+        self.removed = removed or []
+        # Прежний номер -> новый для оставшихся писем, номер которых сдвинулся
+        self.renumbered = renumbered or {}
+
+    @property
+    def changed(self):
+        return bool(self.added or self.removed or self.renumbered)
 
 
 class EmailClient:
-    def __init__(self):
-        self.smtp_client = None
+    def __init__(self, cache=None, smtp_pool=None, search_index=None):
+        # SMTP соединения берутся из пула на время отправки; клиент хранит только параметры
+        self.smtp_pool = smtp_pool or shared_pool
+        self.smtp_settings = None
         self.pop3_client = None
         self.smtp_authenticated = False
         self.pop3_authenticated = False
-        self.log_file = f"email_client_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+        self.pop3_server = None
+        self.pop3_username = None
+        # Параметры POP3 сессии нужны для переподключения и открытия дополнительных сессий
+        self.pop3_settings = None
+        # Сессия, обменивавшаяся данными с сервером не позднее pop3_idle_threshold
+        # секунд назад, считается живой без проверки командой NOOP
+        self.pop3_idle_threshold = 30.0
+        # Восстановление разорванной сессии: число попыток и начальная пауза между ними
+        self.pop3_max_retries = 3
+        self.pop3_retry_delay = 1.0
+        # Локальный кэш писем (MessageCache) и соответствие номеров сообщений из
+        # последнего LIST их UIDL. Методы принимают номера из этого списка; после
+        # переподключения они переводятся в номера новой сессии по UIDL
+        self.cache = cache
+        self.uidl_map = {}
+        # Локальный поисковый индекс (SearchIndex); пополняется заголовками при просмотре
+        # списка и текстами писем при индексации ящика
+        self.search_index = search_index
+        # Размеры писем по номерам из последнего ответа на LIST
+        self.message_sizes = {}
+        # Число писем и общий размер при последнем получении списка (для проверки STAT)
+        self._stat_state = None
+        # Номера (из последнего списка) писем, помеченных на удаление в текущей сессии;
+        # сервер удаляет их только при QUIT, обрыв сессии снимает пометки
+        self.pending_deletes = set()
+        # Письма крупнее spool_threshold при чтении сбрасываются во временный файл,
+        # в кэш попадают только письма не крупнее cache_body_limit
+        self.spool_threshold = 1024 * 1024
+        self.cache_body_limit = 5 * 1024 * 1024
+        # Для просмотра письма крупнее preview_threshold (по размеру из LIST) загружаются
+        # только заголовки и первые preview_lines строк тела командой TOP
+        self.preview_threshold = 256 * 1024
+        self.preview_lines = 200
+        self.logger = get_logger("email_client")
+        # Реестр метрик, общий с POP3 и SMTP клиентами
+        self.metrics = get_metrics()
 
     def setup_smtp(self, server, port, username, password, use_tls=True):
         try:
-            self.smtp_client = SMTPClient()
-            if not self.smtp_client.connect(server, port):
-                return False
-
-            if use_tls:
-                self.smtp_client.send_command("STARTTLS")
-
-            # Выполняем аутентификацию SMTP
-            auth_string = base64.b64encode(f"\0{username}\0{password}".encode()).decode()
-            self.smtp_client.send_command("AUTH PLAIN " + auth_string)
+            # Проверяем подключение и аутентификацию; соединение остается в пуле для отправки
+            client = self.smtp_pool.acquire(server, port, username, password, use_tls)
+            self.smtp_pool.release(client)
 
+            self.smtp_settings = (server, port, username, password, use_tls)
             self.smtp_authenticated = True
             self.log_message("SMTP аутентификация успешна", "ИНФО:")
             return True
@@ -43,42 +103,128 @@ class EmailClient:
     def check_pop3_auth(self):
         """
         Проверяет статус аутентификации POP3 и соединение с сервером.
-        Возвращает True, если соединение активно и аутентификация выполнена успешно.
+        Недавний обмен данными считается подтверждением, что соединение живо;
+        NOOP отправляется только после простоя дольше pop3_idle_threshold.
+        Если сервер разорвал сессию, клиент переподключается и проходит
+        аутентификацию заново. Возвращает True, если сессия готова к работе.
         """
         if not self.pop3_authenticated or not self.pop3_client:
             self.log_message("POP3 клиент не аутентифицирован или не подключен", "ОШИБКА:")
             return False
         try:
-            # Проверяем соединение с помощью NOOP команды
-            response = self.pop3_client.send_command("NOOP")
-            if not response or "+OK" not in response:
-                self.pop3_authenticated = False
-                self.log_message("POP3 соединение потеряно", "ОШИБКА:")
-                return False
-            return True
+            if self.pop3_client.check_alive(self.pop3_idle_threshold):
+                return True
+            self.log_message("POP3 соединение потеряно, переподключение", "ИНФО:")
+            return self._reconnect_pop3()
         except Exception as e:
             self.pop3_authenticated = False
             self.log_message(f"Ошибка при проверке POP3 соединения: {str(e)}", "ОШИБКА:")
             return False
 
-    def setup_pop3(self, server, port, username, password, use_ssl=True):
-        try:
-            self.pop3_client = POP3Client(server, port, use_ssl)
-            if not self.pop3_client.connect():
-                return False
+    def _reconnect_pop3(self):
+        """
+        Открывает новую POP3 сессию с сохраненными параметрами вместо разорванной.
+        Делает до pop3_max_retries попыток, удваивая паузу между ними. Номера писем
+        в новой сессии могут отличаться, поэтому соответствие UIDL запрашивается
+        заново одной командой UIDL.
+        """
+        self.pop3_authenticated = False
+        for attempt in range(self.pop3_max_retries):
+            if attempt:
+                time.sleep(self.pop3_retry_delay * 2 ** (attempt - 1))
+            self.metrics.inc("retries_total", operation="pop3_reconnect")
+            if self.pending_deletes:
+                # QUIT в еще живой сессии удалил бы помеченные письма, пометки которых
+                # затем повторяются в новой сессии
+                self.pop3_client.abort()
+            else:
+                self.pop3_client.close()
+            if not self._open_pop3_session(*self.pop3_settings):
+                continue
+            if self.uidl_map and self.pop3_client.get_uidl_map() is None:
+                continue
+            if self.pending_deletes and not self._remark_deletes():
+                continue
+            self.pop3_authenticated = True
+            self.log_message("POP3 соединение восстановлено", "ИНФО:")
+            return True
 
-            # Выполняем аутентификацию POP3
-            user_response = self.pop3_client.send_command(f"USER {username}")
-            if not user_response or "+OK" not in user_response:
-                self.log_message("Ошибка при отправке команды USER", "ОШИБКА:")
-                return False
+        self.log_message("Не удалось восстановить POP3 соединение", "ОШИБКА:")
+        return False
+
+    def _remark_deletes(self):
+        """Повторяет пометки на удаление в новой сессии: прежние потеряны вместе с разорванной"""
+        numbers = {}
+        for msg_num in self.pending_deletes:
+            number = self._session_number(msg_num)
+            if number is not None:
+                numbers[number] = msg_num
+        marked = self.pop3_client.delete_pipelined(sorted(numbers), self._pipeline_window())
+        if marked is None:
+            return False
+        self.pending_deletes = {numbers[number] for number in marked}
+        return True
+
+    def _pipeline_window(self, window=50):
+        """Размер окна конвейерных команд: 1, если сервер не объявляет PIPELINING"""
+        return window if "PIPELINING" in self.pop3_client.get_capabilities() else 1
+
+    def _with_reconnect(self, action, retry=True):
+        """
+        Выполняет action() - операцию POP3, возвращающую None при ошибке.
+        Если ошибка вызвана обрывом соединения, сессия восстанавливается и
+        операция повторяется (при retry=True), иначе возвращается None.
+        """
+        for attempt in range(self.pop3_max_retries + 1):
+            result = action()
+            if result is not None or self.pop3_client.connected:
+                return result
+            if not retry or attempt == self.pop3_max_retries or not self._reconnect_pop3():
+                return None
+        return None
+
+    def _session_number(self, msg_number):
+        """
+        Переводит номер письма из последнего LIST в номер текущей сессии.
+        Возвращает None, если письмо с таким UIDL на сервере больше нет.
+        """
+        msg_number = int(msg_number)
+        uidl = self.uidl_map.get(msg_number)
+        if uidl is None or not self.pop3_client.uidl_numbers:
+            return msg_number
+        return self.pop3_client.number_for(uidl)
+
+    def _open_pop3_session(self, server, port, username, password, use_ssl):
+        """Подключается к POP3 серверу и проходит аутентификацию"""
+        self.pop3_client = POP3Client(server, port, use_ssl)
+        self.pop3_client.metrics = self.metrics
+        if not self.pop3_client.connect():
+            return False
+
+        # Выполняем аутентификацию POP3
+        start = time.perf_counter()
+        user_response = self.pop3_client.send_command(f"USER {username}")
+        if not user_response or "+OK" not in user_response:
+            self.log_message("Ошибка при отправке команды USER", "ОШИБКА:")
+            return False
+
+        pass_response = self.pop3_client.send_command(f"PASS {password}")
+        if not pass_response or "+OK" not in pass_response:
+            self.log_message("Ошибка при отправке команды PASS", "ОШИБКА:")
+            return False
+        self.metrics.observe("auth_seconds", time.perf_counter() - start, protocol="pop3", command="USER/PASS")
+        return True
 
-            pass_response = self.pop3_client.send_command(f"PASS {password}")
-            if not pass_response or "+OK" not in pass_response:
-                self.log_message("Ошибка при отправке команды PASS", "ОШИБКА:")
+    def setup_pop3(self, server, port, username, password, use_ssl=True):
+        try:
+            if not self._open_pop3_session(server, port, username, password, use_ssl):
                 return False
 
             self.pop3_authenticated = True
+            self.pop3_server = server
+            self.pop3_username = username
+            self.pop3_settings = (server, port, username, password, use_ssl)
+            self.uidl_map = {}
             self.log_message("POP3 аутентификация успешна", "ИНФО:")
             return True
 
@@ -86,41 +232,260 @@ class EmailClient:
             self.log_message(f"Ошибка настройки POP3: {str(e)}", "ОШИБКА:")
             return False
 
-    def list_messages(self):
+    def get_message_sizes(self):
         """
-        Получает список сообщений с сервера POP3.
-        Возвращает список кортежей (номер, размер, заголовки).
+        Получает номера и размеры писем командой LIST и соответствие номеров
+        UIDL, по которому письма находятся после переподключения. Возвращает
+        список кортежей (номер, размер) или None при ошибке.
         """
         if not self.pop3_client or not self.check_pop3_auth():
             self.log_message("POP3 клиент не настроен или не авторизован", "ОШИБКА:")
             return None
 
         try:
-            # Получаем список сообщений
-            response = self.pop3_client.send_command("LIST")
-            if not response or "+OK" not in response:
-                self.log_message("Ошибка при получении списка сообщений", "ОШИБКА:")
+            return self._with_reconnect(self._list_sizes)
+        except Exception as e:
+            self.log_message(f"Ошибка при получении списка сообщений: {str(e)}", "ОШИБКА:")
+            return None
+
+    def _list_sizes(self):
+        # Получаем список сообщений
+        response = self.pop3_client.send_command("LIST")
+        if not response or "+OK" not in response:
+            self.log_message("Ошибка при получении списка сообщений", "ОШИБКА:")
+            return None
+
+        messages_data = self.pop3_client.receive_multiline()
+        if messages_data is None:
+            return None
+
+        # Парсим список сообщений
+        sizes = []
+        for line in messages_data.split('\n'):
+            if line.strip():
+                parts = line.strip().split()
+                if len(parts) >= 2:
+                    try:
+                        sizes.append((int(parts[0]), int(parts[1])))
+                    except ValueError:
+                        continue
+
+        # Сервер без поддержки UIDL отвечает -ERR: тогда номера используются как есть
+        uidl_map = self.pop3_client.get_uidl_map()
+        if uidl_map is None and not self.pop3_client.connected:
+            return None
+        self.uidl_map = uidl_map or {}
+        self.message_sizes = dict(sizes)
+        self._stat_state = (len(sizes), sum(size for _, size in sizes))
+        return sizes
+
+    def _stat(self):
+        """Возвращает (число писем, общий размер) из ответа на STAT или None"""
+        response = self.pop3_client.send_command("STAT")
+        if not response or not response.startswith("+OK"):
+            return None
+        parts = response.split()
+        try:
+            return int(parts[1]), int(parts[2])
+        except (IndexError, ValueError):
+            return None
+
+    def _list_numbers(self, msg_numbers):
+        """
+        Возвращает {номер: размер} для писем msg_numbers текущей сессии или None.
+        Размеры немногих писем запрашиваются конвейером команд LIST n за один
+        обмен с сервером; для большого числа писем или сервера без PIPELINING -
+        одним полным LIST.
+        """
+        if len(msg_numbers) <= 100 and "PIPELINING" in self.pop3_client.get_capabilities():
+            return self.pop3_client.list_pipelined(msg_numbers, len(msg_numbers))
+
+        response = self.pop3_client.send_command("LIST")
+        if not response or not response.startswith("+OK"):
+            return None
+        data = self.pop3_client.receive_multiline()
+        if data is None:
+            return None
+        wanted = set(msg_numbers)
+        sizes = {}
+        for line in data.split("\r\n"):
+            parts = line.split()
+            if len(parts) >= 2 and parts[0].isdigit() and parts[1].isdigit() and int(parts[0]) in wanted:
+                sizes[int(parts[0])] = int(parts[1])
+        return sizes
+
+    def sync_messages(self, reopen_session=False, pipeline_window=50):
+        """
+        Определяет изменения ящика с прошлого получения списка и возвращает SyncResult
+        (или None при ошибке). Сначала выполняется STAT: если число писем и общий
+        размер не изменились, на этом проверка заканчивается. Иначе по UIDL
+        вычисляются добавленные и удаленные письма, заголовки запрашиваются только
+        для новых, а номера писем, использованные в списке, приводятся к текущим
+        (см. SyncResult.renumbered).
+
+        Сервер фиксирует состав ящика при входе (RFC 1939), поэтому новые письма
+        видны только в новой сессии: проверка новой почты вызывается с
+        reopen_session=True, и сессия открывается заново, если нет писем,
+        помеченных на удаление (QUIT удалил бы их). При reopen_session=False
+        проверка выполняется в текущей сессии и замечает только изменения,
+        сделанные в ней самой; переподключение происходит, только если STAT
+        показал обрыв соединения.
+        """
+        if not self.pop3_authenticated or not self.pop3_settings:
+            self.log_message("POP3 клиент не настроен или не авторизован", "ОШИБКА:")
+            return None
+
+        try:
+            # QUIT удалил бы помеченные письма, поэтому при незавершенном удалении сессия сохраняется
+            if reopen_session and not self.pending_deletes:
+                self.pop3_client.close()
+                if not self._open_pop3_session(*self.pop3_settings) and not self._reconnect_pop3():
+                    self.pop3_authenticated = False
+                    return None
+
+            stat = self._with_reconnect(self._stat)
+            if stat is None:
+                return None
+            # Помеченные на удаление письма сервер не показывает в STAT и UIDL до QUIT,
+            # но в списке они остаются под прежними номерами, пока удаление не подтверждено
+            pending = {msg_num: self.uidl_map[msg_num] for msg_num in self.pending_deletes
+                       if msg_num in self.uidl_map}
+            stat = (stat[0] + len(pending), stat[1] + sum(self.message_sizes.get(msg_num, 0) for msg_num in pending))
+            if stat == self._stat_state:
+                return SyncResult()
+
+            uidl_map = self._with_reconnect(lambda: self.pop3_client.get_uidl_map())
+            if uidl_map is None:
+                self.log_message("Сервер не ответил на UIDL", "ОШИБКА:")
                 return None
+            uidl_map.update(pending)
+
+            old_numbers = {uidl: msg_num for msg_num, uidl in self.uidl_map.items()}
+            live = set(uidl_map.values())
+            removed = sorted(msg_num for uidl, msg_num in old_numbers.items() if uidl not in live)
+            renumbered = {old_numbers[uidl]: msg_num for msg_num, uidl in uidl_map.items()
+                          if uidl in old_numbers and old_numbers[uidl] != msg_num}
+            added_numbers = sorted(msg_num for msg_num, uidl in uidl_map.items() if uidl not in old_numbers)
+
+            added_sizes = self._with_reconnect(lambda: self._list_numbers(added_numbers)) if added_numbers else {}
+            if added_sizes is None:
+                return None
+
+            # Размеры оставшихся писем известны из прошлого списка
+            sizes = {msg_num: self.message_sizes.get(old_numbers[uidl], 0)
+                     for msg_num, uidl in uidl_map.items() if uidl in old_numbers}
+            sizes.update(added_sizes)
+            self.uidl_map = dict(uidl_map)
+            self.message_sizes = sizes
+            self._stat_state = stat
+
+            added = list(self._iter_headers(sorted(added_sizes.items()), pipeline_window))
+            if removed and self.cache:
+                self.cache.forget_missing(self.pop3_server, self.pop3_username, live)
+            if removed and self.search_index:
+                self.search_index.forget_missing(self.pop3_server, self.pop3_username, live)
+
+            if added or removed:
+                self.log_message(f"Новых писем: {len(added)}, удалено: {len(removed)}", "ИНФО:")
+            return SyncResult(added, removed, renumbered)
+
+        except Exception as e:
+            self.log_message(f"Ошибка при синхронизации списка писем: {str(e)}", "ОШИБКА:")
+            return None
+
+    def _iter_headers(self, sizes, pipeline_window=50):
+        """
+        Генератор кортежей (номер, размер, заголовки) для писем из sizes.
+        Сначала отдает заголовки из кэша, затем получает недостающие командами TOP n 0
+        одним проходом, без NOOP перед каждым TOP; если сервер объявляет PIPELINING,
+        команды отправляются окнами по pipeline_window. При обрыве соединения
+        сессия восстанавливается и обход продолжается с первого неполученного письма.
+        """
+        cached = {}
+        if self.cache and self.uidl_map:
+            known = [self.uidl_map[msg_num] for msg_num, _ in sizes if msg_num in self.uidl_map]
+            by_uidl = self.cache.get_headers(self.pop3_server, self.pop3_username, known)
+            cached = {msg_num: by_uidl[self.uidl_map[msg_num]] for msg_num, _ in sizes
+                      if self.uidl_map.get(msg_num) in by_uidl}
+
+        to_fetch = [msg_num for msg_num, _ in sizes if msg_num not in cached]
+        size_by_number = dict(sizes)
+        fetched = []
+        done = 0
+        reconnects = 0
+        try:
+            for msg_num, msg_size in sizes:
+                if msg_num in cached:
+                    yield msg_num, msg_size, cached[msg_num]
+
+            while done < len(to_fetch):
+                if "PIPELINING" in self.pop3_client.get_capabilities():
+                    window = pipeline_window
+                else:
+                    window = 1
+
+                # Номера текущей сессии; письма, удаленные с сервера, пропускаются
+                remaining = [(msg_num, self._session_number(msg_num)) for msg_num in to_fetch[done:]]
+                fetcher = self.pop3_client.top_pipelined(
+                    [number for _, number in remaining if number is not None], 0, window)
+                try:
+                    for msg_num, number in remaining:
+                        headers_data = next(fetcher)[1] if number is not None else None
+                        headers = EmailDecoder.parse_headers(headers_data) if headers_data else None
+                        if headers is not None and msg_num in self.uidl_map:
+                            fetched.append((self.uidl_map[msg_num], size_by_number[msg_num], headers))
+                        done += 1
+                        yield msg_num, size_by_number[msg_num], headers
+                except (ConnectionError, OSError):
+                    reconnects += 1
+                    if reconnects > self.pop3_max_retries or not self._reconnect_pop3():
+                        raise
+                    self.log_message(f"Получение заголовков продолжено с письма {to_fetch[done]}", "ИНФО:")
+                finally:
+                    fetcher.close()
+        finally:
+            if self.cache and fetched:
+                self.cache.put_headers(self.pop3_server, self.pop3_username, fetched)
+            if self.search_index and fetched:
+                self.search_index.put_headers(self.pop3_server, self.pop3_username, fetched)
+
+    def list_messages(self, pipeline_window=50, on_message=None, cancel_event=None):
+        """
+        Получает список сообщений с сервера POP3.
+        Возвращает список кортежей (номер, размер, заголовки).
+        При включенном кэше запрашиваются только заголовки писем с новыми UIDL.
+        on_message(номер, размер, заголовки) вызывается по мере получения заголовков;
+        установка cancel_event (threading.Event) прерывает обход, возвращая уже полученное.
+        """
+        sizes = self.get_message_sizes()
+        if sizes is None:
+            return None
+
+        try:
+            headers_by_number = {}
+            cancelled = False
+            headers_iter = self._iter_headers(sizes, pipeline_window)
+            try:
+                for msg_num, msg_size, headers in headers_iter:
+                    headers_by_number[msg_num] = headers
+                    if on_message:
+                        on_message(msg_num, msg_size, headers)
+                    if cancel_event and cancel_event.is_set():
+                        cancelled = True
+                        break
+            finally:
+                headers_iter.close()
+
+            if self.cache and self.uidl_map:
+                self.cache.forget_missing(self.pop3_server, self.pop3_username, self.uidl_map.values())
+            if self.search_index and self.uidl_map:
+                self.search_index.forget_missing(self.pop3_server, self.pop3_username, self.uidl_map.values())
 
-            messages_data = self.pop3_client.receive_multiline()
-            if not messages_data:
-                return []
-
-            # Парсим список сообщений
-            messages = []
-            for line in messages_data.split('\n'):
-                if line.strip():
-                    parts = line.strip().split()
-                    if len(parts) >= 2:
-                        try:
-                            msg_num = int(parts[0])
-                            msg_size = int(parts[1])
-
-                            # Получаем заголовки для каждого сообщения
-                            headers = self.get_message_headers(msg_num)
-                            messages.append((msg_num, msg_size, headers))
-                        except ValueError:
-                            continue
+            messages = [(msg_num, msg_size, headers_by_number.get(msg_num))
+                        for msg_num, msg_size in sizes if msg_num in headers_by_number]
+            if cancelled:
+                self.log_message(f"Получение списка прервано, получено {len(messages)} из {len(sizes)}", "ИНФО:")
+                return messages
 
             self.log_message(f"Получено {len(messages)} сообщений", "ИНФО:")
             return messages
@@ -129,97 +494,520 @@ class EmailClient:
             self.log_message(f"Ошибка при получении списка сообщений: {str(e)}", "ОШИБКА:")
             return None
 
-    def log_message(self, message, level="ИНФО:"):
-        """Записывает сообщение в лог-файл"""
-        timestamp = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-        log_entry = f"{timestamp} {level} {message}\n"
+    def fetch_headers(self, msg_numbers, pipeline_window=50):
+        """
+        Возвращает словарь {номер: заголовки} только для указанных писем.
+        Используется для постраничной подгрузки; размеры берутся из последнего LIST.
+        """
+        if not self.pop3_client or not self.check_pop3_auth():
+            return None
+
         try:
-            with open(self.log_file, 'a', encoding='utf-8') as f:
-                f.write(log_entry)
+            sizes = [(msg_num, self.message_sizes.get(msg_num, 0)) for msg_num in msg_numbers]
+            return {msg_num: headers for msg_num, _, headers in self._iter_headers(sizes, pipeline_window)}
         except Exception as e:
-            print(f"Ошибка записи в лог: {str(e)}")
+            self.log_message(f"Ошибка при получении заголовков: {str(e)}", "ОШИБКА:")
+            return None
+
+    def log_message(self, message, level="ИНФО:"):
+        """Записывает сообщение в общий журнал"""
+        self.logger.log(logging.ERROR if level == "ОШИБКА:" else logging.INFO, message)
+
+    def _message_uidl(self, msg_number):
+        """Возвращает UIDL сообщения, если он известен и кэш включен"""
+        if not self.cache:
+            return None
+        try:
+            return self.uidl_map.get(int(msg_number))
+        except ValueError:
+            return None
 
     def get_message_headers(self, msg_number):
+        uidl = self._message_uidl(msg_number)
+        if uidl:
+            cached = self.cache.get_headers(self.pop3_server, self.pop3_username, [uidl])
+            if uidl in cached:
+                return cached[uidl]
+
         if not self.pop3_client or not self.check_pop3_auth():
             return None
 
-        try:
-            response = self.pop3_client.send_command(f"TOP {msg_number} 0")
+        def fetch():
+            number = self._session_number(msg_number)
+            if number is None:
+                return None
+            response = self.pop3_client.send_command(f"TOP {number} 0")
             if not response or "+OK" not in response:
                 return None
+            return self.pop3_client.receive_multiline()
 
-            headers_data = self.pop3_client.receive_multiline()
+        try:
+            headers_data = self._with_reconnect(fetch)
             if not headers_data:
                 return None
 
-            # Парсим заголовки
-            headers = {}
-            current_header = None
-            current_value = []
-
-            for line in headers_data.split('\n'):
-                line = line.strip()
-                if not line:
-                    continue
-
-                if line[0] in [' ', '\t'] and current_header:
-                    current_value.append(line.strip())
-                else:
-                    if current_header:
-                        headers[current_header] = EmailDecoder.decode_header_value(' '.join(current_value))
-
-                    if ':' in line:
-                        current_header = line.split(':', 1)[0].strip()
-                        current_value = [line.split(':', 1)[1].strip()]
-
-            if current_header:
-                headers[current_header] = EmailDecoder.decode_header_value(' '.join(current_value))
-
-            return headers
+            return EmailDecoder.parse_headers(headers_data)
 
         except Exception as e:
             self.log_message(f"Ошибка при получении заголовков сообщения {msg_number}: {str(e)}", "ОШИБКА:")
             return None
 
     def send_email(self, from_addr, to_addr, subject, message):
-        if not self.smtp_client or not self.check_smtp_auth():
+        if not self.smtp_settings or not self.check_smtp_auth():
             print("SMTP клиент не настроен или не авторизован")
             return False
 
+        try:
+            email_message = EmailMessage()
+            email_message['From'] = from_addr
+            email_message['To'] = to_addr
+            email_message['Subject'] = subject
+            email_message.set_content(message)
+
+            recipients = SMTPClient.split_recipients(to_addr)
+            if not recipients:
+                self.log_message("Не указаны получатели письма", "ОШИБКА:")
+                return False
+
+            response, refused = self._send_pooled(from_addr, recipients, email_message.as_string())
+            for recipient, reason in refused.items():
+                self.log_message(f"Получатель {recipient} отклонен: {reason}", "ОШИБКА:")
+
+            if SMTPClient.reply_code(response) != 250:
+                self.log_message(f"Письмо не отправлено: {response}", "ОШИБКА:")
+                return False
+
+            self.log_message(f"Письмо для {to_addr} отправлено", "ИНФО:")
+            return True
+
+        except Exception as e:
+            self.log_message(f"Ошибка при отправке письма: {str(e)}", "ОШИБКА:")
+            return False
+
+    def _send_pooled(self, from_addr, recipients, data):
+        """
+        Отправляет письмо через соединение из пула. Если соединение оказалось
+        разорванным до отправки текста письма, оно заменяется новым и отправка
+        повторяется один раз. Если оборвался уже ответ на текст письма, сервер мог
+        его принять, поэтому письмо не отправляется повторно.
+        """
+        for attempt in range(2):
+            client = self.smtp_pool.acquire(*self.smtp_settings)
+            try:
+                response, refused = client.send_mail(from_addr, recipients, data)
+            except Exception:
+                self.smtp_pool.release(client, broken=True)
+                if attempt or client.message_sent:
+                    raise
+                self.metrics.inc("retries_total", operation="send_email")
+                continue
+
+            broken = response is None
+            self.smtp_pool.release(client, broken=broken)
+            if not broken:
+                break
+            if client.message_sent:
+                self.log_message("Соединение прервано после передачи текста письма; "
+                                 "письмо могло быть доставлено, повторная отправка не выполняется", "ОШИБКА:")
+                break
+            if not attempt:
+                self.metrics.inc("retries_total", operation="send_email")
+        return response, refused
+
     def read_message(self, msg_number):
+        uidl = self._message_uidl(msg_number)
+        if uidl:
+            message_data = self.cache.get_body(self.pop3_server, self.pop3_username, uidl)
+            if message_data is not None:
+                return EmailDecoder.decode_message_content(message_data)
+
         if not self.pop3_client or not self.check_pop3_auth():
             return None
 
         try:
-            response = self.pop3_client.send_command(f"RETR {msg_number}")
-            if not response or "+OK" not in response:
+            # Письмо принимается потоком; в памяти держится только небольшое письмо,
+            # крупное сразу уходит во временный файл на диске
+            with tempfile.SpooledTemporaryFile(max_size=self.spool_threshold) as spool:
+                size = self.download_message(msg_number, spool)
+                if not size:
+                    return None
+
+                spool.seek(0)
+                if uidl and size <= self.cache_body_limit:
+                    self.cache.put_body(self.pop3_server, self.pop3_username, uidl, spool.read())
+                    spool.seek(0)
+
+                # Декодируем и возвращаем содержимое сообщения
+                return EmailDecoder.decode_message_stream(spool)
+
+        except Exception as e:
+            self.log_message(f"Ошибка при чтении сообщения {msg_number}: {str(e)}", "ОШИБКА:")
+            return None
+
+    def open_message(self, msg_number):
+        """
+        Загружает письмо во временный файл и возвращает разобранную структуру
+        (common.mime.MimeMessage) с ленивым доступом к частям и вложениям.
+        Сообщение нужно закрыть методом close(), временный файл при этом удаляется.
+        Возвращает None при ошибке.
+        """
+        uidl = self._message_uidl(msg_number)
+        if uidl:
+            message_data = self.cache.get_body(self.pop3_server, self.pop3_username, uidl)
+            if message_data is not None:
+                return EmailDecoder.parse_message(message_data)
+        return self._open_downloaded(msg_number, uidl)
+
+    def _open_downloaded(self, msg_number, uidl):
+        """Загружает письмо командой RETR во временный файл (без обращения к кэшу) и разбирает его"""
+        if not self.pop3_client or not self.check_pop3_auth():
+            return None
+
+        spool = tempfile.TemporaryFile()
+        try:
+            size = self.download_message(msg_number, spool)
+            if not size:
+                spool.close()
                 return None
+            if uidl and size <= self.cache_body_limit:
+                spool.seek(0)
+                self.cache.put_body(self.pop3_server, self.pop3_username, uidl, spool.read())
+            spool.seek(0)
+            # Временный файл принадлежит сообщению и закрывается вместе с ним
+            return EmailDecoder.parse_message(spool, close_source=True)
+        except Exception as e:
+            spool.close()
+            self.log_message(f"Ошибка при разборе сообщения {msg_number}: {str(e)}", "ОШИБКА:")
+            return None
+
+    def preview_message(self, msg_number, lines=None):
+        """
+        Загружает письмо для просмотра и возвращает кортеж (заголовки, текст,
+        признак неполного текста) или None при ошибке. Письмо из кэша и письмо
+        не крупнее preview_threshold по размеру из LIST загружаются целиком
+        одной командой RETR; у крупного запрашиваются заголовки и первые lines
+        (по умолчанию preview_lines) строк тела командой TOP. Письмо, размер
+        которого неизвестен, считается крупным. Полное письмо загружается
+        только явно - read_message, open_message или save_attachments.
+        """
+        size = self.message_sizes.get(int(msg_number))
+        uidl = self._message_uidl(msg_number)
+        cached = self.cache.get_body(self.pop3_server, self.pop3_username, uidl) if uidl else None
 
-            message_data = self.pop3_client.receive_multiline()
-            if not message_data:
+        truncated = False
+        if cached is not None:
+            message = EmailDecoder.parse_message(cached)
+        elif size is not None and size <= self.preview_threshold:
+            message = self._open_downloaded(msg_number, uidl)
+        else:
+            if not self.pop3_client or not self.check_pop3_auth():
+                return None
+            buffer = io.BytesIO()
+            if not self.download_message(msg_number, buffer, lines or self.preview_lines):
                 return None
+            message = EmailDecoder.parse_message(buffer.getvalue(), truncated=True)
+            truncated = True
+        if message is None:
+            return None
+
+        try:
+            with message:
+                headers = {name: message.get_header(name) for name in dict.fromkeys(message.headers.keys())}
+                return headers, EmailDecoder.body_text(message), truncated
+        except Exception as e:
+            self.log_message(f"Ошибка при разборе сообщения {msg_number}: {str(e)}", "ОШИБКА:")
+            return None
 
-            # Декодируем и возвращаем содержимое сообщения
-            return EmailDecoder.decode_message_content(message_data)
+    def save_attachments(self, msg_number, directory):
+        """
+        Сохраняет вложения письма в каталог, декодируя их потоком прямо на диск.
+        Возвращает список путей к сохраненным файлам или None при ошибке.
+        """
+        message = self.open_message(msg_number)
+        if message is None:
+            return None
 
+        try:
+            os.makedirs(directory, exist_ok=True)
+            paths = []
+            for index, part in enumerate(message.attachments, 1):
+                # Из имени вложения берется только имя файла, без каталогов
+                filename = os.path.basename((part.filename or "").replace("\\", "/")) or f"attachment_{index}"
+                path = os.path.join(directory, filename)
+                if path in paths:
+                    name, ext = os.path.splitext(filename)
+                    path = os.path.join(directory, f"{name}_{index}{ext}")
+                part.save(path)
+                paths.append(path)
+            self.log_message(f"Сохранено вложений: {len(paths)}", "ИНФО:")
+            return paths
         except Exception as e:
-            self.log_message(f"Ошибка при чтении сообщения {msg_number}: {str(e)}", "ОШИБКА:")
+            self.log_message(f"Ошибка при сохранении вложений {msg_number}: {str(e)}", "ОШИБКА:")
             return None
+        finally:
+            message.close()
 
-    def delete_message(self, msg_number):
+    def parse_messages(self, msg_numbers=None, workers=None, max_pending=None):
+        """
+        Генератор ParsedMessage для писем msg_numbers (по умолчанию - всех писем ящика).
+        Загрузка идет в текущем потоке, разбор - в пуле из workers процессов;
+        в разборе одновременно не более max_pending писем (см. ParsePipeline).
+        """
         if not self.pop3_client or not self.check_pop3_auth():
-            print("POP3 клиент не настроен или не авторизован")
             return
 
+        if msg_numbers is None:
+            sizes = self.get_message_sizes()
+            if sizes is None:
+                return
+            msg_numbers = [msg_num for msg_num, _ in sizes]
+
+        pipeline = ParsePipeline(self, workers, max_pending)
+        try:
+            yield from pipeline.run(msg_numbers)
+        finally:
+            pipeline.close()
+
+    def index_messages(self, batch_size=100, cancel_event=None, workers=None):
+        """
+        Добавляет в поисковый индекс тексты писем, которых в нем еще нет.
+        Письма загружаются и разбираются через parse_messages и записываются
+        в индекс пачками по batch_size. Установка cancel_event прерывает
+        индексацию; уже записанные письма остаются в индексе.
+        Возвращает число проиндексированных писем или None при ошибке.
+        """
+        if not self.search_index:
+            self.log_message("Поисковый индекс не подключен", "ОШИБКА:")
+            return None
+
+        sizes = self.get_message_sizes()
+        if sizes is None:
+            return None
+
+        indexed = self.search_index.indexed_uidls(self.pop3_server, self.pop3_username)
+        pending = [msg_num for msg_num, _ in sizes
+                   if msg_num in self.uidl_map and self.uidl_map[msg_num] not in indexed]
+        count = 0
+        batch = []
+        try:
+            for parsed in self.parse_messages(pending, workers):
+                if parsed.success:
+                    batch.append((self.uidl_map[parsed.msg_number], parsed.size, parsed.headers, parsed.text))
+                if len(batch) >= batch_size:
+                    self.search_index.put_messages(self.pop3_server, self.pop3_username, batch)
+                    count += len(batch)
+                    batch = []
+                if cancel_event and cancel_event.is_set():
+                    break
+        except Exception as e:
+            self.log_message(f"Ошибка при индексации писем: {str(e)}", "ОШИБКА:")
+        finally:
+            if batch:
+                self.search_index.put_messages(self.pop3_server, self.pop3_username, batch)
+                count += len(batch)
+
+        self.log_message(f"Проиндексировано писем: {count}", "ИНФО:")
+        return count
+
+    def search_messages(self, query, limit=200):
+        """
+        Ищет письма в локальном индексе, не обращаясь к серверу (синтаксис
+        запроса - см. SearchIndex.parse_query). Возвращает список кортежей
+        (номер, размер, заголовки); номер равен None, если письма уже нет
+        в последнем полученном списке.
+        """
+        if not self.search_index or not self.pop3_server:
+            return []
+
+        numbers = {uidl: msg_num for msg_num, uidl in self.uidl_map.items()}
+        results = self.search_index.search(self.pop3_server, self.pop3_username, limit=limit,
+                                           **SearchIndex.parse_query(query))
+        return [(numbers.get(uidl), size, headers) for uidl, size, headers in results]
+
+    def download_message(self, msg_number, sink, lines=None):
+        """
+        Сохраняет исходный текст письма в файл (путь) или файловый объект блоками,
+        не загружая письмо в память целиком. Возвращает размер письма или None.
+        При lines загружаются только заголовки и первые lines строк тела (TOP).
+        При обрыве соединения загрузка повторяется в новой сессии, если sink -
+        путь или файловый объект с поддержкой seek (записанное частично отбрасывается).
+        """
+        if not self.pop3_client or not self.check_pop3_auth():
+            return None
+
+        position = None
+        if not isinstance(sink, str):
+            try:
+                position = sink.tell()
+            except (AttributeError, OSError):
+                pass
+
+        def retrieve():
+            number = self._session_number(msg_number)
+            if number is None:
+                return None
+            if position is not None:
+                sink.seek(position)
+                sink.truncate()
+            if lines is not None:
+                return self.pop3_client.top_to(number, lines, sink)
+            return self.pop3_client.retrieve_to(number, sink)
+
+        size = self._with_reconnect(retrieve, retry=isinstance(sink, str) or position is not None)
+        if size is None:
+            self.log_message(f"Ошибка при загрузке сообщения {msg_number}", "ОШИБКА:")
+        return size
+
+    def export_mailbox(self, target, fmt='mbox', connections=1):
+        """
+        Выгружает весь ящик в архив mbox или Maildir (см. MailboxExporter).
+        Прерванный экспорт при повторном вызове с тем же target продолжается.
+        Сервер может не допускать двух сессий к одному ящику, поэтому на время
+        экспорта сессия клиента закрывается и затем открывается заново.
+        Возвращает ExportStats или None, если POP3 не настроен.
+        """
+        if not self.pop3_settings:
+            self.log_message("POP3 клиент не настроен или не авторизован", "ОШИБКА:")
+            return None
+        if self.pending_deletes:
+            self.log_message("Сначала подтвердите или отмените удаление писем", "ОШИБКА:")
+            return None
+
+        server, port, username, password, use_ssl = self.pop3_settings
+        self.close()
+        self.pop3_authenticated = False
+        try:
+            exporter = MailboxExporter(server, port, username, password, target, fmt, use_ssl, connections)
+            return exporter.run()
+        finally:
+            self.setup_pop3(server, port, username, password, use_ssl)
+
+    def select_messages(self, msg_numbers=None, uidls=None, older_than=None, larger_than=None):
+        """
+        Отбирает номера писем из последнего списка: явно заданные номера и UIDL,
+        а при фильтрах - письма с датой раньше older_than (datetime) и размером
+        больше larger_than байт. Заданные условия объединяются через AND.
+        Даты берутся из заголовков в кэше, недостающие запрашиваются командами TOP.
+        """
+        if not self.message_sizes and self.get_message_sizes() is None:
+            return None
+
+        selected = set(self.message_sizes)
+        if msg_numbers is not None:
+            selected &= {int(msg_num) for msg_num in msg_numbers}
+        if uidls is not None:
+            uidls = set(uidls)
+            selected &= {msg_num for msg_num, uidl in self.uidl_map.items() if uidl in uidls}
+        if larger_than is not None:
+            selected = {msg_num for msg_num in selected if self.message_sizes[msg_num] > larger_than}
+        if older_than is not None and selected:
+            if isinstance(older_than, (int, float)):
+                older_than = datetime.fromtimestamp(older_than)
+            # Даты без часового пояса считаются местным временем
+            if older_than.tzinfo is None:
+                older_than = older_than.astimezone()
+            sizes = [(msg_num, self.message_sizes[msg_num]) for msg_num in sorted(selected)]
+            selected = set()
+            for msg_num, _, headers in self._iter_headers(sizes):
+                try:
+                    date = parsedate_to_datetime((headers or {}).get('Date', ''))
+                except (TypeError, ValueError, IndexError):
+                    continue
+                if date.tzinfo is None:
+                    date = date.astimezone()
+                if date < older_than:
+                    selected.add(msg_num)
+        return sorted(selected)
+
+    def mark_for_deletion(self, msg_numbers=None, uidls=None, older_than=None, larger_than=None):
+        """
+        Помечает на удаление письма, отобранные select_messages, конвейерными
+        командами DELE. Письма удаляются только при commit_deletion (QUIT);
+        rollback_deletion снимает пометки. При обрыве соединения пометки
+        восстанавливаются в новой сессии. Возвращает число помеченных писем или None.
+        """
+        if not self.pop3_client or not self.check_pop3_auth():
+            return None
+
+        selected = self.select_messages(msg_numbers, uidls, older_than, larger_than)
+        if selected is None:
+            return None
+        selected = [msg_num for msg_num in selected if msg_num not in self.pending_deletes]
+
+        def mark():
+            numbers = {}
+            for msg_num in selected:
+                number = self._session_number(msg_num)
+                if number is not None:
+                    numbers[number] = msg_num
+            marked = self.pop3_client.delete_pipelined(sorted(numbers), self._pipeline_window())
+            return None if marked is None else [numbers[number] for number in marked]
+
+        try:
+            marked = self._with_reconnect(mark)
+        except Exception as e:
+            self.log_message(f"Ошибка при удалении писем: {str(e)}", "ОШИБКА:")
+            return None
+        if marked is None:
+            self.log_message("Не удалось пометить письма на удаление", "ОШИБКА:")
+            return None
+        self.pending_deletes.update(marked)
+        self.log_message(f"Помечено на удаление: {len(marked)}, всего: {len(self.pending_deletes)}", "ИНФО:")
+        return len(marked)
+
+    def rollback_deletion(self):
+        """Снимает все пометки на удаление командой RSET"""
+        if not self.pending_deletes:
+            return True
+        if not self.pop3_client or not self.check_pop3_auth():
+            # Сессия оборвалась - пометки сняты сервером
+            self.pending_deletes = set()
+            return False
+        response = self.pop3_client.send_command("RSET")
+        if response and response.startswith("+OK") or not self.pop3_client.connected:
+            self.pending_deletes = set()
+            return True
+        return False
+
+    def commit_deletion(self):
+        """
+        Подтверждает удаление помеченных писем: отправляет QUIT, после чего сервер
+        удаляет письма, и открывает новую сессию. Возвращает SyncResult с
+        изменениями списка (удаленные письма и сдвиг номеров) или None при ошибке.
+        """
+        if not self.pending_deletes:
+            return SyncResult()
+        if not self.pop3_client or not self.check_pop3_auth():
+            return None
+
+        count = len(self.pending_deletes)
+        response = self._with_reconnect(lambda: self.pop3_client.quit())
+        if not response or not response.startswith("+OK"):
+            # -ERR на QUIT означает, что часть писем сервер удалить не смог
+            self.log_message(f"Ошибка при удалении писем: {response}", "ОШИБКА:")
+        self.pending_deletes = set()
+
+        if not self._open_pop3_session(*self.pop3_settings) and not self._reconnect_pop3():
+            self.pop3_authenticated = False
+            return None
+        self.log_message(f"Удалено писем: {count}", "ИНФО:")
+        return self.sync_messages(reopen_session=False)
+
+    def delete_messages(self, msg_numbers=None, uidls=None, older_than=None, larger_than=None):
+        """Помечает письма на удаление и сразу подтверждает удаление; возвращает SyncResult или None"""
+        if self.mark_for_deletion(msg_numbers, uidls, older_than, larger_than) is None:
+            self.rollback_deletion()
+            return None
+        return self.commit_deletion()
+
+    def delete_message(self, msg_number):
+        return self.delete_messages([msg_number])
+
     def close(self):
-        if self.smtp_client:
-            if self.smtp_authenticated:
-                self.smtp_client.send_command("QUIT")
-            self.smtp_client.close()
         if self.pop3_client:
-            if self.pop3_authenticated:
-                self.pop3_client.send_command("QUIT")
+            # QUIT завершает сессию; помеченные письма при этом удаляются сервером
             self.pop3_client.close()
+            self.pending_deletes = set()
 
 
 def print_menu():
@@ -230,18 +1018,21 @@ def print_menu():
     print("4. Просмотреть список писем")
     print("5. Прочитать письмо")
     print("6. Удалить письмо")
+    print("7. Сохранить метрики")
+    print("8. Экспортировать ящик в архив")
     print("0. Выход")
 
 
 def main():
-    client = EmailClient()
+    client = EmailClient(cache=MessageCache())
 
     while True:
         print_menu()
-        choice = input("\nВыберите действие (0-6): ")
+        choice = input("\nВыберите действие (0-8): ")
 
         if choice == "0":
             client.close()
+            client.smtp_pool.close_all()
             print("Программа завершена")
             break
 
@@ -281,15 +1072,37 @@ def main():
             client.send_email(from_addr, to_addr, subject, message)
 
         elif choice == "4":
-            client.list_messages()
+            messages = client.list_messages()
+            for msg_num, msg_size, headers in messages or []:
+                headers = headers or {}
+                print(f"{msg_num}. {headers.get('From', '')} | {headers.get('Subject', '')} ({msg_size} байт)")
 
         elif choice == "5":
             msg_num = input("Введите номер сообщения: ")
-            client.read_message(msg_num)
+            content = client.read_message(msg_num)
+            print(content if content is not None else "Не удалось прочитать письмо")
 
         elif choice == "6":
-            msg_num = input("Введите номер сообщения для удаления: ")
-            client.delete_message(msg_num)
+            numbers = input("Введите номера сообщений для удаления (через пробел): ")
+            msg_numbers = [int(num) for num in numbers.replace(",", " ").split() if num.isdigit()]
+            result = client.delete_messages(msg_numbers) if msg_numbers else None
+            print(f"Удалено писем: {len(result.removed)}" if result is not None else "Письма не удалены")
+
+        elif choice == "7":
+            path = input("Файл метрик (.prom или .json): ") or "metrics.prom"
+            if path.endswith(".json"):
+                client.metrics.write_json(path)
+            else:
+                client.metrics.write_prometheus(path)
+            print(f"Метрики сохранены в {path}")
+
+        elif choice == "8":
+            target = input("Файл mbox или каталог Maildir: ")
+            fmt = 'maildir' if input("Формат (mbox/maildir): ").strip().lower() == 'maildir' else 'mbox'
+            connections = int(input("Число параллельных соединений: ") or 1)
+            stats = client.export_mailbox(target, fmt, connections)
+            if stats is not None:
+                print(f"Выгружено писем: {stats.exported}, пропущено: {stats.skipped}, ошибок: {stats.failed}")
 
         else:
             print("Неверный выбор. Попробуйте снова.")
@@ -0,0 +1,138 @@
+import json
+import sqlite3
+import threading
+import time
+
+
+class MessageCache:
+    """
+    Локальный кэш писем на диске (SQLite), ключ - сервер, пользователь и UIDL.
+    Хранит разобранные заголовки и исходные письма байтами, как они пришли
+    с сервера, - перекодирование потеряло бы 8bit-тела в других кодировках. Общий размер кэша
+    ограничен max_bytes: при превышении удаляются давно не использованные записи.
+    """
+
+    def __init__(self, path="message_cache.db", max_bytes=200 * 1024 * 1024):
+        self.path = path
+        self.max_bytes = max_bytes
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS messages (
+                server TEXT NOT NULL,
+                username TEXT NOT NULL,
+                uidl TEXT NOT NULL,
+                size INTEGER,
+                headers TEXT,
+                body BLOB,
+                stored_bytes INTEGER NOT NULL DEFAULT 0,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (server, username, uidl)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS messages_lru ON messages (last_access)")
+        # Прежние версии хранили письмо текстом, декодированным из UTF-8 с заменой
+        # ошибок; такие копии могут быть испорчены, их проще загрузить заново
+        self._conn.execute(
+            "UPDATE messages SET body = NULL, stored_bytes = COALESCE(LENGTH(headers), 0) "
+            "WHERE typeof(body) = 'text'")
+        self._conn.commit()
+
+    def get_headers(self, server, username, uidls):
+        """Возвращает словарь {uidl: заголовки} для писем, заголовки которых есть в кэше"""
+        result = {}
+        uidls = list(uidls)
+        with self._lock:
+            # Запрашиваем пачками, чтобы не упереться в лимит параметров SQLite
+            for start in range(0, len(uidls), 500):
+                batch = uidls[start:start + 500]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT uidl, headers FROM messages WHERE server = ? AND username = ? "
+                    f"AND headers IS NOT NULL AND uidl IN ({placeholders})",
+                    [server, username] + batch)
+                for uidl, headers in rows:
+                    result[uidl] = json.loads(headers)
+            self._touch(server, username, result.keys())
+        return result
+
+    def put_headers(self, server, username, entries):
+        """Сохраняет заголовки; entries - итерируемое из кортежей (uidl, размер, заголовки)"""
+        now = time.time()
+        with self._lock:
+            for uidl, size, headers in entries:
+                headers_json = json.dumps(headers, ensure_ascii=False)
+                self._conn.execute(
+                    "INSERT INTO messages (server, username, uidl, size, headers, stored_bytes, last_access) "
+                    "VALUES (?, ?, ?, ?, ?, ?, ?) "
+                    "ON CONFLICT (server, username, uidl) DO UPDATE SET "
+                    "size = excluded.size, headers = excluded.headers, last_access = excluded.last_access, "
+                    "stored_bytes = LENGTH(excluded.headers) + COALESCE(LENGTH(messages.body), 0)",
+                    (server, username, uidl, size, headers_json, len(headers_json), now))
+            self._evict()
+            self._conn.commit()
+
+    def get_body(self, server, username, uidl):
+        """Возвращает исходное письмо (bytes) из кэша или None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT body FROM messages WHERE server = ? AND username = ? AND uidl = ? AND body IS NOT NULL",
+                (server, username, uidl)).fetchone()
+            if not row:
+                return None
+            self._touch(server, username, [uidl])
+        return bytes(row[0])
+
+    def put_body(self, server, username, uidl, body):
+        """Сохраняет исходное письмо; body - bytes в том виде, в каком письмо получено"""
+        body = sqlite3.Binary(body)
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO messages (server, username, uidl, body, stored_bytes, last_access) "
+                "VALUES (?, ?, ?, ?, ?, ?) "
+                "ON CONFLICT (server, username, uidl) DO UPDATE SET "
+                "body = excluded.body, last_access = excluded.last_access, "
+                "stored_bytes = LENGTH(excluded.body) + COALESCE(LENGTH(messages.headers), 0)",
+                (server, username, uidl, body, len(body), time.time()))
+            self._evict()
+            self._conn.commit()
+
+    def forget_missing(self, server, username, live_uidls):
+        """Удаляет из кэша письма, которых больше нет на сервере"""
+        live_uidls = set(live_uidls)
+        with self._lock:
+            cached = [row[0] for row in self._conn.execute(
+                "SELECT uidl FROM messages WHERE server = ? AND username = ?", (server, username))]
+            missing = [(server, username, uidl) for uidl in cached if uidl not in live_uidls]
+            if missing:
+                self._conn.executemany(
+                    "DELETE FROM messages WHERE server = ? AND username = ? AND uidl = ?", missing)
+                self._conn.commit()
+        return len(missing)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
+
+    def _touch(self, server, username, uidls):
+        """Обновляет время последнего обращения для LRU"""
+        now = time.time()
+        self._conn.executemany(
+            "UPDATE messages SET last_access = ? WHERE server = ? AND username = ? AND uidl = ?",
+            [(now, server, username, uidl) for uidl in uidls])
+        self._conn.commit()
+
+    def _evict(self):
+        """Удаляет самые старые по обращению записи, пока кэш не уложится в max_bytes"""
+        total = self._conn.execute("SELECT COALESCE(SUM(stored_bytes), 0) FROM messages").fetchone()[0]
+        if total <= self.max_bytes:
+            return
+        rows = self._conn.execute(
+            "SELECT rowid, stored_bytes FROM messages ORDER BY last_access")
+        victims = []
+        for rowid, stored_bytes in rows:
+            if total <= self.max_bytes:
+                break
+            victims.append((rowid,))
+            total -= stored_bytes
+        self._conn.executemany("DELETE FROM messages WHERE rowid = ?", victims)
@@ -0,0 +1,167 @@
+import os
+import tempfile
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from email_decoder import EmailDecoder
+
+
+class ParsedMessage:
+    """Результат разбора письма в пуле процессов"""
+
+    def __init__(self, msg_number, size=0, headers=None, text=None, attachments=None, error=None):
+        self.msg_number = msg_number
+        self.size = size
+        self.headers = headers or {}
+        self.text = text
+        # Описания вложений: словари с ключами filename, content_type, size
+        self.attachments = attachments or []
+        self.error = error
+
+    @property
+    def success(self):
+        return self.error is None
+
+
+def parse_raw_message(msg_number, source):
+    """
+    Разбирает письмо в рабочем процессе: заголовки, текст и список вложений.
+    source - байты письма или путь к временному файлу с ним.
+    Функция выполняется в дочернем процессе, поэтому находится на уровне модуля.
+    """
+    try:
+        size = len(source) if isinstance(source, bytes) else os.path.getsize(source)
+        with EmailDecoder.parse_message(source) as message:
+            headers = {name: message.get_header(name) for name in dict.fromkeys(message.headers.keys())}
+            attachments = [{'filename': part.filename, 'content_type': part.content_type, 'size': part.size}
+                           for part in message.attachments]
+            return ParsedMessage(msg_number, size, headers, EmailDecoder.body_text(message), attachments)
+    except Exception as e:
+        return ParsedMessage(msg_number, error=str(e))
+
+
+class ParsePipeline:
+    """
+    Конвейер массового разбора писем: загрузка по POP3 идет в вызывающем потоке,
+    а MIME-разбор и подбор кодировок - в пуле процессов, так что сеть и разбор
+    перекрываются и разбор не упирается в GIL.
+
+    Одновременно в разборе находится не более max_pending писем: когда очередь
+    заполнена, загрузка ждет готовности самого старого письма. Письма крупнее
+    spool_threshold передаются процессам через временный файл, а не копией в памяти.
+    При workers=1 (например, на одноядерной машине) пул не создается и письма
+    разбираются в вызывающем потоке - передача между процессами не окупилась бы.
+    """
+
+    def __init__(self, email_client, workers=None, max_pending=None, spool_threshold=None):
+        self.email_client = email_client
+        self.workers = workers or os.cpu_count() or 2
+        self.max_pending = max_pending or self.workers * 2
+        self.spool_threshold = spool_threshold or email_client.spool_threshold
+        self.executor = None
+
+    def _fetch(self, msg_number):
+        """
+        Загружает исходный текст письма: из кэша или командой RETR.
+        Возвращает (байты или путь к временному файлу, признак временного файла) или None.
+        """
+        client = self.email_client
+        uidl = client._message_uidl(msg_number)
+        if uidl:
+            cached = client.cache.get_body(client.pop3_server, client.pop3_username, uidl)
+            if cached is not None:
+                return cached, False
+
+        # Крупное по LIST письмо сразу пишется в файл, который получит рабочий процесс
+        if client.message_sizes.get(int(msg_number), 0) > self.spool_threshold:
+            with tempfile.NamedTemporaryFile(suffix=".eml", delete=False) as f:
+                size = client.download_message(msg_number, f)
+            if not size:
+                os.remove(f.name)
+                return None
+            return f.name, True
+
+        with tempfile.SpooledTemporaryFile(max_size=self.spool_threshold) as spool:
+            size = client.download_message(msg_number, spool)
+            if not size:
+                return None
+            spool.seek(0)
+            if size <= self.spool_threshold:
+                return spool.read(), False
+
+            # Размер из LIST оказался заниженным: письмо уже во временном файле спула
+            with tempfile.NamedTemporaryFile(suffix=".eml", delete=False) as f:
+                while True:
+                    chunk = spool.read(65536)
+                    if not chunk:
+                        break
+                    f.write(chunk)
+            return f.name, True
+
+    def run(self, msg_numbers):
+        """
+        Генератор ParsedMessage для писем msg_numbers в порядке номеров.
+        Письмо, которое не удалось загрузить или разобрать, возвращается с заполненным error.
+        """
+        if self.workers <= 1:
+            yield from self._run_inline(msg_numbers)
+            return
+
+        if self.executor is None:
+            self.executor = ProcessPoolExecutor(max_workers=self.workers)
+
+        # Очередь (номер, future, временный файл) ограничена max_pending
+        pending = deque()
+        try:
+            for msg_number in msg_numbers:
+                if len(pending) >= self.max_pending:
+                    yield self._collect(pending.popleft())
+
+                fetched = self._fetch(msg_number)
+                if fetched is None:
+                    pending.append((msg_number, None, None))
+                    continue
+                source, is_file = fetched
+                future = self.executor.submit(parse_raw_message, msg_number, source)
+                pending.append((msg_number, future, source if is_file else None))
+
+            while pending:
+                yield self._collect(pending.popleft())
+        finally:
+            # Генератор закрыт досрочно: дожидаемся отправленных задач и убираем файлы
+            while pending:
+                self._collect(pending.popleft())
+
+    def _run_inline(self, msg_numbers):
+        for msg_number in msg_numbers:
+            fetched = self._fetch(msg_number)
+            if fetched is None:
+                yield ParsedMessage(msg_number, error="Не удалось загрузить письмо")
+                continue
+            source, is_file = fetched
+            try:
+                parsed = parse_raw_message(msg_number, source)
+            finally:
+                if is_file:
+                    os.remove(source)
+            yield parsed
+
+    def _collect(self, entry):
+        msg_number, future, temp_path = entry
+        try:
+            if future is None:
+                return ParsedMessage(msg_number, error="Не удалось загрузить письмо")
+            try:
+                return future.result()
+            except Exception as e:
+                return ParsedMessage(msg_number, error=str(e))
+        finally:
+            if temp_path:
+                try:
+                    os.remove(temp_path)
+                except OSError:
+                    pass
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown()
+            self.executor = None
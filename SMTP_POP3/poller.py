@@ -0,0 +1,310 @@
+import heapq
+import json
+import logging
+import os
+import random
+import tempfile
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime
+from POP3.main import POP3Client
+from common.log import get_logger
+from email_decoder import EmailDecoder
+
+
+class AccountConfig:
+    """Параметры одного почтового ящика для опроса"""
+
+    def __init__(self, name, server, port, username, password, use_ssl=True, interval=300):
+        self.name = name
+        self.server = server
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_ssl = use_ssl
+        self.interval = interval
+
+
+class AccountStats:
+    """Накопленная статистика опроса одного ящика"""
+
+    def __init__(self):
+        self.polls = 0
+        self.errors = 0
+        self.messages = 0
+        self.bytes = 0
+        self.busy_time = 0.0
+        self.last_poll = None
+        self.last_error = None
+
+    def as_dict(self):
+        return {
+            'polls': self.polls,
+            'errors': self.errors,
+            'messages': self.messages,
+            'bytes': self.bytes,
+            'busy_time': round(self.busy_time, 3),
+            'messages_per_sec': round(self.messages / self.busy_time, 2) if self.busy_time else 0.0,
+            'bytes_per_sec': round(self.bytes / self.busy_time, 1) if self.busy_time else 0.0,
+            'last_poll': self.last_poll,
+            'last_error': self.last_error,
+        }
+
+
+class MailboxPoller:
+    """
+    Периодически опрашивает несколько почтовых ящиков в общем пуле потоков.
+
+    Число одновременных сессий к одному серверу ограничено per_server_limit:
+    ящик, сервер которого занят, ждет в очереди этого сервера и не занимает
+    поток пула, поэтому ящики других серверов опрашиваются без задержки.
+    Интервалы опроса случайно сдвигаются на долю jitter, чтобы ящики одного
+    сервера не опрашивались синхронно. Для каждого нового письма (по UIDL)
+    вызывается on_message(account, uidl, headers, content).
+
+    Уже полученные UIDL сохраняются в state_path (JSON), чтобы после
+    перезапуска старые письма не считались новыми; None - хранить только в памяти.
+    """
+
+    def __init__(self, accounts, max_workers=8, per_server_limit=2, jitter=0.1,
+                 on_message=None, client_factory=POP3Client, state_path="poller_state.json"):
+        self.accounts = list(accounts)
+        self.max_workers = max_workers
+        self.per_server_limit = per_server_limit
+        self.jitter = jitter
+        self.on_message = on_message
+        self.client_factory = client_factory
+        self.state_path = state_path
+        self.stats = {account.name: AccountStats() for account in self.accounts}
+        self._seen_uidls = {account.name: set() for account in self.accounts}
+        # Число идущих сессий и очередь ожидающих ящиков по серверам
+        self._server_active = {}
+        self._server_waiting = {}
+        # Ящики, опрос которых запущен или ждет в очереди сервера
+        self._in_flight = set()
+        # Повторно захватывается из _finish, если опрос завершился еще при запуске
+        self._lock = threading.RLock()
+        self._state_lock = threading.Lock()
+        self._stop_event = threading.Event()
+        self._executor = None
+        self._scheduler = None
+        self.logger = get_logger("poller")
+        self._load_state()
+
+    def log_message(self, message, level="ИНФО:"):
+        """Записывает сообщение в общий журнал"""
+        self.logger.log(logging.ERROR if level == "ОШИБКА:" else logging.INFO, message)
+
+    @staticmethod
+    def _state_key(account):
+        return f"{account.username}@{account.server}:{account.port}"
+
+    def _load_state(self):
+        """Загружает UIDL, полученные при прошлых запусках"""
+        if not self.state_path or not os.path.exists(self.state_path):
+            return
+        try:
+            with open(self.state_path, encoding='utf-8') as f:
+                state = json.load(f)
+        except (OSError, ValueError) as e:
+            self.log_message(f"Не удалось прочитать состояние опроса {self.state_path}: {str(e)}", "ОШИБКА:")
+            return
+        for account in self.accounts:
+            self._seen_uidls[account.name].update(state.get(self._state_key(account), []))
+
+    def _save_state(self):
+        """Записывает полученные UIDL всех ящиков; файл заменяется атомарно"""
+        if not self.state_path:
+            return
+        with self._state_lock:
+            state = {self._state_key(account): sorted(self._seen_uidls[account.name])
+                     for account in self.accounts}
+            directory = os.path.dirname(os.path.abspath(self.state_path))
+            try:
+                with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=directory,
+                                                 suffix=".tmp", delete=False) as f:
+                    json.dump(state, f, ensure_ascii=False)
+                os.replace(f.name, self.state_path)
+            except OSError as e:
+                self.log_message(f"Не удалось сохранить состояние опроса {self.state_path}: {str(e)}", "ОШИБКА:")
+
+    def _next_delay(self, account):
+        """Интервал до следующего опроса со случайным сдвигом"""
+        return account.interval * (1 + random.uniform(-self.jitter, self.jitter))
+
+    def poll_account(self, account):
+        """
+        Выполняет один опрос ящика: подключается, получает UIDL и скачивает
+        только письма, которые еще не встречались. Возвращает число новых писем.
+        """
+        stats = self.stats[account.name]
+        # Рабочая копия: общий словарь читается при сохранении состояния из других потоков
+        seen = set(self._seen_uidls[account.name])
+        started = time.monotonic()
+        new_messages = 0
+        client = None
+
+        try:
+            client = self.client_factory(account.server, account.port, account.use_ssl)
+            if not client.connect():
+                raise ConnectionError("не удалось подключиться")
+
+            for command in (f"USER {account.username}", f"PASS {account.password}"):
+                response = client.send_command(command)
+                if not response or "+OK" not in response:
+                    raise PermissionError("ошибка аутентификации")
+
+            uidl_map = client.get_uidl_map()
+            if uidl_map is None:
+                raise RuntimeError("сервер не ответил на UIDL")
+
+            for msg_num, uidl in sorted(uidl_map.items()):
+                if uidl in seen:
+                    continue
+                # Письмо принимается байтами, без перекодирования: кодировку определяет декодер
+                with tempfile.SpooledTemporaryFile(max_size=1024 * 1024) as spool:
+                    size = client.retrieve_to(msg_num, spool)
+                    if size is None:
+                        if not client.connected:
+                            raise ConnectionError("соединение прервано при получении письма")
+                        continue
+
+                    spool.seek(0)
+                    header_lines = []
+                    for line in spool:
+                        if line in (b"\r\n", b"\n"):
+                            break
+                        header_lines.append(line)
+                    headers = EmailDecoder.parse_headers(b"".join(header_lines).decode('utf-8', errors='replace'))
+                    spool.seek(0)
+                    content = EmailDecoder.decode_message_stream(spool)
+                if self.on_message:
+                    self.on_message(account, uidl, headers, content)
+
+                seen.add(uidl)
+                new_messages += 1
+                stats.bytes += size
+
+            # Забываем UIDL писем, удаленных с сервера
+            seen.intersection_update(uidl_map.values())
+        except Exception as e:
+            stats.errors += 1
+            stats.last_error = str(e)
+            self.log_message(f"Ошибка опроса ящика {account.name}: {str(e)}", "ОШИБКА:")
+        finally:
+            if client and client.connected:
+                client.close()
+            stats.messages += new_messages
+            stats.polls += 1
+            stats.busy_time += time.monotonic() - started
+            stats.last_poll = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            with self._state_lock:
+                self._seen_uidls[account.name] = seen
+            self._save_state()
+
+        if new_messages:
+            self.log_message(f"Ящик {account.name}: новых писем {new_messages}", "ИНФО:")
+        return new_messages
+
+    def poll_all(self):
+        """Однократно опрашивает все ящики в пуле потоков и ждет завершения"""
+        results = {}
+        done = threading.Event()
+
+        def collect(account, future):
+            results[account.name] = future.result()
+            if len(results) == len(self.accounts):
+                done.set()
+
+        if not self.accounts:
+            return results
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            with self._lock:
+                for account in self.accounts:
+                    self._submit(account, executor, collect)
+            done.wait()
+        return {account.name: results[account.name] for account in self.accounts}
+
+    def _submit(self, account, executor, callback=None):
+        """
+        Запускает опрос ящика в пуле, если у его сервера есть свободная сессия,
+        иначе ставит ящик в очередь сервера. Вызывается под self._lock.
+        callback(account, future) вызывается после завершения опроса.
+        """
+        key = (account.server, account.port)
+        self._in_flight.add(account.name)
+        if self._server_active.get(key, 0) >= self.per_server_limit:
+            self._server_waiting.setdefault(key, deque()).append((account, executor, callback))
+            return
+        try:
+            future = executor.submit(self.poll_account, account)
+        except RuntimeError:
+            # Пул уже остановлен (stop): опрос не запускается
+            self._in_flight.discard(account.name)
+            return
+        self._server_active[key] = self._server_active.get(key, 0) + 1
+        future.add_done_callback(lambda f: self._finish(account, f, callback))
+
+    def start(self):
+        """Запускает периодический опрос в фоновом потоке"""
+        if self._scheduler:
+            return
+        self._stop_event.clear()
+        self._executor = ThreadPoolExecutor(max_workers=self.max_workers)
+        self._scheduler = threading.Thread(target=self._run_scheduler, daemon=True)
+        self._scheduler.start()
+
+    def stop(self, wait=True):
+        """Останавливает опрос; при wait=True дожидается текущих сессий"""
+        self._stop_event.set()
+        if self._scheduler:
+            self._scheduler.join()
+            self._scheduler = None
+        if self._executor:
+            self._executor.shutdown(wait=wait)
+            self._executor = None
+        # Ящики, ждавшие освобождения сервера, так и не были запущены
+        with self._lock:
+            for waiting in self._server_waiting.values():
+                for account, _, _ in waiting:
+                    self._in_flight.discard(account.name)
+                waiting.clear()
+
+    def _run_scheduler(self):
+        # Первые опросы распределяем по доле интервала, чтобы не стартовать все сразу
+        queue = [(time.monotonic() + random.uniform(0, account.interval * self.jitter), i)
+                 for i, account in enumerate(self.accounts)]
+        heapq.heapify(queue)
+
+        while queue and not self._stop_event.is_set():
+            due, index = queue[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._stop_event.wait(min(delay, 1.0))
+                continue
+
+            heapq.heappop(queue)
+            account = self.accounts[index]
+            with self._lock:
+                # Не запускаем новый опрос ящика, пока не закончился или ждет очереди предыдущий
+                if account.name not in self._in_flight:
+                    self._submit(account, self._executor)
+            heapq.heappush(queue, (time.monotonic() + self._next_delay(account), index))
+
+    def _finish(self, account, future, callback):
+        """Освобождает сессию сервера и запускает следующий ящик из его очереди"""
+        key = (account.server, account.port)
+        with self._lock:
+            self._in_flight.discard(account.name)
+            self._server_active[key] -= 1
+            waiting = self._server_waiting.get(key)
+            if waiting:
+                self._submit(*waiting.popleft())
+        if callback:
+            callback(account, future)
+
+    def get_stats(self):
+        """Возвращает статистику по всем ящикам в виде словаря"""
+        return {name: stats.as_dict() for name, stats in self.stats.items()}
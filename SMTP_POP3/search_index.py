@@ -0,0 +1,204 @@
+import re
+import sqlite3
+import threading
+from datetime import datetime
+from email.utils import parsedate_to_datetime
+
+# Слова запроса: буквы и цифры любых алфавитов, как их выделяет токенизатор unicode61
+_WORD_RE = re.compile(r"\w+", re.UNICODE)
+
+
+def _parse_date(value):
+    """Переводит значение заголовка Date в отметку времени или None"""
+    if not value:
+        return None
+    try:
+        return parsedate_to_datetime(value).timestamp()
+    except (TypeError, ValueError, IndexError, OverflowError):
+        return None
+
+
+def _match_terms(text, column=None):
+    """
+    Строит выражение FTS5 из слов text: каждое слово ищется как префикс,
+    слова объединяются через AND. Служебный синтаксис FTS5 в запросе
+    пользователя не интерпретируется - слова берутся в кавычки.
+    """
+    terms = []
+    for word in _WORD_RE.findall(text or ""):
+        term = f'"{word}"*'
+        terms.append(f"{column} : {term}" if column else term)
+    return terms
+
+
+class SearchIndex:
+    """
+    Локальный полнотекстовый индекс писем на SQLite FTS5, ключ - сервер,
+    пользователь и UIDL. Индекс пополняется по мере получения заголовков и
+    разбора писем и позволяет искать по теме, отправителю, тексту и диапазону
+    дат без обращения к серверу.
+
+    Метаданные (тема, отправитель, дата) хранятся в обычной таблице с индексом
+    по дате, слова темы, отправителя и текста - в таблице FTS5 с тем же rowid.
+    """
+
+    def __init__(self, path="search_index.db"):
+        self.path = path
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("""
+            CREATE TABLE IF NOT EXISTS documents (
+                id INTEGER PRIMARY KEY,
+                server TEXT NOT NULL,
+                username TEXT NOT NULL,
+                uidl TEXT NOT NULL,
+                size INTEGER NOT NULL DEFAULT 0,
+                subject TEXT NOT NULL DEFAULT '',
+                sender TEXT NOT NULL DEFAULT '',
+                date_text TEXT NOT NULL DEFAULT '',
+                date REAL,
+                has_body INTEGER NOT NULL DEFAULT 0,
+                UNIQUE (server, username, uidl)
+            )
+        """)
+        self._conn.execute("CREATE INDEX IF NOT EXISTS documents_date ON documents (server, username, date)")
+        # Префиксные индексы ускоряют поиск по началу слова, remove_diacritics - без учета ударений и ё
+        self._conn.execute("""
+            CREATE VIRTUAL TABLE IF NOT EXISTS documents_fts USING fts5(
+                subject, sender, body,
+                tokenize = 'unicode61 remove_diacritics 2',
+                prefix = '2 3'
+            )
+        """)
+        self._conn.commit()
+
+    def put_headers(self, server, username, entries):
+        """Добавляет или обновляет заголовки; entries - итерируемое из кортежей (uidl, размер, заголовки)"""
+        with self._lock:
+            for uidl, size, headers in entries:
+                self._put(server, username, uidl, size, headers, None)
+            self._conn.commit()
+
+    def put_messages(self, server, username, entries):
+        """
+        Добавляет разобранные письма одной транзакцией;
+        entries - итерируемое из кортежей (uidl, размер, заголовки, текст).
+        """
+        with self._lock:
+            for uidl, size, headers, body in entries:
+                self._put(server, username, uidl, size, headers, body or "")
+            self._conn.commit()
+
+    def _put(self, server, username, uidl, size, headers, body):
+        subject = headers.get('Subject', '')
+        sender = headers.get('From', '')
+        date_text = headers.get('Date', '')
+        self._conn.execute(
+            "INSERT INTO documents (server, username, uidl, size, subject, sender, date_text, date, has_body) "
+            "VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?) "
+            "ON CONFLICT (server, username, uidl) DO UPDATE SET "
+            "size = excluded.size, subject = excluded.subject, sender = excluded.sender, "
+            "date_text = excluded.date_text, date = excluded.date, "
+            "has_body = MAX(documents.has_body, excluded.has_body)",
+            (server, username, uidl, size or 0, subject, sender, date_text, _parse_date(date_text),
+             int(body is not None)))
+        rowid = self._conn.execute(
+            "SELECT id FROM documents WHERE server = ? AND username = ? AND uidl = ?",
+            (server, username, uidl)).fetchone()[0]
+
+        # Обновление только заголовков не затирает уже проиндексированный текст
+        if body is None:
+            updated = self._conn.execute(
+                "UPDATE documents_fts SET subject = ?, sender = ? WHERE rowid = ?", (subject, sender, rowid))
+        else:
+            updated = self._conn.execute(
+                "UPDATE documents_fts SET subject = ?, sender = ?, body = ? WHERE rowid = ?",
+                (subject, sender, body, rowid))
+        if not updated.rowcount:
+            self._conn.execute(
+                "INSERT INTO documents_fts (rowid, subject, sender, body) VALUES (?, ?, ?, ?)",
+                (rowid, subject, sender, body or ""))
+
+    def indexed_uidls(self, server, username, with_body=True):
+        """Возвращает множество UIDL, уже попавших в индекс (по умолчанию - вместе с текстом)"""
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT uidl FROM documents WHERE server = ? AND username = ? AND has_body >= ?",
+                (server, username, int(with_body)))
+            return {row[0] for row in rows}
+
+    def search(self, server, username, text=None, subject=None, sender=None,
+               date_from=None, date_to=None, limit=200):
+        """
+        Ищет письма ящика. text ищется в теме, отправителе и тексте письма,
+        subject и sender - только в соответствующем поле; слова совпадают по
+        началу. date_from и date_to (datetime или отметка времени) задают
+        полуинтервал [date_from, date_to). Возвращает список кортежей
+        (uidl, размер, заголовки) от новых писем к старым.
+        """
+        terms = _match_terms(text) + _match_terms(subject, "subject") + _match_terms(sender, "sender")
+        sql = ("SELECT uidl, size, subject, sender, date_text FROM documents "
+               "WHERE server = ? AND username = ?")
+        params = [server, username]
+        if terms:
+            sql += " AND id IN (SELECT rowid FROM documents_fts WHERE documents_fts MATCH ?)"
+            params.append(" AND ".join(terms))
+        if date_from is not None:
+            sql += " AND date >= ?"
+            params.append(date_from.timestamp() if isinstance(date_from, datetime) else date_from)
+        if date_to is not None:
+            sql += " AND date < ?"
+            params.append(date_to.timestamp() if isinstance(date_to, datetime) else date_to)
+        sql += " ORDER BY date DESC LIMIT ?"
+        params.append(limit)
+
+        with self._lock:
+            rows = self._conn.execute(sql, params).fetchall()
+        return [(uidl, size, {'Subject': subject, 'From': sender, 'Date': date_text})
+                for uidl, size, subject, sender, date_text in rows]
+
+    @staticmethod
+    def parse_query(query):
+        """
+        Разбирает строку поиска в аргументы search(): слова вида from:адрес,
+        subject:слово, after:ГГГГ-ММ-ДД и before:ГГГГ-ММ-ДД задают фильтры,
+        остальные слова ищутся во всех полях.
+        """
+        fields = {'from': [], 'subject': [], 'text': []}
+        dates = {}
+        for token in (query or "").split():
+            key, sep, value = token.partition(":")
+            key = key.lower()
+            if sep and key in ('from', 'subject') and value:
+                fields[key].append(value)
+            elif sep and key in ('after', 'before') and value:
+                try:
+                    dates[key] = datetime.strptime(value, "%Y-%m-%d")
+                except ValueError:
+                    fields['text'].append(token)
+            else:
+                fields['text'].append(token)
+        return {
+            'text': " ".join(fields['text']) or None,
+            'subject': " ".join(fields['subject']) or None,
+            'sender': " ".join(fields['from']) or None,
+            'date_from': dates.get('after'),
+            'date_to': dates.get('before'),
+        }
+
+    def forget_missing(self, server, username, live_uidls):
+        """Удаляет из индекса письма, которых больше нет на сервере"""
+        live_uidls = set(live_uidls)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id, uidl FROM documents WHERE server = ? AND username = ?", (server, username))
+            missing = [(rowid,) for rowid, uidl in rows if uidl not in live_uidls]
+            if missing:
+                self._conn.executemany("DELETE FROM documents_fts WHERE rowid = ?", missing)
+                self._conn.executemany("DELETE FROM documents WHERE id = ?", missing)
+                self._conn.commit()
+        return len(missing)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
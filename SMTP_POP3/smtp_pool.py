@@ -0,0 +1,142 @@
+import hashlib
+import logging
+import threading
+import time
+from SMTP.main import SMTPClient
+from common.log import get_logger
+
+
+class SMTPConnectionPool:
+    """
+    Потокобезопасный пул аутентифицированных SMTP соединений.
+
+    Соединения группируются по ключу (сервер, порт, пользователь, хэш учетных
+    данных, TLS): соединение, открытое с одним паролем, не выдается по другому.
+    На каждый ключ открывается не более max_size сессий. Простаивающие дольше idle_timeout
+    соединения закрываются, а перед выдачей соединения, простоявшего дольше
+    health_check_after секунд, его проверяют командой NOOP и при сбое заменяют новым.
+    """
+
+    def __init__(self, max_size=4, idle_timeout=120, health_check_after=5, acquire_timeout=30,
+                 client_factory=SMTPClient):
+        self.max_size = max_size
+        self.idle_timeout = idle_timeout
+        self.health_check_after = health_check_after
+        self.acquire_timeout = acquire_timeout
+        self.client_factory = client_factory
+        self._idle = {}
+        self._open = {}
+        self._condition = threading.Condition()
+        self.logger = get_logger("smtp_pool")
+
+    def log_message(self, message, level="ИНФО:"):
+        """Записывает сообщение в общий журнал"""
+        self.logger.log(logging.ERROR if level == "ОШИБКА:" else logging.INFO, message)
+
+    def acquire(self, server, port, username, password, use_tls=True):
+        """
+        Выдает соединение из пула или открывает новое.
+        Если все max_size соединений заняты, ждет освобождения не дольше acquire_timeout.
+        """
+        credentials = hashlib.sha256(f"{username}\0{password}".encode('utf-8')).hexdigest()
+        key = (server, port, username, credentials, use_tls)
+        deadline = time.monotonic() + self.acquire_timeout
+        self._close_expired()
+
+        with self._condition:
+            while True:
+                idle = self._idle.get(key)
+                if idle:
+                    client, last_used = idle.pop()
+                    break
+                if self._open.get(key, 0) < self.max_size:
+                    # Резервируем место под новое соединение до его открытия
+                    self._open[key] = self._open.get(key, 0) + 1
+                    client, last_used = None, None
+                    break
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    raise TimeoutError(f"нет свободных SMTP соединений к {server}:{port}")
+                self._condition.wait(remaining)
+
+        if client is not None and time.monotonic() - last_used > self.health_check_after:
+            if client.reply_code(client.send_command("NOOP")) != 250:
+                self.log_message(f"Соединение к {server}:{port} неисправно, открываем новое", "ОШИБКА:")
+                client.close()
+                client = None
+
+        if client is None:
+            try:
+                client = self._open_connection(server, port, username, password, use_tls)
+            except Exception:
+                self._forget(key)
+                raise
+
+        client.pool_key = key
+        return client
+
+    def release(self, client, broken=False):
+        """Возвращает соединение в пул; неисправное соединение закрывается"""
+        key = client.pool_key
+        if broken:
+            client.close()
+            self._forget(key)
+            return
+
+        with self._condition:
+            self._idle.setdefault(key, []).append((client, time.monotonic()))
+            self._condition.notify()
+
+    def close_all(self):
+        """Закрывает все простаивающие соединения"""
+        with self._condition:
+            idle = [client for entries in self._idle.values() for client, _ in entries]
+            for key, entries in self._idle.items():
+                self._open[key] -= len(entries)
+            self._idle = {}
+            self._condition.notify_all()
+        for client in idle:
+            self._quit(client)
+
+    def _open_connection(self, server, port, username, password, use_tls):
+        client = self.client_factory()
+        if not client.connect(server, port, use_tls):
+            raise ConnectionError(f"не удалось подключиться к {server}:{port}")
+        if not client.authenticate(username, password):
+            client.close()
+            raise PermissionError("ошибка аутентификации SMTP")
+        self.log_message(f"Открыто SMTP соединение к {server}:{port} для {username}", "ИНФО:")
+        return client
+
+    def _forget(self, key):
+        """Освобождает место закрытого соединения и будит ожидающие потоки"""
+        with self._condition:
+            self._open[key] -= 1
+            self._condition.notify()
+
+    def _close_expired(self):
+        """Закрывает соединения, простаивающие дольше idle_timeout"""
+        now = time.monotonic()
+        expired = []
+        with self._condition:
+            for key, entries in self._idle.items():
+                alive = [(client, last_used) for client, last_used in entries
+                         if now - last_used <= self.idle_timeout]
+                expired.extend(client for client, last_used in entries if now - last_used > self.idle_timeout)
+                self._open[key] -= len(entries) - len(alive)
+                self._idle[key] = alive
+            if expired:
+                self._condition.notify_all()
+        for client in expired:
+            self._quit(client)
+
+    @staticmethod
+    def _quit(client):
+        try:
+            client.send_command("QUIT")
+        finally:
+            client.close()
+
+
+# Общий пул, которым по умолчанию пользуются все экземпляры EmailClient
+shared_pool = SMTPConnectionPool()
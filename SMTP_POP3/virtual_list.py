@@ -0,0 +1,171 @@
+from tkinter import ttk
+
+
+class VirtualMessageList:
+    """
+    Виртуализированный список писем для больших почтовых ящиков.
+
+    Treeview всегда содержит только видимые строки; полоса прокрутки управляет
+    смещением окна в полном списке (номер, размер), полученном из LIST.
+    Выделение нескольких писем сохраняется и для строк, ушедших из окна.
+    Для строк в окне и запасе prefetch вокруг него вызывается
+    on_need_headers(номера) - заголовки подгружаются лениво и передаются
+    обратно через set_headers.
+    """
+
+    def __init__(self, parent, columns, format_row, on_need_headers, prefetch=50):
+        self.columns = columns
+        self.format_row = format_row
+        self.on_need_headers = on_need_headers
+        self.prefetch = prefetch
+
+        self.tree = ttk.Treeview(parent, columns=columns, show='headings', selectmode='extended')
+        self.scrollbar = ttk.Scrollbar(parent, orient="vertical", command=self._on_scrollbar)
+
+        self.rows = []
+        self.headers = {}
+        self.requested = set()
+        # Номера писем в окне с запасом; читается и из фонового потока, поэтому без обращений к Tk
+        self.wanted = set()
+        self.offset = 0
+        # Номера выделенных писем, в том числе не попавших в видимое окно
+        self.selection = set()
+
+        # Прокрутка колесом мыши (Windows/macOS и X11) и клавишами
+        self.tree.bind('<MouseWheel>', lambda e: self.scroll(-1 if e.delta > 0 else 1, 'units'))
+        self.tree.bind('<Button-4>', lambda e: self.scroll(-1, 'units'))
+        self.tree.bind('<Button-5>', lambda e: self.scroll(1, 'units'))
+        self.tree.bind('<Prior>', lambda e: self.scroll(-1, 'pages'))
+        self.tree.bind('<Next>', lambda e: self.scroll(1, 'pages'))
+        self.tree.bind('<Configure>', lambda e: self.render())
+        self.tree.bind('<<TreeviewSelect>>', self._remember_selection, add='+')
+
+    def pack(self):
+        self.tree.pack(side='left', fill='both', expand=True, padx=(5, 0), pady=5)
+        self.scrollbar.pack(side='right', fill='y', padx=(0, 5), pady=5)
+
+    def set_messages(self, rows, headers=None):
+        """
+        Задает полный список писем: последовательность пар (номер, размер).
+        headers - уже известные заголовки {номер: заголовки}, для них запрос не выполняется.
+        """
+        self.rows = list(rows)
+        self.headers = dict(headers or {})
+        self.requested = set()
+        self.offset = 0
+        self.selection = set()
+        self.render()
+
+    def set_headers(self, headers_by_number):
+        """Сохраняет подгруженные заголовки и перерисовывает окно, если они в нем видны"""
+        self.headers.update(headers_by_number)
+        start, end = self._window()
+        if any(msg_num in headers_by_number for msg_num, _ in self.rows[start:end]):
+            self.render()
+
+    def release_requests(self, msg_numbers):
+        """Разрешает повторный запрос заголовков, которые не были загружены"""
+        self.requested.difference_update(msg_numbers)
+
+    def remove(self, msg_num):
+        """Удаляет письмо из списка"""
+        self.rows = [row for row in self.rows if row[0] != msg_num]
+        self.headers.pop(msg_num, None)
+        self.selection.discard(msg_num)
+        self.render()
+
+    def selected_numbers(self):
+        """Номера всех выделенных писем по возрастанию"""
+        return sorted(self.selection)
+
+    def apply_changes(self, removed=(), renumbered=None, added=()):
+        """
+        Применяет изменения ящика без повторной загрузки списка: удаляет письма
+        removed, переводит номера оставшихся по renumbered {прежний: новый} и
+        добавляет строки added - кортежи (номер, размер, заголовки).
+        """
+        renumbered = renumbered or {}
+        removed = set(removed)
+        rows = [(renumbered.get(msg_num, msg_num), msg_size)
+                for msg_num, msg_size in self.rows if msg_num not in removed]
+        headers = {renumbered.get(msg_num, msg_num): value
+                   for msg_num, value in self.headers.items() if msg_num not in removed}
+        for msg_num, msg_size, value in added:
+            rows.append((msg_num, msg_size))
+            if value is not None:
+                headers[msg_num] = value
+
+        self.rows = sorted(rows)
+        self.headers = headers
+        self.requested = {renumbered.get(msg_num, msg_num) for msg_num in self.requested if msg_num not in removed}
+        self.selection = {renumbered.get(msg_num, msg_num) for msg_num in self.selection if msg_num not in removed}
+        self._set_offset(self.offset)
+        self.render()
+
+    def is_wanted(self, msg_num):
+        """Проверяет, находится ли письмо в видимом окне или в запасе вокруг него"""
+        return msg_num in self.wanted
+
+    def visible_count(self):
+        """Число строк, помещающихся в видимой области Treeview"""
+        row_height = ttk.Style().lookup('Treeview', 'rowheight') or 20
+        height = self.tree.winfo_height()
+        if height <= 1:
+            return int(self.tree.cget('height'))
+        # Вычитаем высоту строки заголовков колонок
+        return max(1, (height - 25) // int(row_height))
+
+    def scroll(self, amount, what):
+        step = self.visible_count() if what == 'pages' else 3
+        self._set_offset(self.offset + amount * step)
+        return 'break'
+
+    def _on_scrollbar(self, *args):
+        if args[0] == 'moveto':
+            self._set_offset(int(float(args[1]) * len(self.rows)))
+        elif args[0] == 'scroll':
+            self.scroll(int(args[1]), args[2])
+
+    def _set_offset(self, offset):
+        offset = max(0, min(offset, len(self.rows) - self.visible_count()))
+        if offset != self.offset:
+            self.offset = offset
+            self.render()
+
+    def _window(self, margin=0):
+        start = max(0, self.offset - margin)
+        end = min(len(self.rows), self.offset + self.visible_count() + margin)
+        return start, end
+
+    def render(self):
+        """Перерисовывает видимые строки и запрашивает недостающие заголовки"""
+        self.tree.delete(*self.tree.get_children())
+        start, end = self._window()
+        for msg_num, msg_size in self.rows[start:end]:
+            values = self.format_row(msg_num, msg_size, self.headers.get(msg_num))
+            self.tree.insert('', 'end', iid=str(msg_num), values=values)
+
+        visible = [str(msg_num) for msg_num in self.selection if self.tree.exists(str(msg_num))]
+        if visible:
+            self.tree.selection_set(visible)
+
+        if self.rows:
+            self.scrollbar.set(start / len(self.rows), end / len(self.rows))
+        else:
+            self.scrollbar.set(0, 1)
+
+        self._request_missing()
+
+    def _request_missing(self):
+        start, end = self._window(self.prefetch)
+        self.wanted = {msg_num for msg_num, _ in self.rows[start:end]}
+        missing = [msg_num for msg_num, _ in self.rows[start:end]
+                   if msg_num not in self.headers and msg_num not in self.requested]
+        if missing:
+            self.requested.update(missing)
+            self.on_need_headers(missing)
+
+    def _remember_selection(self, event):
+        # Выделение строк вне окна Treeview не видит - они сохраняются как были
+        shown = {int(item) for item in self.tree.get_children()}
+        self.selection = (self.selection - shown) | {int(item) for item in self.tree.selection()}
@@ -0,0 +1,428 @@
+import base64
+import collections
+import heapq
+import random
+import socket
+import socketserver
+import threading
+import time
+
+
+def message_sizes(count, distribution="fixed", size=2048, sigma=1.0, seed=1):
+    """
+    Возвращает список размеров писем.
+    distribution: "fixed" - все письма размера size,
+    "lognormal" - логнормальное распределение с медианой size и параметром sigma.
+    """
+    if distribution == "fixed":
+        return [size] * count
+    if distribution == "lognormal":
+        rng = random.Random(seed)
+        return [max(256, int(rng.lognormvariate(0, sigma) * size)) for _ in range(count)]
+    raise ValueError(f"Неизвестное распределение размеров: {distribution}")
+
+
+def make_message(index, size, attachment=False):
+    """
+    Детерминированно строит письмо номер index размером около size байт.
+    При attachment=True основная часть объема приходится на вложение в base64.
+    """
+    subject = base64.b64encode(f"Тестовое письмо {index}".encode('utf-8')).decode()
+    headers = (f"From: sender{index % 50}@example.org\r\n"
+               f"To: user@example.org\r\n"
+               f"Subject: =?utf-8?b?{subject}?=\r\n"
+               f"Date: Mon, 1 Jan 2024 00:00:00 +0000\r\n"
+               f"Message-ID: <{index}@bench.local>\r\n"
+               f"MIME-Version: 1.0\r\n")
+    line = f"Строка текста письма {index} для замера производительности.".encode('utf-8')
+
+    if not attachment:
+        body_lines = max(1, (size - len(headers)) // (len(line) + 2))
+        return (headers + "Content-Type: text/plain; charset=utf-8\r\n"
+                          "Content-Transfer-Encoding: 8bit\r\n\r\n").encode('utf-8') + \
+            b"\r\n".join([line] * body_lines) + b"\r\n"
+
+    boundary = f"bench-{index}"
+    # base64 увеличивает объем на треть, поэтому исходных данных нужно меньше
+    raw = bytes((index + i) % 256 for i in range(256)) * max(1, size * 3 // 4 // 256)
+    encoded = base64.encodebytes(raw).replace(b"\n", b"\r\n")
+    return (headers + f"Content-Type: multipart/mixed; boundary=\"{boundary}\"\r\n\r\n"
+                      f"--{boundary}\r\n"
+                      "Content-Type: text/plain; charset=utf-8\r\n\r\n").encode('utf-8') + \
+        line + b"\r\n" + \
+        (f"--{boundary}\r\n"
+         "Content-Type: application/octet-stream\r\n"
+         "Content-Transfer-Encoding: base64\r\n"
+         f"Content-Disposition: attachment; filename=\"file{index}.bin\"\r\n\r\n").encode('utf-8') + \
+        encoded + f"--{boundary}--\r\n".encode('utf-8')
+
+
+class Mailbox:
+    """
+    Почтовый ящик заглушки POP3. Письма строятся по запросу и не хранятся,
+    поэтому память сервера не искажает замеры клиента. У каждого письма есть
+    постоянный идентификатор (от него зависят содержимое и UIDL), а номер
+    письма - его позиция в ящике, которая сдвигается при удалении писем.
+    """
+
+    def __init__(self, sizes, attachment=False):
+        self.sizes = list(sizes)
+        self.attachment = attachment
+        # Идентификаторы писем по позициям; новые письма получают следующий по порядку
+        self.ids = list(range(1, len(self.sizes) + 1))
+        self._next_id = len(self.sizes) + 1
+        # Заявленные размеры по идентификаторам сохраняются и после удаления письма:
+        # сессия, открытая раньше, продолжает видеть его до своего завершения
+        self._declared_sizes = dict(zip(self.ids, self.sizes))
+        self._actual_sizes = {}
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self.sizes)
+
+    def snapshot(self):
+        """Идентификаторы писем на текущий момент - состав ящика для новой сессии"""
+        with self._lock:
+            return list(self.ids)
+
+    def message_by_id(self, message_id):
+        data = make_message(message_id, self._declared_sizes[message_id], self.attachment)
+        self._actual_sizes[message_id] = len(data)
+        return data
+
+    def size_by_id(self, message_id):
+        # Для LIST хватает заявленного размера, точный известен после первой выдачи
+        return self._actual_sizes.get(message_id, self._declared_sizes[message_id])
+
+    @staticmethod
+    def uidl_by_id(message_id):
+        return "bench-%d" % message_id
+
+    def message(self, number):
+        return self.message_by_id(self.ids[number - 1])
+
+    def size(self, number):
+        return self.size_by_id(self.ids[number - 1])
+
+    def uidl(self, number):
+        return self.uidl_by_id(self.ids[number - 1])
+
+    def add(self, size):
+        """Добавляет письмо в конец ящика; возвращает его идентификатор"""
+        with self._lock:
+            message_id = self._next_id
+            self._next_id += 1
+            self.ids.append(message_id)
+            self.sizes.append(size)
+            self._declared_sizes[message_id] = size
+            return message_id
+
+    def remove(self, message_ids):
+        """Удаляет письма с идентификаторами message_ids; номера следующих писем сдвигаются"""
+        message_ids = set(message_ids)
+        with self._lock:
+            keep = [i for i, message_id in enumerate(self.ids) if message_id not in message_ids]
+            self.ids = [self.ids[i] for i in keep]
+            self.sizes = [self.sizes[i] for i in keep]
+
+
+class _DelayedWriter:
+    """
+    Отправляет ответы клиенту через latency секунд после прихода команды.
+    Ответы на команды, пришедшие одной пачкой, уходят одновременно, поэтому
+    задержка моделирует время прохождения сети, а не медленный сервер.
+    """
+
+    def __init__(self, wfile, latency):
+        self.wfile = wfile
+        self.latency = latency
+        self._queue = []
+        self._seq = 0
+        self._cond = threading.Condition()
+        self._closed = False
+        if latency > 0:
+            self._thread = threading.Thread(target=self._run, daemon=True)
+            self._thread.start()
+
+    def write(self, data, arrived):
+        if self.latency <= 0:
+            self.wfile.write(data)
+            return
+        with self._cond:
+            heapq.heappush(self._queue, (arrived + self.latency, self._seq, data))
+            self._seq += 1
+            self._cond.notify()
+
+    def _run(self):
+        while True:
+            with self._cond:
+                while not self._queue and not self._closed:
+                    self._cond.wait()
+                if not self._queue:
+                    return
+                deliver_at, _, data = self._queue[0]
+                delay = deliver_at - time.monotonic()
+                if delay > 0:
+                    self._cond.wait(delay)
+                    continue
+                heapq.heappop(self._queue)
+            try:
+                self.wfile.write(data)
+            except OSError:
+                return
+
+    def close(self):
+        if self.latency <= 0:
+            return
+        with self._cond:
+            self._closed = True
+            self._cond.notify()
+        self._thread.join()
+
+
+def _multiline(data):
+    """Оформляет многострочный ответ POP3 с dot-stuffing и завершающей точкой"""
+    if data.endswith(b"\r\n"):
+        data = data[:-2]
+    lines = data.split(b"\r\n")
+    return b"".join(b"." + line + b"\r\n" if line.startswith(b".") else line + b"\r\n"
+                    for line in lines) + b".\r\n"
+
+
+class _Handler(socketserver.StreamRequestHandler):
+    def setup(self):
+        super().setup()
+        # Ответы пишутся по одному; без TCP_NODELAY алгоритм Нейгла вместе с
+        # отложенным ACK клиента добавлял бы к конвейерным ответам ~40 мс
+        self.connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+
+
+class _POP3Handler(_Handler):
+    def handle(self):
+        server = self.server
+        mailbox = server.mailbox
+        writer = _DelayedWriter(self.wfile, server.latency)
+        # Состав ящика фиксируется при входе (RFC 1939): письма, добавленные или
+        # удаленные другими сессиями, видны только в следующей сессии
+        maildrop = mailbox.snapshot()
+        # Пометки DELE хранятся идентификаторами писем и применяются к ящику по QUIT
+        deleted = set()
+        with server.lock:
+            server.connections.add(self.connection)
+        writer.write(b"+OK benchmark POP3 ready\r\n", time.monotonic())
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                arrived = time.monotonic()
+                parts = line.decode('utf-8', errors='replace').split()
+                if not parts:
+                    continue
+                command = parts[0].upper()
+                if server.should_drop(command):
+                    # Обрыв соединения без ответа, как при сбое сети
+                    self.connection.shutdown(socket.SHUT_RDWR)
+                    return
+                if command == "PASS":
+                    maildrop = mailbox.snapshot()
+                    deleted.clear()
+
+                number = int(parts[1]) if len(parts) > 1 and parts[1].isdigit() else None
+                if number is not None and not (1 <= number <= len(maildrop) and
+                                               maildrop[number - 1] not in deleted):
+                    number = 0
+                message_id = maildrop[number - 1] if number else None
+                live = [(n, i) for n, i in enumerate(maildrop, 1) if i not in deleted] \
+                    if command == "STAT" or command in ("LIST", "UIDL") and number is None else None
+
+                if command == "CAPA":
+                    reply = b"+OK\r\n" + _multiline(b"USER\r\nUIDL\r\nTOP\r\nPIPELINING\r\n")
+                elif command in ("USER", "PASS", "NOOP"):
+                    reply = b"+OK\r\n"
+                elif command == "STAT":
+                    reply = b"+OK %d %d\r\n" % (len(live), sum(mailbox.size_by_id(i) for _, i in live))
+                elif command in ("LIST", "UIDL") and number is None:
+                    if command == "LIST":
+                        listing = b"".join(b"%d %d\r\n" % (n, mailbox.size_by_id(i)) for n, i in live)
+                    else:
+                        listing = b"".join(b"%d %s\r\n" % (n, mailbox.uidl_by_id(i).encode()) for n, i in live)
+                    reply = b"+OK\r\n" + _multiline(listing)
+                elif command in ("LIST", "UIDL", "TOP", "RETR", "DELE"):
+                    if not number:
+                        reply = b"-ERR no such message\r\n"
+                    elif command == "LIST":
+                        reply = b"+OK %d %d\r\n" % (number, mailbox.size_by_id(message_id))
+                    elif command == "UIDL":
+                        reply = b"+OK %d %s\r\n" % (number, mailbox.uidl_by_id(message_id).encode())
+                    elif command == "DELE":
+                        deleted.add(message_id)
+                        reply = b"+OK\r\n"
+                    else:
+                        data = mailbox.message_by_id(message_id)
+                        if command == "TOP":
+                            head, _, body = data.partition(b"\r\n\r\n")
+                            count = int(parts[2]) if len(parts) > 2 else 0
+                            data = head + b"\r\n\r\n" + b"".join(
+                                body_line + b"\r\n" for body_line in body.split(b"\r\n")[:count])
+                        reply = b"+OK\r\n" + _multiline(data)
+                elif command == "RSET":
+                    deleted.clear()
+                    reply = b"+OK\r\n"
+                elif command == "QUIT":
+                    mailbox.remove(deleted)
+                    writer.write(b"+OK bye\r\n", arrived)
+                    return
+                else:
+                    reply = b"-ERR unknown command\r\n"
+                writer.write(reply, arrived)
+        finally:
+            writer.close()
+            with server.lock:
+                server.connections.discard(self.connection)
+
+
+class _SMTPHandler(_Handler):
+    def handle(self):
+        server = self.server
+        writer = _DelayedWriter(self.wfile, server.latency)
+        writer.write(b"220 benchmark ESMTP ready\r\n", time.monotonic())
+        in_data = False
+        try:
+            while True:
+                line = self.rfile.readline()
+                if not line:
+                    return
+                arrived = time.monotonic()
+                if in_data:
+                    if line == b".\r\n":
+                        in_data = False
+                        with server.lock:
+                            server.delivered += 1
+                        writer.write(b"250 OK queued\r\n", arrived)
+                    else:
+                        with server.lock:
+                            server.received_bytes += len(line)
+                    continue
+
+                command = line.decode('utf-8', errors='replace').strip().upper()
+                if command.startswith("EHLO"):
+                    reply = b"250-benchmark\r\n250-PIPELINING\r\n250-AUTH PLAIN\r\n250 SIZE 104857600\r\n"
+                elif command.startswith("HELO"):
+                    reply = b"250 benchmark\r\n"
+                elif command.startswith("AUTH"):
+                    reply = b"235 Authentication successful\r\n"
+                elif command.startswith(("MAIL", "RCPT", "RSET", "NOOP")):
+                    reply = b"250 OK\r\n"
+                elif command == "DATA":
+                    in_data = True
+                    reply = b"354 End data with <CR><LF>.<CR><LF>\r\n"
+                elif command == "QUIT":
+                    writer.write(b"221 bye\r\n", arrived)
+                    return
+                else:
+                    reply = b"502 Command not implemented\r\n"
+                writer.write(reply, arrived)
+        finally:
+            writer.close()
+
+
+class _Server(socketserver.ThreadingTCPServer):
+    daemon_threads = True
+    allow_reuse_address = True
+
+
+class _POP3Server(_Server):
+    def __init__(self, mailbox, latency):
+        super().__init__(("127.0.0.1", 0), _POP3Handler)
+        self.mailbox = mailbox
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.connections = set()
+        # Число полученных команд каждого вида
+        self.commands = collections.Counter()
+        self._drop = None
+
+    def should_drop(self, command):
+        """Учитывает команду и сообщает, нужно ли оборвать на ней соединение"""
+        with self.lock:
+            self.commands[command] += 1
+            if self._drop is None or self._drop[0] != command:
+                return False
+            if self._drop[1] > 0:
+                self._drop[1] -= 1
+                return False
+            self._drop = None
+            return True
+
+
+class FakePOP3Server:
+    """
+    Заглушка POP3 сервера для замеров и тестов, работающая в отдельном потоке.
+    latency - задержка ответа в секундах (время прохождения сети).
+    """
+
+    def __init__(self, mailbox, latency=0.0):
+        self.server = _POP3Server(mailbox, latency)
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def commands(self):
+        return self.server.commands
+
+    def drop_connection_on(self, command, after=0):
+        """Однократно обрывает соединение на команде command, пропустив after таких команд"""
+        with self.server.lock:
+            self.server._drop = [command.upper(), after]
+
+    def disconnect_all(self):
+        """Обрывает все открытые сессии, не отправляя ответа"""
+        with self.server.lock:
+            connections = list(self.server.connections)
+        for connection in connections:
+            try:
+                connection.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+
+class FakeSMTPServer:
+    """Заглушка SMTP сервера: принимает письма и считает их, не сохраняя содержимое"""
+
+    def __init__(self, latency=0.0):
+        self.server = _Server(("127.0.0.1", 0), _SMTPHandler)
+        self.server.latency = latency
+        self.server.lock = threading.Lock()
+        self.server.delivered = 0
+        self.server.received_bytes = 0
+        self.thread = None
+
+    @property
+    def port(self):
+        return self.server.server_address[1]
+
+    @property
+    def delivered(self):
+        return self.server.delivered
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
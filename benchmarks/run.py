@@ -0,0 +1,420 @@
+"""
+Замеры производительности почтового клиента на локальных заглушках POP3 и SMTP.
+
+Каждый сценарий выполняется в отдельном процессе, чтобы пиковое потребление
+памяти (RSS) относилось только к нему. Результаты можно сохранить как базовые
+и сравнивать с ними последующие запуски:
+
+    python run.py --save baseline.json
+    python run.py --compare baseline.json
+    python run.py --scenario pop3_list_small --scale 0.1
+"""
+import argparse
+import json
+import math
+import multiprocessing
+import os
+import platform
+import queue
+import sys
+import tempfile
+import time
+
+BENCH_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(BENCH_DIR)
+# Модули SMTP_POP3 импортируют друг друга без имени пакета, как при запуске из своего каталога
+for path in (ROOT_DIR, os.path.join(ROOT_DIR, "SMTP_POP3"), BENCH_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+try:
+    import resource
+except ImportError:  # Windows
+    resource = None
+
+from fake_servers import FakePOP3Server, FakeSMTPServer, Mailbox, make_message, message_sizes
+
+
+# Описание сценариев: kind - что замеряется, остальные поля - параметры нагрузки.
+# count, reads и sends уменьшаются пропорционально --scale.
+SCENARIOS = {
+    "pop3_list_small": {
+        "kind": "list", "count": 10000, "size": 2048, "distribution": "lognormal", "latency": 0.0,
+        "description": "LIST + TOP для 10k небольших писем",
+    },
+    "pop3_list_latency": {
+        "kind": "list", "count": 2000, "size": 2048, "distribution": "lognormal", "latency": 0.02,
+        "description": "LIST + TOP для 2k писем при задержке сети 20 мс",
+    },
+    "pop3_read_small": {
+        "kind": "read", "count": 10000, "reads": 1000, "size": 4096, "distribution": "lognormal",
+        "latency": 0.0, "description": "RETR и декодирование 1000 небольших писем",
+    },
+    "pop3_read_attachments": {
+        "kind": "read", "count": 100, "reads": 100, "size": 3 * 1024 * 1024, "distribution": "fixed",
+        "attachment": True, "latency": 0.0, "description": "RETR и декодирование 100 писем с вложениями по 3 МБ",
+    },
+    "pop3_parse_pipeline": {
+        "kind": "pipeline", "count": 2000, "size": 64 * 1024, "distribution": "lognormal", "latency": 0.0,
+        "description": "RETR и разбор 2000 писем в пуле процессов (EmailClient.parse_messages)",
+    },
+    "smtp_send": {
+        "kind": "send", "sends": 2000, "size": 2048, "latency": 0.0,
+        "description": "Отправка 2000 писем через пул SMTP соединений",
+    },
+    "smtp_send_latency": {
+        "kind": "send", "sends": 200, "size": 2048, "latency": 0.02,
+        "description": "Отправка 200 писем при задержке сети 20 мс",
+    },
+    "decode_small": {
+        "kind": "decode", "count": 10000, "size": 4096, "distribution": "lognormal",
+        "description": "EmailDecoder для 10k небольших писем без сети",
+    },
+    "decode_attachments": {
+        "kind": "decode", "count": 50, "size": 3 * 1024 * 1024, "distribution": "fixed", "attachment": True,
+        "description": "EmailDecoder для 50 писем с вложениями по 3 МБ без сети",
+    },
+}
+
+
+def percentile(values, q):
+    """Перцентиль по методу ближайшего ранга"""
+    if not values:
+        return None
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, math.ceil(q / 100 * len(ordered)) - 1))
+    return ordered[index]
+
+
+def peak_rss_mb():
+    """Пиковый RSS текущего процесса в мегабайтах или None, если он недоступен"""
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Linux возвращает килобайты, macOS - байты
+    return peak / (1024 * 1024) if sys.platform == "darwin" else peak / 1024
+
+
+def _scaled(params, key, scale):
+    return max(1, int(params[key] * scale))
+
+
+def _run_list(params, scale):
+    from main import EmailClient
+
+    count = _scaled(params, "count", scale)
+    sizes = message_sizes(count, params["distribution"], params["size"])
+    server = FakePOP3Server(Mailbox(sizes, params.get("attachment", False)), params["latency"]).start()
+    try:
+        client = EmailClient()
+        if not client.setup_pop3("127.0.0.1", server.port, "bench", "bench", use_ssl=False):
+            raise RuntimeError("Не удалось подключиться к заглушке POP3")
+
+        # Задержка каждого письма - время от предыдущего полученного заголовка
+        latencies = []
+        last = [time.perf_counter()]
+
+        def on_message(msg_num, msg_size, headers):
+            now = time.perf_counter()
+            latencies.append(now - last[0])
+            last[0] = now
+
+        start = time.perf_counter()
+        messages = client.list_messages(on_message=on_message)
+        elapsed = time.perf_counter() - start
+        client.close()
+        if messages is None or len(messages) != count:
+            raise RuntimeError("list_messages вернул неполный список")
+        return {"ops": count, "bytes": sum(sizes), "seconds": elapsed, "latencies": latencies}
+    finally:
+        server.stop()
+
+
+def _run_read(params, scale):
+    from main import EmailClient
+
+    count = _scaled(params, "count", scale)
+    reads = min(count, _scaled(params, "reads", scale))
+    sizes = message_sizes(count, params["distribution"], params["size"])
+    mailbox = Mailbox(sizes, params.get("attachment", False))
+    server = FakePOP3Server(mailbox, params["latency"]).start()
+    try:
+        client = EmailClient()
+        if not client.setup_pop3("127.0.0.1", server.port, "bench", "bench", use_ssl=False):
+            raise RuntimeError("Не удалось подключиться к заглушке POP3")
+        client.get_message_sizes()
+
+        # Письма читаются равномерно по всему ящику
+        step = max(1, count // reads)
+        numbers = list(range(1, count + 1, step))[:reads]
+        latencies = []
+        start = time.perf_counter()
+        for number in numbers:
+            op_start = time.perf_counter()
+            if client.read_message(number) is None:
+                raise RuntimeError(f"Не удалось прочитать письмо {number}")
+            latencies.append(time.perf_counter() - op_start)
+        elapsed = time.perf_counter() - start
+        client.close()
+        return {"ops": len(numbers), "bytes": sum(mailbox.size(n) for n in numbers),
+                "seconds": elapsed, "latencies": latencies}
+    finally:
+        server.stop()
+
+
+def _run_pipeline(params, scale):
+    from main import EmailClient
+
+    count = _scaled(params, "count", scale)
+    sizes = message_sizes(count, params["distribution"], params["size"])
+    mailbox = Mailbox(sizes, params.get("attachment", False))
+    server = FakePOP3Server(mailbox, params["latency"]).start()
+    try:
+        client = EmailClient()
+        if not client.setup_pop3("127.0.0.1", server.port, "bench", "bench", use_ssl=False):
+            raise RuntimeError("Не удалось подключиться к заглушке POP3")
+
+        # Задержка письма - время от предыдущего готового результата
+        latencies = []
+        start = last = time.perf_counter()
+        for parsed in client.parse_messages():
+            if not parsed.success:
+                raise RuntimeError(f"Письмо {parsed.msg_number} не разобрано: {parsed.error}")
+            now = time.perf_counter()
+            latencies.append(now - last)
+            last = now
+        elapsed = time.perf_counter() - start
+        client.close()
+        return {"ops": len(latencies), "bytes": sum(mailbox.size(n) for n in range(1, count + 1)),
+                "seconds": elapsed, "latencies": latencies}
+    finally:
+        server.stop()
+
+
+def _run_send(params, scale):
+    from main import EmailClient
+    from smtp_pool import SMTPConnectionPool
+
+    sends = _scaled(params, "sends", scale)
+    server = FakeSMTPServer(params["latency"]).start()
+    pool = SMTPConnectionPool()
+    try:
+        client = EmailClient(smtp_pool=pool)
+        text = "Строка текста письма для замера производительности.\n" * max(1, params["size"] // 100)
+
+        start = time.perf_counter()
+        if not client.setup_smtp("127.0.0.1", server.port, "bench", "bench", use_tls=False):
+            raise RuntimeError("Не удалось подключиться к заглушке SMTP")
+        setup_seconds = time.perf_counter() - start
+
+        latencies = []
+        for i in range(sends):
+            op_start = time.perf_counter()
+            if not client.send_email("bench@example.org", f"user{i % 10}@example.org", f"Письмо {i}", text):
+                raise RuntimeError(f"Письмо {i} не отправлено")
+            latencies.append(time.perf_counter() - op_start)
+        elapsed = time.perf_counter() - start
+        return {"ops": sends, "bytes": server.server.received_bytes, "seconds": elapsed,
+                "latencies": latencies, "setup_seconds": setup_seconds}
+    finally:
+        pool.close_all()
+        server.stop()
+
+
+def _run_decode(params, scale):
+    from email_decoder import EmailDecoder
+
+    count = _scaled(params, "count", scale)
+    sizes = message_sizes(count, params["distribution"], params["size"])
+    attachment = params.get("attachment", False)
+    latencies = []
+    total_bytes = 0
+    elapsed = 0.0
+    for index, size in enumerate(sizes, 1):
+        # Построение письма не входит в замер
+        data = make_message(index, size, attachment).decode('utf-8', errors='replace')
+        total_bytes += len(data)
+        op_start = time.perf_counter()
+        EmailDecoder.decode_message_content(data)
+        latency = time.perf_counter() - op_start
+        latencies.append(latency)
+        elapsed += latency
+    return {"ops": count, "bytes": total_bytes, "seconds": elapsed, "latencies": latencies}
+
+
+RUNNERS = {"list": _run_list, "read": _run_read, "pipeline": _run_pipeline, "send": _run_send,
+           "decode": _run_decode}
+
+
+def run_scenario(name, scale=1.0):
+    """Выполняет сценарий в текущем процессе и возвращает словарь с результатами"""
+    from common.log import setup_logging
+
+    params = SCENARIOS[name]
+    with tempfile.TemporaryDirectory() as workdir:
+        # Журнал и временные файлы сценария не засоряют рабочий каталог
+        setup_logging(os.path.join(workdir, "benchmark.log"))
+        previous_dir = os.getcwd()
+        os.chdir(workdir)
+        try:
+            raw = RUNNERS[params["kind"]](params, scale)
+        finally:
+            os.chdir(previous_dir)
+
+    seconds = raw["seconds"]
+    result = {
+        "scenario": name,
+        "description": params["description"],
+        "scale": scale,
+        "ops": raw["ops"],
+        "seconds": round(seconds, 4),
+        "ops_per_second": round(raw["ops"] / seconds, 2) if seconds else None,
+        "mb_per_second": round(raw["bytes"] / seconds / (1024 * 1024), 2) if seconds else None,
+        "p50_ms": round(percentile(raw["latencies"], 50) * 1000, 3),
+        "p99_ms": round(percentile(raw["latencies"], 99) * 1000, 3),
+        "peak_rss_mb": None,
+    }
+    if "setup_seconds" in raw:
+        result["setup_ms"] = round(raw["setup_seconds"] * 1000, 3)
+    rss = peak_rss_mb()
+    if rss is not None:
+        result["peak_rss_mb"] = round(rss, 1)
+    return result
+
+
+def _child(name, scale, results):
+    try:
+        results.put(run_scenario(name, scale))
+    except Exception as e:
+        results.put({"scenario": name, "error": str(e)})
+
+
+def run_isolated(name, scale=1.0, timeout=600):
+    """
+    Выполняет сценарий в отдельном процессе, чтобы замер памяти не зависел от других сценариев.
+    Если процесс завершился без результата или с ненулевым кодом либо не уложился
+    в timeout секунд, сценарий считается неудачным (результат с ключом "error").
+    """
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    process = context.Process(target=_child, args=(name, scale, results))
+    process.start()
+    deadline = time.monotonic() + timeout if timeout else None
+    result = None
+    while result is None:
+        try:
+            result = results.get(timeout=0.5)
+        except queue.Empty:
+            if not process.is_alive():
+                # Результат мог быть отправлен перед самым завершением процесса
+                try:
+                    result = results.get(timeout=1.0)
+                except queue.Empty:
+                    result = {"scenario": name,
+                              "error": f"процесс сценария завершился с кодом {process.exitcode} без результата"}
+            elif deadline is not None and time.monotonic() > deadline:
+                process.terminate()
+                result = {"scenario": name, "error": f"сценарий не завершился за {timeout} с"}
+
+    process.join(10)
+    if process.is_alive():
+        process.kill()
+        process.join()
+    if process.exitcode and "error" not in result:
+        result = {"scenario": name, "error": f"процесс сценария завершился с кодом {process.exitcode}"}
+    return result
+
+
+def compare(results, baseline, tolerance):
+    """
+    Сравнивает результаты с базовыми. Возвращает список строк отчета и признак
+    регрессии: пропускная способность ниже или p99 выше базовых больше чем на tolerance.
+    """
+    by_name = {item["scenario"]: item for item in baseline.get("results", [])}
+    lines = []
+    regression = False
+    for result in results:
+        base = by_name.get(result["scenario"])
+        if not base or "error" in result or "error" in base:
+            continue
+        if base.get("scale") != result.get("scale"):
+            lines.append(f"{result['scenario']}: масштаб отличается от базового, сравнение пропущено")
+            continue
+
+        changes = []
+        for key, higher_is_better in (("ops_per_second", True), ("p50_ms", False),
+                                      ("p99_ms", False), ("peak_rss_mb", False)):
+            old, new = base.get(key), result.get(key)
+            if not old or new is None:
+                continue
+            delta = (new - old) / old
+            worse = -delta if higher_is_better else delta
+            mark = ""
+            if worse > tolerance and key in ("ops_per_second", "p99_ms"):
+                mark = " РЕГРЕССИЯ"
+                regression = True
+            changes.append(f"{key} {old} -> {new} ({delta:+.1%}){mark}")
+        lines.append(f"{result['scenario']}: " + "; ".join(changes))
+    return lines, regression
+
+
+def _format_result(result):
+    if "error" in result:
+        return f"{result['scenario']:<24} ОШИБКА: {result['error']}"
+    rss = f"{result['peak_rss_mb']:.1f}" if result["peak_rss_mb"] is not None else "-"
+    return (f"{result['scenario']:<24} {result['ops']:>7} оп. {result['seconds']:>9.3f} с "
+            f"{result['ops_per_second']:>10.1f} оп/с {result['mb_per_second']:>8.2f} МБ/с "
+            f"p50 {result['p50_ms']:>8.3f} мс p99 {result['p99_ms']:>8.3f} мс RSS {rss} МБ")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Замеры производительности почтового клиента")
+    parser.add_argument("--scenario", action="append", choices=sorted(SCENARIOS),
+                        help="сценарий для запуска (можно указать несколько раз; по умолчанию все)")
+    parser.add_argument("--scale", type=float, default=1.0,
+                        help="множитель числа писем и операций, например 0.1 для быстрого прогона")
+    parser.add_argument("--save", metavar="FILE", help="сохранить результаты как базовые")
+    parser.add_argument("--compare", metavar="FILE", help="сравнить с сохраненными базовыми результатами")
+    parser.add_argument("--tolerance", type=float, default=0.1,
+                        help="допустимое ухудшение при сравнении (доля, по умолчанию 0.1)")
+    parser.add_argument("--timeout", type=float, default=600,
+                        help="предельное время одного сценария в секундах (0 - без ограничения)")
+    parser.add_argument("--list", action="store_true", help="показать список сценариев")
+    args = parser.parse_args()
+
+    if args.list:
+        for name, params in SCENARIOS.items():
+            print(f"{name:<24} {params['description']}")
+        return 0
+
+    results = []
+    for name in args.scenario or list(SCENARIOS):
+        result = run_isolated(name, args.scale, args.timeout)
+        print(_format_result(result), flush=True)
+        results.append(result)
+
+    report = {
+        "created": time.strftime("%Y-%m-%d %H:%M:%S"),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "results": results,
+    }
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(report, f, ensure_ascii=False, indent=2)
+        print(f"Результаты сохранены в {args.save}")
+
+    failed = any("error" in result for result in results)
+    if args.compare:
+        with open(args.compare, encoding="utf-8") as f:
+            baseline = json.load(f)
+        lines, regression = compare(results, baseline, args.tolerance)
+        print("\nСравнение с базовыми результатами:")
+        for line in lines:
+            print(line)
+        failed = failed or regression
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
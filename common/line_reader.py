@@ -0,0 +1,132 @@
+import io
+
+
+class LineReader:
+    """
+    Буферизованное построчное чтение ответов сервера из сокета.
+    На каждое соединение создается один экземпляр, который хранит
+    непрочитанный остаток данных между вызовами.
+    """
+
+    def __init__(self, sock, chunk_size=65536, on_read=None):
+        self.socket = sock
+        self.chunk_size = chunk_size
+        # on_read(число байт) вызывается после каждого чтения из сокета (учет трафика)
+        self.on_read = on_read
+        self._buffer = bytearray()
+        self._pos = 0
+
+    def _fill(self):
+        """Дочитывает очередной блок данных из сокета в буфер"""
+        chunk = self.socket.recv(self.chunk_size)
+        if not chunk:
+            raise ConnectionError("Соединение закрыто сервером")
+        if self.on_read:
+            self.on_read(len(chunk))
+        # Отбрасываем уже прочитанную часть буфера, чтобы он не рос бесконечно
+        if self._pos:
+            del self._buffer[:self._pos]
+            self._pos = 0
+        self._buffer += chunk
+
+    def has_buffered_data(self):
+        """Возвращает True, если в буфере остались непрочитанные данные"""
+        return self._pos < len(self._buffer)
+
+    def readline(self):
+        """Возвращает одну строку ответа в байтах без завершающего CRLF"""
+        # Сколько байт после текущей позиции уже просмотрено без нахождения CRLF
+        scanned = 0
+        while True:
+            end = self._buffer.find(b"\r\n", self._pos + scanned)
+            if end >= 0:
+                line = bytes(self._buffer[self._pos:end])
+                self._pos = end + 2
+                return line
+            # CR мог прийти последним байтом блока, поэтому его просматриваем повторно
+            scanned = max(len(self._buffer) - self._pos - 1, 0)
+            self._fill()
+
+    def read_multiline(self):
+        """
+        Читает многострочный ответ POP3 до строки из одной точки.
+        Снимает dot-stuffing и возвращает тело ответа в байтах (строки через CRLF).
+        """
+        sink = io.BytesIO()
+        self.read_multiline_into(sink)
+        data = sink.getvalue()
+        return data[:-2] if data.endswith(b"\r\n") else data
+
+    def read_multiline_into(self, sink, chunk_size=65536):
+        """
+        Читает многострочный ответ POP3 и пишет его в sink (объект с методом write)
+        блоками примерно по chunk_size байт, не накапливая ответ целиком в памяти.
+        Строки записываются без dot-stuffing и с окончанием CRLF. Возвращает число записанных байт.
+
+        Буфер разбирается не построчно: отдельно обрабатываются только строки,
+        начинающиеся с точки, остальные данные копируются целыми блоками.
+        """
+        pending = bytearray()
+        total = 0
+        # Находится ли _pos в начале строки
+        line_start = True
+        while True:
+            buffer = self._buffer
+            pos = self._pos
+            if line_start:
+                if pos >= len(buffer):
+                    self._fill()
+                    continue
+                if buffer[pos] == 0x2E:  # '.'
+                    if len(buffer) - pos < 3:
+                        self._fill()
+                        continue
+                    if buffer[pos + 1:pos + 3] == b"\r\n":
+                        self._pos = pos + 3
+                        break
+                    if buffer[pos + 1] == 0x2E:
+                        pos += 1
+                line_start = False
+
+            # Ближайшая строка, начинающаяся с точки; до нее данные копируются как есть
+            dot = buffer.find(b"\r\n.", pos)
+            if dot >= 0:
+                pending += buffer[pos:dot + 2]
+                self._pos = dot + 2
+                line_start = True
+            else:
+                last = buffer.rfind(b"\r\n", pos)
+                if last >= 0:
+                    pending += buffer[pos:last + 2]
+                    self._pos = last + 2
+                    line_start = True
+                else:
+                    # Незавершенная строка (точка в ее начале уже обработана); завершающий
+                    # CR оставляем в буфере, чтобы найти CRLF на стыке с новым блоком
+                    end = len(buffer) - 1 if buffer.endswith(b"\r") else len(buffer)
+                    pending += buffer[pos:end]
+                    self._pos = end
+                    self._fill()
+
+            if len(pending) >= chunk_size:
+                sink.write(bytes(pending))
+                total += len(pending)
+                pending.clear()
+
+        if pending:
+            sink.write(bytes(pending))
+            total += len(pending)
+        return total
+
+    def read_reply(self):
+        """
+        Читает полный ответ SMTP, включая строки-продолжения вида '250-...'.
+        Возвращает список строк ответа в байтах.
+        """
+        lines = []
+        while True:
+            line = self.readline()
+            lines.append(line)
+            # Последняя строка ответа имеет пробел (или ничего) после кода
+            if len(line) < 4 or line[3:4] != b"-":
+                return lines
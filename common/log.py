@@ -0,0 +1,161 @@
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+from datetime import datetime
+
+# Уровень трассировки протокола: команды и ответы серверов пишутся как DEBUG
+TRACE = logging.DEBUG
+
+# Повторно захватывается: get_logger держит его на время setup_logging
+_lock = threading.RLock()
+_listener = None
+_file_handler = None
+_max_payload = 512
+
+
+class BufferedRotatingFileHandler(logging.handlers.RotatingFileHandler):
+    """
+    Файл журнала с ротацией по размеру, сбрасываемый на диск не чаще flush_interval.
+    Записи уровня ERROR и выше сбрасываются сразу; отложенный сброс после
+    простоя выполняет слушатель очереди (см. flush_pending).
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, flush_interval=1.0):
+        # Трассировка может содержать байты письма не в UTF-8 (суррогаты) - пишем их экранированными
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count, encoding='utf-8',
+                         errors='backslashreplace')
+        self.flush_interval = flush_interval
+        self._last_flush = time.monotonic()
+        # Есть ли записи, еще не сброшенные на диск
+        self._pending = False
+
+    def emit(self, record):
+        super().emit(record)
+        if record.levelno >= logging.ERROR:
+            # Ошибка может предшествовать аварийному завершению - она должна попасть на диск
+            self._flush_now()
+
+    def flush(self):
+        if time.monotonic() - self._last_flush >= self.flush_interval:
+            self._flush_now()
+        else:
+            self._pending = True
+
+    def flush_pending(self):
+        """Сбрасывает на диск записи, задержанные ограничением частоты сброса"""
+        if self._pending:
+            self._flush_now()
+
+    def _flush_now(self):
+        super().flush()
+        self._last_flush = time.monotonic()
+        self._pending = False
+
+    def close(self):
+        super().flush()
+        super().close()
+
+
+class _FlushingQueueListener(logging.handlers.QueueListener):
+    """
+    Слушатель очереди журнала, который после flush_interval секунд без новых
+    записей сбрасывает задержанные записи на диск: иначе последние записи
+    перед простоем оставались бы в буфере до следующей записи.
+    """
+
+    def __init__(self, records, handler, flush_interval):
+        super().__init__(records, handler)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        if not block or not self.flush_interval or self.flush_interval <= 0:
+            return super().dequeue(block)
+        while True:
+            try:
+                return self.queue.get(timeout=self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush_pending()
+
+
+def setup_logging(path=None, level=logging.INFO, max_bytes=10 * 1024 * 1024, backup_count=5,
+                  max_payload=512, flush_interval=1.0):
+    """
+    Настраивает общий журнал всех клиентов.
+
+    Записи помещаются в очередь, а в файл их пишет отдельный поток, поэтому
+    вызов логирования не выполняет дисковых операций. Файл ротируется по размеру
+    max_bytes и сбрасывается на диск не чаще раза в flush_interval секунд;
+    записи уровня ERROR и записи перед простоем сбрасываются без задержки. Трассировка протокола пишется с уровнем DEBUG и при level=INFO
+    отключена. Тела писем и длинные ответы обрезаются до max_payload символов
+    (None - не обрезать, 0 - не записывать вовсе).
+    """
+    global _listener, _file_handler, _max_payload
+
+    with _lock:
+        _stop_listener()
+        if path is None:
+            path = f"email_client_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
+
+        _file_handler = BufferedRotatingFileHandler(path, max_bytes, backup_count, flush_interval)
+        _file_handler.setFormatter(logging.Formatter(
+            "%(asctime)s %(levelname)s %(name)s: %(message)s", datefmt='%Y-%m-%d %H:%M:%S'))
+        _max_payload = max_payload
+
+        records = queue.SimpleQueue()
+        root = logging.getLogger("email_client")
+        root.handlers = [logging.handlers.QueueHandler(records)]
+        root.setLevel(level)
+        root.propagate = False
+
+        _listener = _FlushingQueueListener(records, _file_handler, flush_interval)
+        _listener.start()
+
+
+def _stop_listener():
+    global _listener, _file_handler
+    if _listener:
+        # stop() дописывает все записи, оставшиеся в очереди
+        _listener.stop()
+        _listener = None
+    if _file_handler:
+        _file_handler.close()
+        _file_handler = None
+
+
+def shutdown_logging():
+    """Дописывает очередь журнала и закрывает файл"""
+    with _lock:
+        _stop_listener()
+
+
+atexit.register(shutdown_logging)
+
+
+def get_logger(name):
+    """Возвращает журнал компонента; при первом обращении настраивает журнал по умолчанию"""
+    if _listener is None:
+        # Проверка и настройка под одной блокировкой: иначе два потока могли бы
+        # настроить журнал дважды, и вторая настройка остановила бы первую
+        with _lock:
+            if _listener is None:
+                setup_logging()
+    return logging.getLogger(f"email_client.{name}")
+
+
+def log_file():
+    """Путь к текущему файлу журнала"""
+    return _file_handler.baseFilename if _file_handler else None
+
+
+def shorten(text, limit=None):
+    """Обрезает длинное содержимое (например, тело письма) перед записью в журнал"""
+    limit = _max_payload if limit is None else limit
+    if limit is None or text is None or len(text) <= limit:
+        return text
+    if limit == 0:
+        return f"<{len(text)} символов>"
+    return f"{text[:limit]}... <еще {len(text) - limit} символов>"
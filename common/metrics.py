@@ -0,0 +1,228 @@
+import json
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Границы корзин гистограмм задержек в секундах
+DEFAULT_BUCKETS = (0.001, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# Описания метрик для экспорта в формате Prometheus: имя -> (тип, справка)
+METRICS_HELP = {
+    "command_seconds": ("histogram", "Время от отправки команды до строки ответа сервера"),
+    "transfer_seconds": ("histogram", "Время приема многострочных данных после ответа на команду"),
+    "connect_seconds": ("histogram", "Время установки TCP соединения"),
+    "tls_seconds": ("histogram", "Время TLS рукопожатия (SSL или STARTTLS)"),
+    "auth_seconds": ("histogram", "Время аутентификации"),
+    "bytes_sent_total": ("counter", "Отправлено байт"),
+    "bytes_received_total": ("counter", "Получено байт"),
+    "errors_total": ("counter", "Ответы сервера с ошибкой и сбои соединения"),
+    "retries_total": ("counter", "Повторные попытки операций"),
+}
+
+
+class Histogram:
+    """Гистограмма с фиксированными корзинами, как в Prometheus"""
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        index = len(self.buckets)
+        for i, bound in enumerate(self.buckets):
+            if value <= bound:
+                index = i
+                break
+        self.counts[index] += 1
+        self.count += 1
+        self.sum += value
+
+    def cumulative(self):
+        """Возвращает пары (граница, число наблюдений не больше границы), включая +Inf"""
+        result = []
+        total = 0
+        for bound, count in zip(list(self.buckets) + [float("inf")], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+    def quantile(self, q):
+        """Оценка квантиля по верхней границе корзины"""
+        if not self.count:
+            return None
+        rank = q * self.count
+        for bound, total in self.cumulative():
+            if total >= rank:
+                return bound
+        return None
+
+
+class Metrics:
+    """
+    Реестр метрик протоколов: гистограммы задержек и счетчики с метками.
+
+    Клиенты сообщают о событиях через observe() и inc(); каждое событие также
+    передается подключенным хукам hook(имя, значение, метки), что позволяет
+    отправлять его во внешнюю систему трассировки. Хук не должен бросать
+    исключения - ошибки хуков игнорируются.
+    """
+
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = buckets
+        self.enabled = True
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._hooks = []
+
+    def add_hook(self, hook):
+        with self._lock:
+            self._hooks = self._hooks + [hook]
+
+    def remove_hook(self, hook):
+        with self._lock:
+            self._hooks = [h for h in self._hooks if h is not hook]
+
+    @staticmethod
+    def _key(name, labels):
+        return name, tuple(sorted(labels.items()))
+
+    def observe(self, name, value, **labels):
+        """Добавляет наблюдение (обычно длительность в секундах) в гистограмму name"""
+        if not self.enabled:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram(self.buckets)
+            histogram.observe(value)
+            hooks = self._hooks
+        self._notify(hooks, name, value, labels)
+
+    def inc(self, name, value=1, **labels):
+        """Увеличивает счетчик name на value"""
+        if not self.enabled or not value:
+            return
+        key = self._key(name, labels)
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+            hooks = self._hooks
+        self._notify(hooks, name, value, labels)
+
+    @staticmethod
+    def _notify(hooks, name, value, labels):
+        for hook in hooks:
+            try:
+                hook(name, value, labels)
+            except Exception:
+                pass
+
+    @contextmanager
+    def timer(self, name, **labels):
+        """Контекстный менеджер, записывающий длительность блока в гистограмму name"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start, **labels)
+
+    def reset(self):
+        with self._lock:
+            self._histograms = {}
+            self._counters = {}
+
+    def snapshot(self):
+        """Возвращает текущие значения в виде словаря, пригодного для json.dumps"""
+        with self._lock:
+            histograms = [(key, h.count, h.sum, h.cumulative(), h.quantile(0.5), h.quantile(0.99))
+                          for key, h in self._histograms.items()]
+            counters = list(self._counters.items())
+
+        result = {"timestamp": time.time(), "histograms": [], "counters": []}
+        for (name, labels), count, total, buckets, p50, p99 in sorted(histograms):
+            result["histograms"].append({
+                "name": name,
+                "labels": dict(labels),
+                "count": count,
+                "sum": total,
+                "p50": p50,
+                "p99": p99,
+                "buckets": {_format_bound(bound): n for bound, n in buckets},
+            })
+        for (name, labels), value in sorted(counters):
+            result["counters"].append({"name": name, "labels": dict(labels), "value": value})
+        return result
+
+    def to_json(self, indent=2):
+        return json.dumps(self.snapshot(), ensure_ascii=False, indent=indent)
+
+    def to_prometheus(self, prefix="email_client_"):
+        """Возвращает метрики в текстовом формате экспозиции Prometheus"""
+        with self._lock:
+            histograms = sorted((key, h.count, h.sum, h.cumulative()) for key, h in self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        lines = []
+        described = set()
+
+        def describe(name, kind):
+            if name in described:
+                return
+            described.add(name)
+            help_text = METRICS_HELP.get(name, (kind, name))[1]
+            lines.append(f"# HELP {prefix}{name} {help_text}")
+            lines.append(f"# TYPE {prefix}{name} {kind}")
+
+        for (name, labels), count, total, buckets in histograms:
+            describe(name, "histogram")
+            for bound, n in buckets:
+                bucket_labels = labels + (("le", _format_bound(bound)),)
+                lines.append(f"{prefix}{name}_bucket{_format_labels(bucket_labels)} {n}")
+            lines.append(f"{prefix}{name}_sum{_format_labels(labels)} {total}")
+            lines.append(f"{prefix}{name}_count{_format_labels(labels)} {count}")
+
+        for (name, labels), value in counters:
+            describe(name, "counter")
+            lines.append(f"{prefix}{name}{_format_labels(labels)} {value}")
+        return "\n".join(lines) + "\n"
+
+    def write_prometheus(self, path, prefix="email_client_"):
+        """Записывает метрики в файл для node_exporter textfile collector"""
+        _write_atomic(path, self.to_prometheus(prefix))
+
+    def write_json(self, path):
+        _write_atomic(path, self.to_json())
+
+
+def _format_bound(bound):
+    return "+Inf" if bound == float("inf") else repr(float(bound))
+
+
+def _format_labels(labels):
+    if not labels:
+        return ""
+    parts = []
+    for key, value in labels:
+        value = str(value).replace("\\", "\\\\").replace("\"", "\\\"").replace("\n", "\\n")
+        parts.append(f'{key}="{value}"')
+    return "{" + ",".join(parts) + "}"
+
+
+def _write_atomic(path, text):
+    # Файл подменяется целиком, чтобы читатель не увидел его наполовину записанным
+    tmp_path = f"{path}.tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        f.write(text)
+    os.replace(tmp_path, path)
+
+
+# Общий реестр, в который по умолчанию пишут все клиенты
+metrics = Metrics()
+
+
+def get_metrics():
+    return metrics
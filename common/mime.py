@@ -0,0 +1,494 @@
+import binascii
+import codecs
+import io
+from email.header import decode_header, make_header
+from email.message import Message
+
+# Байты вне алфавита base64 (пробелы, переводы строк и посторонние символы): декодер
+# пропускает их, как email.message, поэтому они отбрасываются до разбиения на группы по 4
+_BASE64_IGNORED = bytes(set(range(256)) - set(
+    b"ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz0123456789+/="))
+
+
+def default_text_decoder(data, charset=None, sender=None):
+    """Переводит байты в строку по указанной кодировке, при ошибке - как UTF-8 с заменой"""
+    if charset:
+        try:
+            return data.decode(charset)
+        except (UnicodeDecodeError, LookupError):
+            pass
+    return data.decode('utf-8', errors='replace')
+
+
+def complete_prefix(data, charset=None):
+    """
+    Отбрасывает неполный многобайтный символ в конце данных - например, когда
+    письмо получено не целиком (TOP). Для однобайтных кодировок данные не меняются.
+    """
+    try:
+        decoder = codecs.getincrementaldecoder(charset or 'utf-8')()
+        decoder.decode(data, final=False)
+        pending = decoder.getstate()[0]
+    except (LookupError, UnicodeDecodeError, TypeError, IndexError):
+        return data
+    return data[:len(data) - len(pending)] if pending else data
+
+
+def default_header_decoder(value, sender=None):
+    """Декодирует encoded words в значении заголовка"""
+    try:
+        return str(make_header(decode_header(value)))
+    except Exception:
+        return value
+
+
+class _Base64Decoder:
+    """
+    Потоковый декодер base64 с правилами binascii.a2b_base64 (как email.message):
+    посторонние символы пропускаются, '=' в начале группы игнорируется, а
+    заполнение, завершающее группу, заканчивает данные части.
+    """
+
+    def __init__(self):
+        # Символы незавершенной группы (меньше 4) и число '=' подряд после них
+        self._pending = b""
+        self._pads = 0
+        self.done = False
+
+    def feed(self, chunk):
+        if self.done:
+            return b""
+        data = chunk.translate(None, _BASE64_IGNORED)
+        if b"=" not in data:
+            # Обычный случай - блок без заполнения
+            if data:
+                self._pads = 0
+            data = self._pending + data
+            usable = len(data) - len(data) % 4
+            self._pending = data[usable:]
+            return binascii.a2b_base64(data[:usable]) if usable else b""
+
+        pieces = data.split(b"=")
+        out = []
+        for index, piece in enumerate(pieces):
+            if index:
+                self._pads += 1
+                quad = len(self._pending)
+                if quad >= 2 and quad + self._pads >= 4:
+                    out.append(binascii.a2b_base64(self._pending + b"=" * (4 - quad)))
+                    self._pending = b""
+                    self.done = True
+                    break
+            if piece:
+                self._pads = 0
+                data = self._pending + piece
+                usable = len(data) - len(data) % 4
+                self._pending = data[usable:]
+                if usable:
+                    out.append(binascii.a2b_base64(data[:usable]))
+        return b"".join(out)
+
+    def flush(self):
+        """Неполная последняя группа: дополняется, как это делает email.message"""
+        data, self._pending = self._pending, b""
+        if len(data) < 2:
+            return b""
+        return binascii.a2b_base64(data + b"=" * (4 - len(data)))
+
+
+class MimePart:
+    """
+    Часть письма. Хранит заголовки и положение тела в исходном файле;
+    тело читается и декодируется только при обращении к нему.
+    """
+
+    def __init__(self, message, headers, start, end=None):
+        self._message = message
+        self.headers = headers
+        # Границы закодированного тела в исходных данных
+        self.start = start
+        self.end = end
+        self.children = []
+
+    @property
+    def content_type(self):
+        return self.headers.get_content_type()
+
+    @property
+    def charset(self):
+        return self.headers.get_content_charset()
+
+    @property
+    def encoding(self):
+        return str(self.headers.get('Content-Transfer-Encoding', '7bit')).strip().lower()
+
+    @property
+    def filename(self):
+        filename = self.headers.get_filename()
+        if filename:
+            return self._message.decode_header(filename)
+        return None
+
+    @property
+    def size(self):
+        """Размер закодированного тела в байтах (для multipart - вместе с вложенными частями)"""
+        return self.end - self.start
+
+    @property
+    def is_multipart(self):
+        return self.headers.get_content_maintype() == 'multipart'
+
+    @property
+    def is_attachment(self):
+        disposition = str(self.headers.get('Content-Disposition', '')).split(';', 1)[0].strip().lower()
+        return not self.is_multipart and (disposition == 'attachment' or
+                                          (self.filename is not None and disposition != 'inline'))
+
+    def walk(self):
+        """Обходит часть и все вложенные части в порядке следования в письме"""
+        yield self
+        for child in self.children:
+            yield from child.walk()
+
+    def iter_decoded(self, chunk_size=65536):
+        """Генератор декодированных блоков тела части, читаемых из источника по chunk_size байт"""
+        if self.is_multipart:
+            return
+
+        encoding = self.encoding
+        if encoding == 'base64':
+            decoder = _Base64Decoder()
+            for chunk in self._message.read_range(self.start, self.end, chunk_size):
+                block = decoder.feed(chunk)
+                if block:
+                    yield block
+                if decoder.done:
+                    return
+            block = decoder.flush()
+            if block:
+                yield block
+            return
+
+        leftover = b""
+        for chunk in self._message.read_range(self.start, self.end, chunk_size):
+            if encoding == 'quoted-printable':
+                # Декодируются только целые строки, чтобы не разорвать мягкий перенос '='
+                data = leftover + chunk
+                cut = data.rfind(b"\n") + 1
+                leftover = data[cut:]
+                if cut:
+                    yield binascii.a2b_qp(data[:cut])
+            else:
+                yield chunk
+
+        if leftover:
+            yield binascii.a2b_qp(leftover)
+
+    def read_bytes(self):
+        """Возвращает декодированное тело части целиком"""
+        return b"".join(self.iter_decoded())
+
+    def text(self):
+        """Возвращает тело текстовой части строкой"""
+        data = self.read_bytes()
+        if self._message.truncated and self.end >= self._message.root.end:
+            # Часть обрезана вместе с письмом: последний символ мог прийти не полностью
+            data = complete_prefix(data, self.charset)
+        return self._message.decode_text(data, self.charset)
+
+    def save(self, target, chunk_size=65536):
+        """
+        Декодирует тело части в файл (путь) или файловый объект блоками,
+        не загружая его в память целиком. Возвращает число записанных байт.
+        """
+        if isinstance(target, str):
+            with open(target, 'wb') as f:
+                return self.save(f, chunk_size)
+        written = 0
+        for block in self.iter_decoded(chunk_size):
+            target.write(block)
+            written += len(block)
+        return written
+
+
+class MimeMessage:
+    """
+    Разобранное письмо: заголовки и дерево частей. При разборе читаются только
+    заголовки частей и границы; тела декодируются по запросу из исходного
+    файла, поэтому он должен оставаться открытым, пока используется сообщение.
+    Сообщение не потокобезопасно: части читают общий источник.
+    Для письма, полученного не целиком (truncated=True), незакрытые части
+    заканчиваются вместе с данными, а их размеры и вложения могут быть неполными.
+    """
+
+    def __init__(self, source, text_decoder=None, header_decoder=None, owns_source=False, truncated=False):
+        self.source = source
+        self.root = None
+        self.truncated = truncated
+        self._owns_source = owns_source
+        self._text_decoder = text_decoder or default_text_decoder
+        self._header_decoder = header_decoder or default_header_decoder
+
+    @property
+    def headers(self):
+        return self.root.headers
+
+    @property
+    def sender(self):
+        return str(self.headers.get('From', '')).encode('ascii', errors='replace').decode('ascii') or None
+
+    def get_header(self, name, default=""):
+        """Возвращает декодированное значение заголовка"""
+        value = self.headers.get(name)
+        if value is None:
+            return default
+        value = str(value)
+        try:
+            value.encode('ascii')
+        except UnicodeEncodeError:
+            # Незакодированные 8-битные заголовки парсер хранит как суррогаты
+            return self.decode_text(value.encode('ascii', errors='surrogateescape'), None)
+        return self.decode_header(value)
+
+    def decode_header(self, value):
+        return self._header_decoder(value, self.sender)
+
+    def decode_text(self, data, charset):
+        return self._text_decoder(data, charset, self.sender)
+
+    def parts(self):
+        return list(self.root.walk())
+
+    def _first_body(self, content_type):
+        for part in self.root.walk():
+            if part.content_type == content_type and not part.is_attachment:
+                return part
+        return None
+
+    @property
+    def text_part(self):
+        return self._first_body('text/plain')
+
+    @property
+    def html_part(self):
+        return self._first_body('text/html')
+
+    @property
+    def text(self):
+        """Текст первой части text/plain или None"""
+        part = self.text_part
+        return part.text() if part else None
+
+    @property
+    def html(self):
+        part = self.html_part
+        return part.text() if part else None
+
+    @property
+    def attachments(self):
+        return [part for part in self.root.walk() if part.is_attachment]
+
+    def read_range(self, start, end, chunk_size=65536):
+        """Генератор блоков исходных данных в диапазоне [start, end)"""
+        self.source.seek(start)
+        remaining = end - start
+        while remaining > 0:
+            chunk = self.source.read(min(chunk_size, remaining))
+            if not chunk:
+                break
+            remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        if self._owns_source:
+            self.source.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.close()
+
+
+def _parse_headers(lines):
+    """
+    Собирает заголовки части в email.message.Message. Значения не декодируются;
+    8-битные байты сохраняются как суррогаты, как это делает BytesParser.
+    """
+    headers = Message()
+    name = None
+    value = []
+    for line in lines:
+        text = line.decode('ascii', errors='surrogateescape').rstrip('\r\n')
+        if text[:1] in (' ', '\t') and name:
+            # Продолжение свернутого заголовка: перевод строки убирается, пробел остается
+            value.append(text)
+            continue
+        if name:
+            headers[name] = ''.join(value)
+        name = None
+        if ':' in text:
+            name, first = text.split(':', 1)
+            name = name.strip()
+            value = [first.lstrip()]
+    if name:
+        headers[name] = ''.join(value)
+    return headers
+
+
+class _Scanner:
+    """Чтение источника с учетом смещений: заголовки построчно, тела - блоками"""
+
+    def __init__(self, source, block_size=65536):
+        self.source = source
+        self.block_size = block_size
+        self.offset = source.tell()
+
+    def readline(self):
+        line = self.source.readline()
+        self.offset += len(line)
+        return line
+
+    def skip_body(self, boundaries):
+        """
+        Пропускает тело до строки-разделителя одной из boundaries. Данные читаются
+        блоками, а строками проверяются только места, где строка начинается с '--'.
+        Возвращает (конец тела, разделитель или None в конце данных); позиция
+        источника остается сразу за строкой-разделителем.
+        """
+        start = self.offset
+        if not boundaries:
+            end = self.source.seek(0, io.SEEK_END)
+            self.offset = end
+            return end, None
+
+        # Фиктивный перевод строки в начале позволяет искать разделитель и в первой строке тела
+        buffer = bytearray(b"\n")
+        buffer_start = start - 1
+        search_from = 0
+        eof = False
+        while True:
+            index = buffer.find(b"\n--", search_from)
+            if index < 0:
+                if eof:
+                    self.offset = max(start, buffer_start + len(buffer))
+                    return self.offset, None
+                # Хвост "\r\n-" может оказаться началом разделителя и нужен для его разбора
+                drop = max(len(buffer) - 3, 0)
+                del buffer[:drop]
+                buffer_start += drop
+                search_from = 0
+                chunk = self.source.read(self.block_size)
+                eof = not chunk
+                buffer += chunk
+                continue
+
+            line_start = index + 1
+            line_end = buffer.find(b"\n", line_start)
+            if line_end < 0 and not eof:
+                chunk = self.source.read(self.block_size)
+                eof = not chunk
+                buffer += chunk
+                search_from = index
+                continue
+
+            line_end = len(buffer) if line_end < 0 else line_end + 1
+            kind = _boundary_kind(bytes(buffer[line_start:line_end]), boundaries)
+            if kind:
+                # Перевод строки перед разделителем относится к разделителю (RFC 2046)
+                body_end = buffer_start + index
+                if index > 0 and buffer[index - 1] == 13:
+                    body_end -= 1
+                self.offset = buffer_start + line_end
+                self.source.seek(self.offset)
+                return max(start, body_end), kind
+            search_from = line_start
+
+
+def _boundary_kind(line, boundaries):
+    """Возвращает ('part' | 'close', граница), если строка - разделитель одной из boundaries"""
+    if not line.startswith(b"--") or not boundaries:
+        return None
+    stripped = line.rstrip()
+    for boundary in reversed(boundaries):
+        delimiter = b"--" + boundary
+        if stripped == delimiter:
+            return 'part', boundary
+        if stripped == delimiter + b"--":
+            return 'close', boundary
+    return None
+
+
+def _parse_part(message, scanner, boundaries):
+    """
+    Разбирает часть, начинающуюся с текущей позиции. Возвращает кортеж
+    (часть, разделитель, на котором она закончилась, или None в конце данных).
+    """
+    header_lines = []
+    ended = None
+    while True:
+        line = scanner.readline()
+        if not line:
+            break
+        kind = _boundary_kind(line, boundaries)
+        if kind:
+            ended = kind
+            break
+        if line in (b"\r\n", b"\n"):
+            break
+        header_lines.append(line)
+
+    headers = _parse_headers(header_lines)
+    part = MimePart(message, headers, scanner.offset, scanner.offset)
+    if ended or not line:
+        return part, ended
+
+    boundary = headers.get_param('boundary') if headers.get_content_maintype() == 'multipart' else None
+    if not boundary:
+        # Листовая часть: тело продолжается до разделителя объемлющей части
+        part.end, kind = scanner.skip_body(boundaries)
+        return part, kind
+
+    inner = boundaries + [str(boundary).encode('ascii', errors='replace')]
+    own = inner[-1]
+    # Преамбула до первого разделителя пропускается
+    part.end, kind = scanner.skip_body(inner)
+
+    while kind and kind[1] == own and kind[0] == 'part':
+        child, kind = _parse_part(message, scanner, inner)
+        part.children.append(child)
+        part.end = child.end
+
+    if kind is None or kind[1] != own:
+        # Данные кончились или встретился разделитель объемлющей части: часть не была закрыта
+        return part, kind
+
+    # Эпилог после закрывающего разделителя пропускается до разделителя объемлющей части
+    part.end, kind = scanner.skip_body(boundaries)
+    return part, kind
+
+
+def parse_message(source, text_decoder=None, header_decoder=None, close_source=False, truncated=False):
+    """
+    Разбирает структуру письма без декодирования тел частей.
+    source - байты, путь к файлу или файловый объект, открытый в бинарном режиме
+    с поддержкой seek; письмо читается с текущей позиции объекта. Путь
+    открывается и закрывается вместе с сообщением, как и файловый объект при close_source=True.
+    text_decoder(байты, кодировка, отправитель) и header_decoder(значение, отправитель)
+    позволяют подставить собственный подбор кодировок. truncated=True указывает,
+    что письмо получено не целиком (например, командой TOP).
+    """
+    owns_source = close_source
+    if isinstance(source, (bytes, bytearray)):
+        source = io.BytesIO(source)
+    elif isinstance(source, str):
+        source = open(source, 'rb')
+        owns_source = True
+
+    message = MimeMessage(source, text_decoder, header_decoder, owns_source, truncated)
+    try:
+        message.root, _ = _parse_part(message, _Scanner(source), [])
+    except Exception:
+        message.close()
+        raise
+    return message
@@ -0,0 +1,19 @@
+"""
+Общая подготовка тестов: пути импорта как у benchmarks/run.py и журнал во
+временном каталоге, чтобы тесты не оставляли файлы email_client_*.log.
+"""
+import os
+import sys
+import tempfile
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+ROOT_DIR = os.path.dirname(TESTS_DIR)
+# Модули SMTP_POP3 импортируют друг друга без имени пакета, как при запуске из своего каталога
+for path in (ROOT_DIR, os.path.join(ROOT_DIR, "SMTP_POP3"), os.path.join(ROOT_DIR, "benchmarks")):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+
+from common.log import setup_logging
+
+LOG_DIR = tempfile.mkdtemp(prefix="email_client_tests_")
+setup_logging(os.path.join(LOG_DIR, "tests.log"))
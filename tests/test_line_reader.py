@@ -0,0 +1,110 @@
+import io
+import random
+import unittest
+
+import support  # noqa: F401  (пути импорта и журнал тестов)
+from common.line_reader import LineReader
+from fake_servers import FakePOP3Server, Mailbox, make_message
+from POP3.main import POP3Client
+
+
+class SplitSocket:
+    """Сокет-заглушка: отдает данные блоками случайной длины, как их может нарезать TCP"""
+
+    def __init__(self, data, rng, max_chunk):
+        self.data = data
+        self.rng = rng
+        self.max_chunk = max_chunk
+        self.pos = 0
+
+    def recv(self, size):
+        count = min(size, self.rng.randint(1, self.max_chunk))
+        chunk = self.data[self.pos:self.pos + count]
+        self.pos += len(chunk)
+        return chunk
+
+
+def stuff(lines):
+    """Оформляет строки многострочным ответом POP3 с dot-stuffing"""
+    return b"".join((b"." + line if line.startswith(b".") else line) + b"\r\n" for line in lines) + b".\r\n"
+
+
+def read_by_lines(reader, sink):
+    """Прежняя построчная реализация read_multiline_into - эталон для сравнения"""
+    while True:
+        line = reader.readline()
+        if line == b".":
+            return
+        if line.startswith(b".."):
+            line = line[1:]
+        sink.write(line + b"\r\n")
+
+
+class LineReaderSplitTest(unittest.TestCase):
+    """read_multiline_into должен давать тот же результат, что и построчное чтение, при любой нарезке"""
+
+    LINES = [b"", b".", b"..", b"...", b".x", b"abc", b"\r", b"a\rb", b"\rx", b"x.", b"-- ", b"\xd0\x9f\xd1\x80"]
+
+    def _check(self, lines, rng, max_chunk, chunk_size):
+        wire = stuff(lines) + b"+OK next\r\n"
+
+        expected = io.BytesIO()
+        reference = LineReader(SplitSocket(wire, random.Random(0), len(wire)))
+        read_by_lines(reference, expected)
+
+        reader = LineReader(SplitSocket(wire, rng, max_chunk))
+        sink = io.BytesIO()
+        written = reader.read_multiline_into(sink, chunk_size=chunk_size)
+        self.assertEqual(sink.getvalue(), expected.getvalue(), lines)
+        self.assertEqual(written, len(expected.getvalue()))
+        # Следующий ответ остается в буфере нетронутым
+        self.assertEqual(reader.readline(), b"+OK next")
+
+    def test_random_lines_random_splits(self):
+        rng = random.Random(2024)
+        for _ in range(3000):
+            lines = [rng.choice(self.LINES) * rng.randint(1, 3) for _ in range(rng.randint(0, 8))]
+            self._check(lines, rng, max_chunk=rng.randint(1, 12), chunk_size=rng.randint(1, 32))
+
+    def test_messages_random_splits(self):
+        rng = random.Random(7)
+        for index in range(1, 41):
+            data = make_message(index, rng.randint(200, 20000), attachment=index % 2 == 0)
+            lines = data[:-2].split(b"\r\n")
+            # Строки, начинающиеся с точки, в разных местах письма
+            for _ in range(5):
+                lines.insert(rng.randrange(len(lines) + 1), rng.choice([b".", b"..", b".hidden"]))
+            self._check(lines, rng, max_chunk=rng.choice([1, 7, 100, 4096, 65536]),
+                        chunk_size=rng.choice([1, 100, 65536]))
+
+    def test_read_multiline_strips_final_crlf(self):
+        lines = [b"first", b"..second", b""]
+        reader = LineReader(SplitSocket(stuff(lines), random.Random(1), 3))
+        self.assertEqual(reader.read_multiline(), b"first\r\n..second\r\n")
+
+
+class RetrieveTest(unittest.TestCase):
+    """RETR через заглушку POP3 возвращает письмо байт в байт"""
+
+    def setUp(self):
+        self.mailbox = Mailbox([3000, 70000, 200000, 500], attachment=True)
+        self.server = FakePOP3Server(self.mailbox).start()
+        self.client = POP3Client("127.0.0.1", self.server.port, use_ssl=False)
+        self.assertTrue(self.client.connect())
+        self.client.send_command("USER user")
+        self.client.send_command("PASS password")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_retrieve_to(self):
+        for number in range(1, len(self.mailbox) + 1):
+            sink = io.BytesIO()
+            size = self.client.retrieve_to(number, sink, chunk_size=4096)
+            self.assertEqual(sink.getvalue(), make_message(number, self.mailbox.sizes[number - 1], True))
+            self.assertEqual(size, len(sink.getvalue()))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,46 @@
+import logging
+import os
+import time
+import unittest
+
+import support  # noqa: F401  (пути импорта и журнал тестов)
+from common.log import get_logger, setup_logging
+
+
+class BufferedLogTest(unittest.TestCase):
+    """Записи журнала попадают на диск после простоя и сразу для ошибок"""
+
+    def setUp(self):
+        self.path = os.path.join(support.LOG_DIR, f"{self.id()}.log")
+
+    def tearDown(self):
+        setup_logging(os.path.join(support.LOG_DIR, "tests.log"))
+
+    def wait_for(self, text, timeout=2.0):
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            with open(self.path, encoding='utf-8') as f:
+                if text in f.read():
+                    return True
+            time.sleep(0.02)
+        return False
+
+    def test_idle_flush(self):
+        setup_logging(self.path, flush_interval=0.2)
+        logger = get_logger("test")
+        # Первая запись сбрасывается сразу, следующие в пределах интервала задерживаются
+        for index in range(5):
+            logger.info("запись %d", index)
+        self.assertTrue(self.wait_for("запись 4"))
+
+    def test_error_flushed_immediately(self):
+        setup_logging(self.path, flush_interval=60)
+        logger = get_logger("test")
+        logger.info("первая")
+        logger.info("вторая")
+        logger.log(logging.ERROR, "сбой")
+        self.assertTrue(self.wait_for("сбой", timeout=1.0))
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,138 @@
+import base64
+import email
+import email.policy
+import io
+import random
+import unittest
+from email.message import EmailMessage
+
+import support  # noqa: F401  (пути импорта и журнал тестов)
+from common.mime import MimeMessage, _parse_part, _Scanner, parse_message
+from fake_servers import make_message
+
+# Байты вне алфавита base64, которые встречаются в поврежденных вложениях
+STRAY = b"!*-_.#@$%^&(){}[]~`\"'<>?\\|;:,\t "
+
+
+def parse_with_block(data, block_size):
+    """Разбирает письмо, читая источник блоками block_size байт"""
+    source = io.BytesIO(data)
+    message = MimeMessage(source)
+    message.root, _ = _parse_part(message, _Scanner(source, block_size), [])
+    return message
+
+
+def leaves(message):
+    return [part for part in message.parts() if not part.is_multipart]
+
+
+def reference_leaves(data):
+    return [part for part in email.message_from_bytes(data, policy=email.policy.default).walk()
+            if not part.is_multipart()]
+
+
+class MimeParserTest(unittest.TestCase):
+    """Разбор common.mime должен совпадать с пакетом email стандартной библиотеки"""
+
+    def assertSameAsEmail(self, data, block_sizes=(7, 64, 65536), chunk_sizes=(3, 65536)):
+        expected = reference_leaves(data)
+        for block_size in block_sizes:
+            message = parse_with_block(data, block_size)
+            parts = leaves(message)
+            self.assertEqual([part.content_type for part in parts],
+                             [part.get_content_type() for part in expected], block_size)
+            for part, reference in zip(parts, expected):
+                payload = reference.get_payload(decode=True) or b""
+                self.assertEqual(part.filename, reference.get_filename())
+                for chunk_size in chunk_sizes:
+                    self.assertEqual(b"".join(part.iter_decoded(chunk_size)), payload,
+                                     (block_size, chunk_size, part.content_type))
+
+    def _text(self, rng):
+        lines = [rng.choice(["--", "-- x", "--notb", "plain", "", "Привет", "=3D", "a" * rng.randint(0, 100)])
+                 for _ in range(rng.randint(1, 8))]
+        return "\n".join(lines) + rng.choice(["", "\n"])
+
+    def _binary(self, rng):
+        return bytes(rng.randrange(256) for _ in range(rng.randint(0, 3000)))
+
+    def test_random_messages(self):
+        rng = random.Random(5)
+        for _ in range(150):
+            message = EmailMessage()
+            message['Subject'] = 'test'
+            message.set_content(self._text(rng), cte=rng.choice(['8bit', 'quoted-printable', 'base64']))
+            if rng.random() < 0.3:
+                message.add_alternative("<p>%s</p>" % self._text(rng), subtype='html')
+            for index in range(rng.randint(0, 3)):
+                if rng.random() < 0.5:
+                    message.add_attachment(self._binary(rng), maintype='application', subtype='octet-stream',
+                                           filename=f'file{index}.bin')
+                else:
+                    message.add_attachment(self._text(rng), filename=f'text{index}.txt',
+                                           cte=rng.choice(['quoted-printable', 'base64']))
+            if message.is_multipart() and rng.random() < 0.3:
+                message.preamble = "pre --\n--x"
+                message.epilogue = "epi\n--"
+            data = message.as_bytes()
+            if rng.random() < 0.5:
+                data = data.replace(b"\n", b"\r\n")
+            self.assertSameAsEmail(data)
+
+    def test_nested_multipart(self):
+        message = EmailMessage()
+        message.set_content("текст")
+        message.add_alternative("<p>текст <img src=\"cid:logo\"></p>", subtype='html')
+        html = message.get_payload()[1]
+        html.add_related(b"\x89PNG" + bytes(range(256)) * 8, maintype='image', subtype='png', cid='<logo>')
+        message.add_attachment(b"\x00\x01\x02" * 500, maintype='application', subtype='octet-stream',
+                               filename='data.bin')
+        data = message.as_bytes()
+        self.assertEqual([part.content_type for part in parse_message(data).parts()],
+                         ['multipart/mixed', 'multipart/alternative', 'text/plain', 'multipart/related',
+                          'text/html', 'image/png', 'application/octet-stream'])
+        self.assertSameAsEmail(data)
+
+    def test_attached_message_is_not_expanded(self):
+        inner = EmailMessage()
+        inner['Subject'] = 'inner'
+        inner.set_content("вложенное письмо")
+        outer = EmailMessage()
+        outer.set_content("внешний текст")
+        outer.add_attachment(inner)
+        part = parse_message(outer.as_bytes()).parts()[-1]
+        self.assertEqual(part.content_type, 'message/rfc822')
+        self.assertEqual(parse_message(part.read_bytes()).text, "вложенное письмо\n")
+
+    def test_benchmark_messages(self):
+        for index in range(1, 6):
+            self.assertSameAsEmail(make_message(index, 5000 * index, attachment=True))
+            self.assertSameAsEmail(make_message(index, 5000 * index))
+
+    def test_base64_with_stray_characters(self):
+        rng = random.Random(1)
+        header = (b"Content-Type: application/octet-stream\r\n"
+                  b"Content-Transfer-Encoding: base64\r\n\r\n")
+        for _ in range(500):
+            encoded = bytearray(base64.encodebytes(self._binary(rng)).replace(b"\n", b"\r\n"))
+            for _ in range(rng.randint(1, 6)):
+                position = rng.randint(0, len(encoded))
+                encoded[position:position] = bytes([rng.choice(STRAY)])
+            self.assertSameAsEmail(header + bytes(encoded), block_sizes=(5, 65536), chunk_sizes=(1, 4, 65536))
+
+    def test_base64_padding_inside_body(self):
+        header = (b"Content-Type: application/octet-stream\r\n"
+                  b"Content-Transfer-Encoding: base64\r\n\r\n")
+        for body in [b"QQ==\r\nQkM=\r\n", b"QUJD\r\n=\r\nREVG\r\n", b"QUJ*DR!EVG\r\n", b"QUJDREVG=\r\n"]:
+            self.assertSameAsEmail(header + body, chunk_sizes=(1, 2, 3, 65536))
+
+    def test_truncated_text(self):
+        data = ("Content-Type: text/plain; charset=utf-8\r\n"
+                "Content-Transfer-Encoding: 8bit\r\n\r\nПривет").encode('utf-8')
+        # Последний символ обрезан посередине
+        message = parse_message(data[:-1], truncated=True)
+        self.assertEqual(message.text, "Приве")
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,159 @@
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+import unittest
+from collections import Counter
+
+import support  # noqa: F401  (пути импорта и журнал тестов)
+from fake_servers import FakePOP3Server, Mailbox
+from poller import AccountConfig, MailboxPoller
+from POP3.main import POP3Client
+
+
+class SessionCounter:
+    """Фабрика клиентов для MailboxPoller, считающая одновременные сессии к каждому серверу"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.active = Counter()
+        self.peak = Counter()
+        self.peak_total = 0
+
+    def __call__(self, server, port, use_ssl):
+        counter = self
+
+        class Client(POP3Client):
+            def connect(self):
+                with counter.lock:
+                    counter.active[port] += 1
+                    counter.peak[port] = max(counter.peak[port], counter.active[port])
+                    counter.peak_total = max(counter.peak_total, sum(counter.active.values()))
+                return super().connect()
+
+            def close(self):
+                super().close()
+                with counter.lock:
+                    counter.active[port] -= 1
+
+        return Client(server, port, use_ssl)
+
+
+class MailboxPollerTest(unittest.TestCase):
+    """MailboxPoller против заглушек POP3: ограничение сессий на сервер и сохранение полученных UIDL"""
+
+    def setUp(self):
+        self.tmp = tempfile.mkdtemp(prefix="email_client_tests_")
+        self.state_path = os.path.join(self.tmp, "poller_state.json")
+        self.servers = []
+        self.received = []
+        self.lock = threading.Lock()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def start_server(self, mailbox, latency=0.0):
+        server = FakePOP3Server(mailbox, latency).start()
+        self.servers.append(server)
+        return server
+
+    def on_message(self, account, uidl, headers, content):
+        with self.lock:
+            self.received.append((account.name, uidl, headers.get('Message-ID')))
+
+    def make_poller(self, accounts, **kwargs):
+        kwargs.setdefault('state_path', self.state_path)
+        return MailboxPoller(accounts, on_message=self.on_message, **kwargs)
+
+    @staticmethod
+    def account(name, server, username=None, interval=300):
+        return AccountConfig(name, "127.0.0.1", server.port, username or name, "password",
+                             use_ssl=False, interval=interval)
+
+    def test_per_server_limit(self):
+        # Сессии к первому серверу медленные: ожидающие его ящики не должны задерживать второй сервер
+        slow = self.start_server(Mailbox([2000] * 3), latency=0.05)
+        fast = self.start_server(Mailbox([2000] * 3))
+        accounts = [self.account(f"slow{i}", slow) for i in range(6)] + \
+                   [self.account(f"fast{i}", fast) for i in range(4)]
+        counter = SessionCounter()
+        poller = self.make_poller(accounts, max_workers=8, per_server_limit=2, client_factory=counter)
+
+        results = poller.poll_all()
+        self.assertEqual(results, {account.name: 3 for account in accounts})
+        self.assertEqual(counter.peak[slow.port], 2)
+        self.assertLessEqual(counter.peak[fast.port], 2)
+        self.assertGreater(counter.peak_total, 2)
+        self.assertEqual(sum(counter.active.values()), 0)
+        self.assertEqual(len(self.received), 3 * len(accounts))
+
+    def test_state_survives_restart(self):
+        mailbox = Mailbox([2000, 3000, 4000])
+        server = self.start_server(mailbox)
+        accounts = [self.account("first", server), self.account("second", server, username="other")]
+
+        self.assertEqual(self.make_poller(accounts).poll_all(), {"first": 3, "second": 3})
+        with open(self.state_path, encoding='utf-8') as f:
+            state = json.load(f)
+        self.assertEqual(state[f"first@127.0.0.1:{server.port}"], ["bench-1", "bench-2", "bench-3"])
+
+        # Новый экземпляр после перезапуска не считает старые письма новыми
+        self.received.clear()
+        self.assertEqual(self.make_poller(accounts).poll_all(), {"first": 0, "second": 0})
+        self.assertEqual(self.received, [])
+
+        mailbox.remove([1])
+        mailbox.add(1500)
+        self.assertEqual(self.make_poller(accounts).poll_all(), {"first": 1, "second": 1})
+        self.assertEqual(sorted(self.received), [("first", "bench-4", "<4@bench.local>"),
+                                                 ("second", "bench-4", "<4@bench.local>")])
+        with open(self.state_path, encoding='utf-8') as f:
+            state = json.load(f)
+        # UIDL удаленного письма забыт
+        self.assertEqual(state[f"first@127.0.0.1:{server.port}"], ["bench-2", "bench-3", "bench-4"])
+
+    def test_without_state_file(self):
+        server = self.start_server(Mailbox([2000, 3000]))
+        accounts = [self.account("only", server)]
+        self.assertEqual(self.make_poller(accounts, state_path=None).poll_all(), {"only": 2})
+        self.assertEqual(self.make_poller(accounts, state_path=None).poll_all(), {"only": 2})
+        self.assertFalse(os.path.exists(self.state_path))
+
+    def test_jitter_bounds(self):
+        server = self.start_server(Mailbox([]))
+        account = self.account("only", server, interval=100)
+        poller = self.make_poller([account], jitter=0.2)
+        delays = [poller._next_delay(account) for _ in range(1000)]
+        self.assertTrue(all(80 <= delay <= 120 for delay in delays))
+        self.assertGreater(max(delays) - min(delays), 10)
+        self.assertEqual(self.make_poller([account], jitter=0)._next_delay(account), 100)
+
+    def test_scheduler_polls_periodically(self):
+        mailbox = Mailbox([2000])
+        server = self.start_server(mailbox)
+        accounts = [self.account(f"box{i}", server, interval=0.1) for i in range(3)]
+        counter = SessionCounter()
+        poller = self.make_poller(accounts, per_server_limit=1, client_factory=counter)
+        poller.start()
+        try:
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and min(s.polls for s in poller.stats.values()) < 3:
+                time.sleep(0.05)
+            mailbox.add(1000)
+            deadline = time.monotonic() + 5
+            while time.monotonic() < deadline and len(self.received) < 2 * len(accounts):
+                time.sleep(0.05)
+        finally:
+            poller.stop()
+        self.assertGreaterEqual(min(s.polls for s in poller.stats.values()), 3)
+        self.assertEqual(counter.peak[server.port], 1)
+        self.assertEqual(sorted(uidl for _, uidl, _ in self.received),
+                         ["bench-1"] * 3 + ["bench-2"] * 3)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,187 @@
+import io
+import os
+import shutil
+import tempfile
+import unittest
+
+import support  # noqa: F401  (пути импорта и журнал тестов)
+from fake_servers import FakePOP3Server, Mailbox, make_message
+from main import EmailClient
+from message_cache import MessageCache
+from POP3.main import POP3Client
+
+SIZES = [2000, 2500, 3000, 3500, 4000, 4500]
+
+
+class POP3SessionTest(unittest.TestCase):
+    """Сессия EmailClient против заглушки POP3: переподключение, синхронизация по UIDL и удаление"""
+
+    def setUp(self):
+        self.mailbox = Mailbox(SIZES)
+        self.server = FakePOP3Server(self.mailbox).start()
+        self.tmp = tempfile.mkdtemp(prefix="email_client_tests_")
+        self.cache = MessageCache(os.path.join(self.tmp, "cache.db"))
+        self.client = EmailClient(cache=self.cache)
+        self.client.pop3_retry_delay = 0
+        self.assertTrue(self.client.setup_pop3("127.0.0.1", self.server.port, "user", "password", use_ssl=False))
+        self.assertEqual(len(self.client.get_message_sizes()), len(SIZES))
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+        self.cache.close()
+        shutil.rmtree(self.tmp, ignore_errors=True)
+
+    def download(self, msg_number):
+        sink = io.BytesIO()
+        self.assertIsNotNone(self.client.download_message(msg_number, sink))
+        return sink.getvalue()
+
+    def test_reconnect_after_disconnect(self):
+        self.server.disconnect_all()
+        self.assertEqual(self.download(3), make_message(3, SIZES[2]))
+        self.assertEqual(self.server.commands["USER"], 2)
+
+    def test_reconnect_maps_numbers_by_uidl(self):
+        # Другой клиент удалил письмо 2, пока сессия была разорвана: номера сдвинулись
+        self.mailbox.remove([2])
+        self.server.disconnect_all()
+        self.assertEqual(self.download(3), make_message(3, SIZES[2]))
+        self.assertEqual(self.download(6), make_message(6, SIZES[5]))
+
+    def test_listing_resumes_after_drop(self):
+        self.server.drop_connection_on("TOP", after=3)
+        messages = self.client.list_messages()
+        self.assertEqual([msg_num for msg_num, _, _ in messages], list(range(1, len(SIZES) + 1)))
+        self.assertEqual([headers['Message-ID'] for _, _, headers in messages],
+                         [f"<{index}@bench.local>" for index in range(1, len(SIZES) + 1)])
+        self.assertEqual(self.server.commands["USER"], 2)
+
+    def test_sync_unchanged_costs_only_stat(self):
+        self.server.commands.clear()
+        self.assertFalse(self.client.sync_messages().changed)
+        self.assertEqual(dict(self.server.commands), {"STAT": 1})
+        # Новая сессия добавляет только вход и выход
+        self.server.commands.clear()
+        self.assertFalse(self.client.sync_messages(reopen_session=True).changed)
+        self.assertEqual(dict(self.server.commands), {"QUIT": 1, "USER": 1, "PASS": 1, "STAT": 1})
+
+    def test_sync_uidl_diff(self):
+        self.mailbox.remove([2])
+        self.mailbox.add(1500)
+        # Текущая сессия видит ящик на момент входа
+        self.assertFalse(self.client.sync_messages().changed)
+
+        self.server.commands.clear()
+        result = self.client.sync_messages(reopen_session=True)
+        self.assertEqual(result.removed, [2])
+        self.assertEqual(result.renumbered, {3: 2, 4: 3, 5: 4, 6: 5})
+        self.assertEqual([(msg_num, headers['Message-ID']) for msg_num, _, headers in result.added],
+                         [(6, "<7@bench.local>")])
+        self.assertEqual(self.client.uidl_map, {number: self.mailbox.uidl(number) for number in range(1, 7)})
+        self.assertEqual(self.client.message_sizes[6], 1500)
+        # Размер нового письма запрошен LIST n, без полного LIST
+        self.assertEqual(self.server.commands["QUIT"], 1)
+        self.assertEqual(self.server.commands["LIST"], 1)
+        self.assertEqual(self.server.commands["TOP"], 1)
+        self.assertFalse(self.client.sync_messages(reopen_session=True).changed)
+
+    def test_sync_reopen_sees_new_mail(self):
+        self.mailbox.add(1500)
+        self.mailbox.add(1600)
+        result = self.client.sync_messages(reopen_session=True)
+        self.assertEqual([msg_num for msg_num, _, _ in result.added], [7, 8])
+        self.assertEqual(result.removed, [])
+        self.assertEqual(self.server.commands["USER"], 2)
+
+    def test_sync_keeps_session_with_pending_deletes(self):
+        self.assertEqual(self.client.mark_for_deletion([1]), 1)
+        self.mailbox.add(1500)
+        self.assertFalse(self.client.sync_messages(reopen_session=True).changed)
+        self.assertEqual(self.server.commands["USER"], 1)
+        self.assertEqual(self.client.pending_deletes, {1})
+        self.assertEqual(len(self.mailbox), len(SIZES) + 1)
+
+    def test_rollback_deletion(self):
+        self.assertEqual(self.client.mark_for_deletion([1, 2]), 2)
+        self.assertEqual(self.client.pending_deletes, {1, 2})
+        self.assertTrue(self.client.rollback_deletion())
+        self.assertEqual(self.client.pending_deletes, set())
+        self.assertEqual(self.server.commands["RSET"], 1)
+        # QUIT после RSET ничего не удаляет
+        self.client.close()
+        self.assertEqual(len(self.mailbox), len(SIZES))
+
+    def test_commit_deletion(self):
+        self.assertEqual(self.client.mark_for_deletion([1, 3]), 2)
+        result = self.client.commit_deletion()
+        self.assertEqual(result.removed, [1, 3])
+        self.assertEqual(result.renumbered, {2: 1, 4: 2, 5: 3, 6: 4})
+        self.assertEqual(self.mailbox.ids, [2, 4, 5, 6])
+        self.assertEqual(self.client.pending_deletes, set())
+
+    def test_commit_after_drop_remarks_deletes(self):
+        self.assertEqual(self.client.mark_for_deletion([2]), 1)
+        # Пометки разорванной сессии сервер забывает; клиент должен повторить DELE
+        self.server.disconnect_all()
+        result = self.client.commit_deletion()
+        self.assertEqual(result.removed, [2])
+        self.assertEqual(self.mailbox.ids, [1, 3, 4, 5, 6])
+        self.assertEqual(self.server.commands["DELE"], 2)
+
+    def test_reconnect_keeps_pending_deletes_uncommitted(self):
+        self.assertEqual(self.client.mark_for_deletion([2]), 1)
+        # Переподключение при живой сессии не должно подтверждать удаление QUIT
+        self.assertTrue(self.client._reconnect_pop3())
+        self.assertEqual(self.server.commands["QUIT"], 0)
+        self.assertEqual(len(self.mailbox), len(SIZES))
+        self.assertEqual(self.client.pending_deletes, {2})
+        self.assertTrue(self.client.rollback_deletion())
+        self.client.close()
+        self.assertEqual(len(self.mailbox), len(SIZES))
+
+    def test_preview_small_message_uses_retr(self):
+        headers, _, truncated = self.client.preview_message(2)
+        self.assertEqual(headers['Message-ID'], "<2@bench.local>")
+        self.assertFalse(truncated)
+        self.assertEqual((self.server.commands["RETR"], self.server.commands["TOP"]), (1, 0))
+
+    def test_preview_unknown_size_uses_top(self):
+        self.client.message_sizes.pop(2)
+        headers, _, truncated = self.client.preview_message(2)
+        self.assertEqual(headers['Message-ID'], "<2@bench.local>")
+        self.assertTrue(truncated)
+        self.assertEqual((self.server.commands["RETR"], self.server.commands["TOP"]), (0, 1))
+
+
+class PipelineDrainTest(unittest.TestCase):
+    """Досрочно закрытый конвейер TOP дочитывает ответы, а при обрыве помечает сессию разорванной"""
+
+    def setUp(self):
+        self.server = FakePOP3Server(Mailbox(SIZES)).start()
+        self.client = POP3Client("127.0.0.1", self.server.port, use_ssl=False)
+        self.assertTrue(self.client.connect())
+        self.client.send_command("USER user")
+        self.client.send_command("PASS password")
+
+    def tearDown(self):
+        self.client.close()
+        self.server.stop()
+
+    def test_close_drains_responses(self):
+        pipeline = self.client.top_pipelined(range(1, len(SIZES) + 1), 0, window=len(SIZES))
+        self.assertEqual(next(pipeline)[0], 1)
+        pipeline.close()
+        self.assertTrue(self.client.connected)
+        self.assertTrue(self.client.send_command("NOOP").startswith("+OK"))
+
+    def test_drop_while_draining_marks_session_broken(self):
+        self.server.drop_connection_on("TOP", after=2)
+        pipeline = self.client.top_pipelined(range(1, len(SIZES) + 1), 0, window=len(SIZES))
+        self.assertEqual(next(pipeline)[0], 1)
+        pipeline.close()
+        self.assertFalse(self.client.connected)
+
+
+if __name__ == "__main__":
+    unittest.main()
@@ -0,0 +1,52 @@
+import asyncio
+import unittest
+
+import support  # noqa: F401  (пути импорта и журнал тестов)
+from fake_servers import FakeSMTPServer
+from SMTP.async_client import AsyncSMTPClient
+from SMTP.main import SMTPClient
+
+
+class ConnectFailureTest(unittest.TestCase):
+    """Неудачное подключение не оставляет открытый сокет"""
+
+    def setUp(self):
+        self.server = FakeSMTPServer().start()
+
+    def tearDown(self):
+        self.server.stop()
+
+    def test_refused_starttls_closes_socket(self):
+        client = SMTPClient()
+        sock = None
+        original = client.ehlo
+
+        def ehlo():
+            nonlocal sock
+            sock = client.socket
+            return original()
+
+        client.ehlo = ehlo
+        # Заглушка не поддерживает STARTTLS
+        self.assertFalse(client.connect("127.0.0.1", self.server.port, use_tls=True))
+        self.assertIsNotNone(sock)
+        self.assertEqual(sock.fileno(), -1)
+        self.assertIsNone(client.socket)
+
+    def test_plain_connect(self):
+        client = SMTPClient()
+        self.assertTrue(client.connect("127.0.0.1", self.server.port, use_tls=False))
+        self.assertTrue(client.supports("PIPELINING"))
+        client.close()
+
+    def test_async_refused_starttls_closes_connection(self):
+        async def run():
+            client = AsyncSMTPClient(timeout=5)
+            self.assertFalse(await client.connect("127.0.0.1", self.server.port, use_tls=True))
+            self.assertIsNone(client.writer)
+
+        asyncio.run(run())
+
+
+if __name__ == "__main__":
+    unittest.main()